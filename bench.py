@@ -0,0 +1,245 @@
+"""Микробенчмарки хранилища и обработчиков заявок на синтетической истории
+
+Для каждого размера истории и каждого хранилища (json, json с журналом, sqlite)
+генерируется otgul_requests.json в прежнем формате, после чего замеряются
+загрузка с восстановлением ожидающих заявок (как в on_ready), add_request,
+get_request_by_id, has_today_request, update_request_status, выдача первой
+страницы /мои_отгулы и периодическое сохранение счетчиков статистики.
+Хранилище собирается как в боте: с архивом и счетчиками статистики.
+Результаты пишутся в JSON; с --compare сравниваются с прошлым запуском:
+медиана, выросшая сверх порога, считается регрессией (код выхода 1). В режиме json без журнала каждое изменение переписывает весь
+файл, поэтому число записей для него уменьшается пропорционально размеру
+истории (не меньше MIN_REWRITE_OPS). История в миллион заявок замеряется
+только явно: --sizes 1000000.
+
+    python bench.py --output bench.json
+    python bench.py --output new.json --compare bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import bot
+
+BACKENDS = ('json', 'journal', 'sqlite')
+STATUSES = ('approved', 'approved', 'approved', 'rejected', 'deleted', 'expired')
+# Хранилища, которые при каждом изменении переписывают файл целиком
+FULL_REWRITE = ('json',)
+MIN_REWRITE_OPS = 5
+
+
+def generate_requests(count, seed=0):
+    """Синтетическая история в прежнем формате otgul_requests.json
+
+    Около 50 заявок на сотрудника; заявки идут по дням в прошлое от сегодняшнего,
+    сегодняшние — ожидающие.
+    """
+    rng = random.Random(seed)
+    users = max(1, count // 50)
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    per_day = max(1, users // 2)
+    requests = []
+    for request_id in range(1, count + 1):
+        day = today - timedelta(days=(count - request_id) // per_day)
+        start = rng.randrange(8 * 60, 20 * 60)
+        end = start + rng.choice((15, 30, 45, 60))
+        created = day + timedelta(minutes=start - rng.randrange(5, 120))
+        request = {
+            'id': request_id,
+            'user_id': str(100000000000000000 + rng.randrange(users)),
+            'username': f'Сотрудник {request_id % users}',
+            'date': day.strftime('%d.%m.%Y'),
+            'time': f'{start // 60:02d}:{start % 60:02d} - {end // 60:02d}:{end % 60:02d}',
+            'duration': f'{end - start} мин',
+            'static': f'{rng.randrange(1000):03d}-{rng.randrange(1000):03d}',
+            'department': 'ГИБДД',
+            'reason': 'Гражданские дела',
+            'status': 'pending' if day == today else rng.choice(STATUSES),
+            'created_at': created.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        if request['status'] in ('approved', 'rejected'):
+            request['moderator_id'] = str(200000000000000000 + rng.randrange(20))
+            request['moderator_name'] = 'Модератор'
+            request['processed_at'] = (created + timedelta(minutes=10)).strftime('%Y-%m-%d %H:%M:%S')
+        requests.append(request)
+    return requests
+
+
+def create_backend(kind, directory, requests):
+    """Хранилище заданного типа, заполненное историей"""
+    path = os.path.join(directory, 'otgul_requests.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(requests, f, ensure_ascii=False)
+    if kind == 'sqlite':
+        backend = bot.SqliteBackend(os.path.join(directory, 'otgul_requests.db'))
+        backend.save_all(bot.JsonBackend(path).load())
+        return backend
+    return bot.JsonBackend(path, os.path.join(directory, 'otgul_requests.journal') if kind == 'journal' else None)
+
+
+def summarize(timings):
+    """Время одной операции в микросекундах: среднее, медиана и p99"""
+    timings = sorted(timings)
+    return {
+        'ops': len(timings),
+        'mean_us': statistics.fmean(timings) * 1e6,
+        'p50_us': timings[len(timings) // 2] * 1e6,
+        'p99_us': timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1e6,
+    }
+
+
+async def timed(operation, repeat):
+    timings = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        result = operation(i)
+        if asyncio.iscoroutine(result):
+            await result
+        timings.append(time.perf_counter() - started)
+    return summarize(timings)
+
+
+def write_ops_for(kind, size, ops):
+    """Число записей на замер: для полной перезаписи — ops на каждую 1000 заявок истории"""
+    if kind not in FULL_REWRITE:
+        return ops
+    return min(ops, max(MIN_REWRITE_OPS, ops * 1000 // max(1, size)))
+
+
+async def run_case(kind, requests, ops, seed=0):
+    """Замеры одного хранилища на одной истории"""
+    rng = random.Random(seed)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        backend = create_backend(kind, directory, requests)
+        store = bot.RequestStore(
+            backend,
+            bot.RequestArchive(os.path.join(directory, 'archive')),
+            bot.StatsCounters(os.path.join(directory, 'otgul_stats.json'))
+        )
+        # Обработчики обращаются к модульным store и store_writer бота
+        bot.store = store
+        bot.store_writer = bot.StoreWriter(store, max_delay=0)
+
+        def restore(_):
+            store.load()
+            return [bot.request_deadline(request) for request in store.pending()]
+
+        results['pending_restore'] = await timed(restore, 3)
+        # Файла счетчиков нет, поэтому при запуске они пересчитываются по истории
+        results['stats_rebuild'] = await timed(lambda _: store.rebuild_stats(), 1)
+        bot.store_writer.start()
+        try:
+            user_ids = sorted({r['user_id'] for r in requests})
+            today = datetime.now().strftime('%d.%m.%Y')
+            results['get_request_by_id'] = await timed(
+                lambda _: bot.get_request_by_id(rng.randrange(1, len(requests) + 1)), ops
+            )
+            results['has_today_request'] = await timed(lambda _: bot.has_today_request(rng.choice(user_ids)), ops)
+            added = []
+
+            async def add(i):
+                added.append(await bot.add_request(
+                    rng.choice(user_ids), f'Сотрудник {i}', today, time='18:00 - 18:30', duration='30 мин',
+                    static='123-456', reason='Гражданские дела'
+                ))
+
+            write_ops = write_ops_for(kind, len(requests), ops)
+            results['add_request'] = await timed(add, write_ops)
+            results['update_request_status'] = await timed(
+                lambda i: bot.update_request_status(added[i]['id'], 'approved', '1', 'Модератор'), write_ops
+            )
+
+            async def listing(_):
+                user_id = rng.choice(user_ids)
+                view = bot.HistoryView(int(user_id), await store.history_index(user_id))
+                await view.render()
+
+            results['my_otguls'] = await timed(listing, ops)
+
+            async def save_stats(_):
+                store.stats.dirty = True
+                await store.stats.flush()
+
+            results['stats_flush'] = await timed(save_stats, 3)
+        finally:
+            await bot.store_writer.stop()
+            backend.close()
+    return results
+
+
+async def run(sizes, backends, ops, seed):
+    report = {
+        'meta': {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'ops': ops,
+        },
+        'results': {},
+    }
+    for size in sizes:
+        requests = generate_requests(size, seed)
+        for kind in backends:
+            print(f'⏱️ {kind}, {size} заявок...', file=sys.stderr)
+            for operation, summary in (await run_case(kind, requests, ops, seed)).items():
+                report['results'][f'{kind}/{size}/{operation}'] = summary
+    return report
+
+
+def compare(current, baseline, threshold, min_delta_us):
+    """Сравнивает медианы; регрессия — замедление больше threshold и больше min_delta_us микросекунд"""
+    regressions = []
+    for name, summary in sorted(current['results'].items()):
+        previous = baseline['results'].get(name)
+        if previous is None or not previous['p50_us']:
+            continue
+        ratio = summary['p50_us'] / previous['p50_us']
+        regressed = ratio > 1 + threshold and summary['p50_us'] - previous['p50_us'] > min_delta_us
+        mark = '❌' if regressed else '✅'
+        print(f'{mark} {name}: {previous["p50_us"]:.1f} -> {summary["p50_us"]:.1f} мкс ({ratio:.2f}x)', file=sys.stderr)
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарки хранилища заявок на отгул')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000], help='Размеры истории')
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=list(BACKENDS), help='Хранилища')
+    parser.add_argument('--ops', type=int, default=200, help='Операций на замер')
+    parser.add_argument('--seed', type=int, default=0, help='Зерно генератора истории')
+    parser.add_argument('--output', help='Файл результатов (по умолчанию stdout)')
+    parser.add_argument('--compare', metavar='BASELINE', help='Сравнить с результатами прошлого запуска')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Допустимое замедление, доля (0.2 = 20%%)')
+    parser.add_argument('--min-delta-us', type=float, default=5.0, help='Замедления меньше стольких микросекунд не считаются')
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args.sizes, args.backends, args.ops, args.seed))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold, args.min_delta_us)
+        if regressions:
+            print(f'❌ Регрессии: {len(regressions)}', file=sys.stderr)
+            sys.exit(1)
+        print('✅ Регрессий нет', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
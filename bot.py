@@ -1,259 +1,2969 @@
+import time
+
+# Отсчет для --profile-startup начинается до импорта discord.py
+IMPORT_STARTED = time.perf_counter()
+
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord import app_commands
+import argparse
+import asyncio
+import bisect
+import contextlib
+import csv
+import enum
+import functools
+import hashlib
+import heapq
+import io
 import os
 import sys
 from datetime import datetime, timedelta
 import json
+import math
 import re
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
 from typing import Optional
 from dotenv import load_dotenv
 
-# Загружаем переменные окружения из .env файла
-load_dotenv()
+IMPORTS_DONE = time.perf_counter()
+
+# Загружаем переменные окружения из .env файла
+load_dotenv()
+
+# Цикл событий: auto — winloop на Windows и uvloop на Linux, если они установлены; asyncio — стандартный
+OTGUL_EVENT_LOOP = os.getenv('OTGUL_EVENT_LOOP', 'auto').lower()
+
+def install_event_loop(choice=OTGUL_EVENT_LOOP):
+    """Устанавливает политику цикла событий; возвращает имя выбранного цикла"""
+    if choice == 'asyncio':
+        return 'asyncio'
+    if sys.platform == 'win32':
+        try:
+            import winloop
+            winloop.install()
+            return 'winloop'
+        except ImportError:
+            asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+            return 'asyncio'
+    try:
+        import uvloop
+    except ImportError:
+        # uvloop необязателен: без него работает стандартный цикл
+        return 'asyncio'
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return 'uvloop'
+
+EVENT_LOOP = install_event_loop()
+
+# Настройка intents
+intents = discord.Intents.default()
+try:
+    intents.message_content = True
+except AttributeError:
+    pass
+try:
+    intents.members = True
+except AttributeError:
+    pass
+
+# Режим с шардами (AutoShardedBot): число шардов задается OTGUL_SHARD_COUNT или выбирается Discord
+OTGUL_SHARDED = os.getenv('OTGUL_SHARDED', '0').lower() in ('1', 'true', 'yes')
+OTGUL_SHARD_COUNT = int(os.getenv('OTGUL_SHARD_COUNT', '0')) or None
+
+class OtgulBot(commands.AutoShardedBot if OTGUL_SHARDED else commands.Bot):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Синхронизировать команды, даже если их описание не менялось (--force-sync)
+        self.force_sync = False
+        # on_ready вызывается при каждом переподключении, а запуск нужен один раз
+        self.startup_done = False
+        # --profile-startup: вывести время этапов запуска и остановиться
+        self.profile_startup = False
+        self.stats_missing = False
+        self.connect_started = None
+        self.submit_view = None
+        self._background = set()
+
+    def spawn(self, coro):
+        """Фоновая задача запуска; ссылка хранится, пока задача не завершится"""
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    async def setup_hook(self):
+        # Небольшие файлы счетчиков и очереди уведомлений читаются до подключения
+        self.stats_missing = not await asyncio.to_thread(store.stats.load)
+        await asyncio.to_thread(notifier.load)
+        # Один обработчик кнопок approve_/reject_/delete_<id> для всех заявок
+        self.add_dynamic_items(OtgulActionButton)
+        # Кнопка на панели /инфо_отгулы, включая панели, опубликованные до перезапуска
+        self.submit_view = SubmitView()
+        self.add_view(self.submit_view)
+        await metrics_server.start()
+        # Заявки читаются параллельно с подключением к шлюзу; обработчики ждут store.wait_loaded()
+        self.spawn(self.load_store(store.begin_load()))
+        self.connect_started = time.perf_counter()
+
+    async def load_store(self, loading):
+        try:
+            with startup_profile.phase('store_load'), metrics.timer('otgul_storage_load_seconds'):
+                await loading
+        except Exception as e:
+            log_error('storage_load', f'❌ Ошибка загрузки заявок: {e}', e)
+            await self.close()
+            return
+        store_writer.start()
+        notifier.start()
+
+    async def close(self):
+        expiry_scheduler.stop()
+        await notifier.stop()
+        await store_writer.stop()
+        await store.stats.flush()
+        await metrics_server.stop()
+        await super().close()
+
+# Создание бота
+bot = OtgulBot(command_prefix='!', intents=intents, **({'shard_count': OTGUL_SHARD_COUNT} if OTGUL_SHARDED else {}))
+
+# Файл для хранения запросов отгула
+OTGUL_FILE = 'otgul_requests.json'
+
+# Хранилище заявок: json (по умолчанию) или sqlite
+OTGUL_STORAGE = os.getenv('OTGUL_STORAGE', 'json').lower()
+OTGUL_DB_FILE = os.getenv('OTGUL_DB_FILE', 'otgul_requests.db')
+
+# Режим журнала: изменения дописываются в лог, снимок пересобирается в фоне
+OTGUL_JOURNAL = os.getenv('OTGUL_JOURNAL', '0').lower() in ('1', 'true', 'yes')
+OTGUL_JOURNAL_FILE = os.getenv('OTGUL_JOURNAL_FILE', os.path.splitext(OTGUL_FILE)[0] + '.journal')
+OTGUL_COMPACT_INTERVAL = int(os.getenv('OTGUL_COMPACT_INTERVAL', '300'))
+
+# Заявки каждого сервера в своем файле каталога OTGUL_PARTITION_DIR (по умолчанию включено вместе с шардами)
+OTGUL_PARTITIONED = os.getenv('OTGUL_PARTITIONED', '1' if OTGUL_SHARDED else '0').lower() in ('1', 'true', 'yes')
+OTGUL_PARTITION_DIR = os.getenv('OTGUL_PARTITION_DIR', 'otgul_guilds')
+
+# Архив рассмотренных заявок по месяцам; в горячем хранилище остаются ожидающие и сегодняшние
+OTGUL_ARCHIVE_DIR = os.getenv('OTGUL_ARCHIVE_DIR', 'otgul_archive')
+OTGUL_ARCHIVE_INTERVAL = int(os.getenv('OTGUL_ARCHIVE_INTERVAL', '3600'))
+
+# Сколько сотрудников одного подразделения могут отсутствовать одновременно (0 — без ограничения)
+OTGUL_MAX_CONCURRENT = int(os.getenv('OTGUL_MAX_CONCURRENT', '0'))
+
+# Счетчики для /статистика_отгулов; сохраняются раз в минуту и при остановке бота
+OTGUL_STATS_FILE = os.getenv('OTGUL_STATS_FILE', 'otgul_stats.json')
+
+# Фоновая запись: максимальная задержка сброса пачки изменений и ожидание записи на диск
+OTGUL_FLUSH_DELAY = float(os.getenv('OTGUL_FLUSH_DELAY', '0.2'))
+OTGUL_DURABLE_ACK = os.getenv('OTGUL_DURABLE_ACK', '1').lower() in ('1', 'true', 'yes')
+
+
+# Метрики в формате Prometheus на локальном адресе (0 — не запускать) и формат лога: text или json
+OTGUL_METRICS_HOST = os.getenv('OTGUL_METRICS_HOST', '127.0.0.1')
+OTGUL_METRICS_PORT = int(os.getenv('OTGUL_METRICS_PORT', '0'))
+OTGUL_LOG_FORMAT = os.getenv('OTGUL_LOG_FORMAT', 'text').lower()
+
+
+def _format_metric_value(value):
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in labels) + '}'
+
+
+class Metrics:
+    """Счетчики, гистограммы и измеряемые при опросе значения в текстовом формате Prometheus
+
+    Счетчики и гистограммы можно обновлять и из рабочих потоков (asyncio.to_thread),
+    значения gauge() вычисляются в цикле событий в момент опроса.
+    """
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {}
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    def describe(self, name, kind, help_text):
+        self._types[name] = kind
+        self._help[name] = help_text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # Счетчики по корзинам, затем сумма и общее число наблюдений
+                histogram = self._histograms[key] = [0] * len(self.BUCKETS) + [0.0, 0]
+            position = bisect.bisect_left(self.BUCKETS, value)
+            if position < len(self.BUCKETS):
+                histogram[position] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def gauge(self, name, help_text, func, kind='gauge'):
+        """Значение, вычисляемое при опросе: число или словарь {(метки): число}"""
+        self.describe(name, kind, help_text)
+        self._gauges[name] = func
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus 0.0.4"""
+        samples = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                samples.setdefault(name, []).append((name, labels, value))
+            for (name, labels), histogram in self._histograms.items():
+                lines = samples.setdefault(name, [])
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS, histogram):
+                    cumulative += count
+                    lines.append((f'{name}_bucket', labels + (('le', bound),), cumulative))
+                lines.append((f'{name}_bucket', labels + (('le', '+Inf'),), histogram[-1]))
+                lines.append((f'{name}_sum', labels, histogram[-2]))
+                lines.append((f'{name}_count', labels, histogram[-1]))
+        for name, func in self._gauges.items():
+            try:
+                value = func()
+            except Exception as e:
+                log_error('metrics', f'❌ Ошибка вычисления метрики {name}: {e}', e)
+                continue
+            if isinstance(value, dict):
+                samples[name] = [(name, tuple(sorted(labels)), v) for labels, v in value.items()]
+            else:
+                samples[name] = [(name, (), value)]
+        output = []
+        for name in sorted(samples):
+            if name in self._help:
+                output.append(f'# HELP {name} {self._help[name]}')
+                output.append(f'# TYPE {name} {self._types[name]}')
+            for sample, labels, value in samples[name]:
+                output.append(f'{sample}{_format_labels(labels)} {_format_metric_value(value)}')
+        return '\n'.join(output) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('otgul_handler_duration_seconds', 'histogram', 'Время работы обработчиков команд, кнопок и модальных окон')
+metrics.describe('otgul_handler_deferred_total', 'counter', 'Ответы, отложенные из-за срока в 3 секунды')
+metrics.describe('otgul_handler_errors_total', 'counter', 'Исключения в обработчиках взаимодействий')
+metrics.describe('otgul_storage_write_seconds', 'histogram', 'Время записи пачки изменений в хранилище')
+metrics.describe('otgul_storage_write_entries_total', 'counter', 'Записанные в хранилище изменения')
+metrics.describe('otgul_storage_load_seconds', 'histogram', 'Время загрузки заявок из хранилища')
+metrics.describe('otgul_archive_read_seconds', 'histogram', 'Время чтения месяца архива с диска')
+metrics.describe('otgul_errors_total', 'counter', 'Перехваченные и записанные в лог исключения')
+metrics.gauge(
+    'otgul_gateway_latency_seconds', 'Задержка heartbeat шлюза Discord',
+    lambda: bot.latency
+)
+
+
+def log(message, event=None, level='info', **fields):
+    """Пишет сообщение в консоль; при OTGUL_LOG_FORMAT=json — одной JSON-строкой с полями"""
+    if OTGUL_LOG_FORMAT == 'json':
+        record = {'ts': datetime.now().isoformat(timespec='milliseconds'), 'level': level, 'event': event, 'message': message}
+        record.update(fields)
+        print(json.dumps(record, ensure_ascii=False, default=str), flush=True)
+    else:
+        print(message)
+
+
+def log_error(event, message, error=None, **fields):
+    """Перехваченное исключение: запись в лог и счетчик otgul_errors_total"""
+    metrics.inc('otgul_errors_total', event=event)
+    if error is not None:
+        fields['error'] = f'{type(error).__name__}: {error}'
+    log(message, event, 'error', **fields)
+
+
+class MetricsServer:
+    """Локальный HTTP-адрес /metrics для Prometheus на aiohttp (зависимость discord.py)"""
+
+    def __init__(self, host=OTGUL_METRICS_HOST, port=OTGUL_METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def _handle(self, request):
+        from aiohttp import web
+        return web.Response(
+            body=metrics.render().encode('utf-8'),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+        )
+
+    async def start(self):
+        if not self.port or self._runner is not None:
+            return
+        # aiohttp.web импортируется, только если метрики включены: это заметная часть времени импорта
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        log(f'📈 Метрики доступны на http://{self.host}:{self.port}/metrics', 'metrics_started')
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics_server = MetricsServer()
+
+
+class StartupProfile:
+    """Время этапов запуска: импорты, загрузка заявок, подключение, восстановление, синхронизация команд
+
+    Этапы считаются по часам: загрузка заявок идет параллельно с подключением
+    к шлюзу, поэтому их сумма может быть больше общего времени.
+    """
+
+    def __init__(self, started):
+        self.started = started
+        self.phases = {}
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def mark(self, name):
+        """Время от начала запуска до этой точки"""
+        self.phases[name] = time.perf_counter() - self.started
+
+    def report(self):
+        width = max(map(len, self.phases), default=0)
+        return '\n'.join(f'   {name:<{width}}  {seconds * 1000:9.1f} мс' for name, seconds in self.phases.items())
+
+
+startup_profile = StartupProfile(IMPORT_STARTED)
+startup_profile.add('imports', IMPORTS_DONE - IMPORT_STARTED)
+metrics.gauge(
+    'otgul_startup_seconds', 'Время этапов последнего запуска',
+    lambda: {(('phase', name),): seconds for name, seconds in startup_profile.phases.items()}
+)
+
+
+def write_text_atomic(path, text):
+    """Атомарно записывает готовый текст: временный файл, fsync и переименование"""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def write_json_atomic(path, data, indent=2):
+    """Атомарно записывает JSON: временный файл, fsync и переименование"""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class Status(str, enum.Enum):
+    """Статус заявки"""
+
+    PENDING = 'pending'
+    APPROVED = 'approved'
+    REJECTED = 'rejected'
+    DELETED = 'deleted'
+    EXPIRED = 'expired'
+
+
+class Department(str, enum.Enum):
+    """Подразделение заявителя"""
+
+    GIBDD = 'ГИБДД'
+
+
+def department_of(value):
+    """Подразделение как член Department или, для неизвестных, интернированная строка"""
+    if isinstance(value, Department):
+        return value
+    value = value or Department.GIBDD.value
+    try:
+        return Department(value)
+    except ValueError:
+        return sys.intern(value)
+
+
+def date_ordinal(value):
+    """Порядковый номер дня из 'ДД.ММ.ГГГГ'; числа и нераспознанные строки возвращаются как есть"""
+    if not isinstance(value, str):
+        return value
+    try:
+        return datetime.strptime(value, '%d.%m.%Y').toordinal()
+    except ValueError:
+        return value
+
+
+def _parse_timestamp(value):
+    if not isinstance(value, str):
+        return value
+    try:
+        return int(datetime.strptime(value, '%Y-%m-%d %H:%M:%S').timestamp())
+    except ValueError:
+        return value
+
+
+def _parse_snowflake(value):
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    return value
+
+
+def _format_enum(value):
+    return value.value if isinstance(value, enum.Enum) else value
+
+
+def _format_date(value):
+    return datetime.fromordinal(value).strftime('%d.%m.%Y') if isinstance(value, int) else value
+
+
+def _format_timestamp(value):
+    return datetime.fromtimestamp(value).strftime('%Y-%m-%d %H:%M:%S') if isinstance(value, int) else value
+
+
+# Преобразование полей заявки из устаревшего формата (строки) во внутренний и обратно
+_FIELD_PARSERS = {
+    'user_id': _parse_snowflake,
+    'moderator_id': _parse_snowflake,
+    'channel_id': _parse_snowflake,
+    'message_id': _parse_snowflake,
+    'guild_id': _parse_snowflake,
+    'date': date_ordinal,
+    'created_at': _parse_timestamp,
+    'processed_at': _parse_timestamp,
+    'status': Status,
+    'department': department_of,
+    'notification_status': sys.intern,
+}
+
+_FIELD_FORMATTERS = {
+    'user_id': str,
+    'moderator_id': str,
+    'channel_id': str,
+    'message_id': str,
+    'guild_id': str,
+    'date': _format_date,
+    'created_at': _format_timestamp,
+    'processed_at': _format_timestamp,
+    'status': _format_enum,
+    'department': _format_enum,
+}
+
+
+_MISSING = object()
+
+
+class OtgulRequest:
+    """Заявка на отгул
+
+    Даты хранятся порядковыми номерами дней, время — секундами эпохи, ID —
+    целыми числами, статус и подразделение — членами перечислений. Доступ
+    по ключу (request['date'], request.get('moderator_name')) возвращает
+    значения в прежнем строковом виде.
+    """
+
+    __slots__ = (
+        'id', 'user_id', 'username', 'date', 'time', 'duration', 'static', 'department', 'reason',
+        'status', 'created_at', 'moderator_id', 'moderator_name', 'rejection_reason', 'processed_at',
+        'notification_status', 'channel_id', 'message_id', 'extra', 'guild_id'
+    )
+
+    # Новые поля добавляются в конец: старые строки версии 2 короче и читаются без них
+    FIELDS = tuple(name for name in __slots__ if name != 'extra')
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        self.update(fields)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Заявка из словаря в устаревшем формате (или из словаря со значениями во внутреннем виде)"""
+        if isinstance(data, cls):
+            return data
+        return cls(**data)
+
+    def update(self, changes):
+        for name, value in changes.items():
+            if name in self.FIELDS:
+                parser = _FIELD_PARSERS.get(name)
+                setattr(self, name, parser(value) if parser is not None and value is not None else value)
+            elif value is None:
+                if self.extra:
+                    self.extra.pop(name, None)
+            else:
+                # Неизвестные поля сохраняются как есть, чтобы не терять данные
+                if self.extra is None:
+                    self.extra = {}
+                self.extra[name] = value
+
+    def get(self, key, default=None):
+        if key in self.FIELDS:
+            value = getattr(self, key)
+            if value is None:
+                return default
+            formatter = _FIELD_FORMATTERS.get(key)
+            return formatter(value) if formatter is not None else value
+        if self.extra:
+            return self.extra.get(key, default)
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.update({key: value})
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __eq__(self, other):
+        if not isinstance(other, OtgulRequest):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    __hash__ = None
+
+    def copy(self):
+        clone = OtgulRequest.__new__(OtgulRequest)
+        for name in self.__slots__:
+            setattr(clone, name, getattr(self, name))
+        if self.extra:
+            clone.extra = dict(self.extra)
+        return clone
+
+    def to_dict(self):
+        """Словарь в устаревшем формате: только заданные поля, строковые даты и ID"""
+        data = {name: self.get(name) for name in self.FIELDS if getattr(self, name) is not None}
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def __repr__(self):
+        return f'<OtgulRequest id={self.id} user_id={self.user_id} status={_format_enum(self.status)}>'
+
+
+class RequestSerializer:
+    """Чтение и запись заявок в файлах и журнале
+
+    Версия 1 — прежний формат: список словарей со строковыми датами. Версия 2 —
+    компактный: {"version": 2, "fields": [...], "rows": [[...], ...]}, где
+    значения строк идут в порядке fields во внутреннем (числовом) виде.
+    Читаются обе версии, пишется версия 2.
+    """
+
+    VERSION = 2
+
+    @staticmethod
+    def row(request):
+        return [_format_enum(getattr(request, name)) for name in OtgulRequest.__slots__]
+
+    # В строках версии 2 значения уже во внутреннем виде: разбирать нужно только перечисления
+    _ROW_PARSERS = {
+        'status': Status,
+        'department': department_of,
+        'notification_status': sys.intern,
+    }
+
+    @classmethod
+    @functools.lru_cache(maxsize=16)
+    def _row_plan(cls, fields):
+        """Разбор строки для данного порядка полей: что присваивать по позиции, что разбирать"""
+        plain, parsed, unknown = [], [], []
+        for index, name in enumerate(fields):
+            if name == 'extra':
+                continue
+            if name not in OtgulRequest.FIELDS:
+                unknown.append((index, name))
+            elif name in cls._ROW_PARSERS:
+                parsed.append((index, name, cls._ROW_PARSERS[name]))
+            else:
+                plain.append((index, name))
+        missing = [name for name in OtgulRequest.__slots__ if name not in fields]
+        extra = fields.index('extra') if 'extra' in fields else None
+        return len(fields), plain, parsed, unknown, missing, extra
+
+    @classmethod
+    def from_row(cls, row, fields=OtgulRequest.__slots__):
+        size, plain, parsed, unknown, missing, extra = cls._row_plan(tuple(fields))
+        if len(row) < size:
+            row = list(row) + [None] * (size - len(row))
+        request = OtgulRequest.__new__(OtgulRequest)
+        for name in missing:
+            setattr(request, name, None)
+        for index, name in plain:
+            setattr(request, name, row[index])
+        for index, name, parser in parsed:
+            value = row[index]
+            setattr(request, name, parser(value) if value is not None else None)
+        request.extra = None
+        if unknown:
+            request.update({name: row[index] for index, name in unknown})
+        if extra is not None and row[extra]:
+            request.update(row[extra])
+        return request
+
+    @classmethod
+    def dump(cls, requests):
+        return {
+            'version': cls.VERSION,
+            'fields': list(OtgulRequest.__slots__),
+            'rows': [cls.row(request) for request in requests],
+        }
+
+    @classmethod
+    def load(cls, data):
+        if isinstance(data, list):
+            return [OtgulRequest.from_dict(item) for item in data]
+        if data.get('version') != cls.VERSION:
+            raise ValueError(f'Неизвестная версия файла заявок: {data.get("version")}')
+        fields = tuple(data['fields'])
+        return [cls.from_row(row, fields) for row in data['rows']]
+
+    @staticmethod
+    def record(data):
+        """Заявка из строки версии 2 или из словаря прежнего формата"""
+        if isinstance(data, list):
+            return RequestSerializer.from_row(data)
+        return OtgulRequest.from_dict(data)
+
+    @classmethod
+    def read(cls, path, default=()):
+        if not os.path.exists(path):
+            return list(default)
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls.load(json.load(f))
+
+    @classmethod
+    def save(cls, path, requests):
+        write_json_atomic(path, cls.dump(requests), None)
+
+    @classmethod
+    def entry(cls, entry):
+        """Запись журнала в компактном виде"""
+        if entry['op'] == 'put':
+            return {'op': 'put', 'row': cls.row(entry['request'])}
+        return entry
+
+    @classmethod
+    def request_of(cls, entry):
+        """Заявка из записи журнала любой версии"""
+        return cls.record(entry['row'] if 'row' in entry else entry['request'])
+
+
+class JsonBackend:
+    """Хранение заявок в JSON-файле, с необязательным журналом изменений"""
+
+    def __init__(self, path, journal_path=None):
+        self.path = path
+        self.journal_path = journal_path
+        self.compactable = bool(journal_path)
+        self.needs_snapshot = not journal_path
+        self._journal = None
+
+    def load(self):
+        """Читает снимок и применяет к нему хвост журнала"""
+        requests = RequestSerializer.read(self.path)
+        if self.journal_path and os.path.exists(self.journal_path):
+            by_id = {r.id: r for r in requests}
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Недописанная строка после сбоя — дальше журнал не читаем
+                        break
+                    if entry['op'] == 'put':
+                        request = RequestSerializer.request_of(entry)
+                        by_id[request.id] = request
+                    elif entry['op'] == 'delete':
+                        by_id.pop(entry['id'], None)
+            requests = list(by_id.values())
+        return requests
+
+    def save_all(self, requests):
+        """Сохраняет все заявки в файл"""
+        RequestSerializer.save(self.path, requests)
+        if self.journal_path:
+            self._truncate_journal(0)
+
+    def write(self, entries, snapshot=None):
+        """Сохраняет пачку изменений: строками в журнал с одним fsync или полной перезаписью файла"""
+        if not self.journal_path:
+            RequestSerializer.save(self.path, snapshot)
+            return
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._journal.write(''.join(
+            json.dumps(RequestSerializer.entry(entry), ensure_ascii=False) + '\n' for entry in entries
+        ))
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def journal_size(self):
+        """Текущий размер журнала в байтах"""
+        if not self.journal_path or not os.path.exists(self.journal_path):
+            return 0
+        return os.path.getsize(self.journal_path)
+
+    def _truncate_journal(self, offset):
+        """Отбрасывает начало журнала до offset, уже попавшее в снимок"""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'rb') as f:
+            f.seek(offset)
+            tail = f.read()
+        tmp_path = f'{self.journal_path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(tail)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+
+    async def compact(self, requests):
+        """Сворачивает журнал в снимок, не блокируя цикл событий записью файла"""
+        offset = self.journal_size()
+        if not offset:
+            return False
+        records = [r.copy() for r in requests]
+        await asyncio.to_thread(RequestSerializer.save, self.path, records)
+        # Записи, добавленные во время записи снимка, остаются в хвосте журнала
+        self._truncate_journal(offset)
+        return True
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+
+class SqliteBackend:
+    """Хранение заявок в SQLite (WAL) только для сохранности
+
+    Заявки целиком читаются при запуске, все выборки идут по индексам
+    RequestStore в памяти, поэтому таблица хранит лишь ID и компактную строку
+    версии 2 без отдельных столбцов и индексов.
+    """
+
+    compactable = False
+    needs_snapshot = False
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            # Соединение используется и из фоновой задачи записи (через asyncio.to_thread)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            # С подтверждением после записи на диск транзакция должна переживать и сбой питания
+            self._db.execute(f"PRAGMA synchronous={'FULL' if OTGUL_DURABLE_ACK else 'NORMAL'}")
+            self._db.executescript(
+                '''
+                CREATE TABLE IF NOT EXISTS requests (
+                    id INTEGER PRIMARY KEY,
+                    data TEXT NOT NULL
+                );
+                '''
+            )
+        return self._db
+
+    @staticmethod
+    def _row(request):
+        return request.id, json.dumps(RequestSerializer.row(request), ensure_ascii=False)
+
+    def load(self):
+        return [
+            RequestSerializer.record(json.loads(data))
+            for (data,) in self.db.execute('SELECT data FROM requests ORDER BY id')
+        ]
+
+    def save_all(self, requests):
+        with self.db:
+            self.db.execute('DELETE FROM requests')
+            self.db.executemany('INSERT INTO requests VALUES (?, ?)', [self._row(r) for r in requests])
+
+    def write(self, entries, snapshot=None):
+        """Сохраняет пачку изменений одной транзакцией"""
+        with self.db:
+            for entry in entries:
+                if entry['op'] == 'put':
+                    self.db.execute('INSERT OR REPLACE INTO requests VALUES (?, ?)', self._row(entry['request']))
+                elif entry['op'] == 'delete':
+                    self.db.execute('DELETE FROM requests WHERE id = ?', (entry['id'],))
+
+    async def compact(self, requests):
+        return False
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class PartitionedBackend:
+    """Хранение заявок по файлам серверов: <каталог>/<guild_id>.json (.db)
+
+    Заявки без guild_id остаются в общем хранилище legacy. Каждая пачка
+    изменений раскладывается по серверам, так что запись заявки одного сервера
+    не трогает файлы других. Наибольший выданный ID хранится в partitions.json:
+    файлы серверов читаются не все сразу, а ID должны оставаться уникальными.
+    """
+
+    def __init__(self, directory, legacy, factory):
+        self.directory = directory
+        self.legacy = legacy
+        self.factory = factory
+        self.compactable = legacy.compactable
+        self.needs_snapshot = legacy.needs_snapshot
+        self._backends = {}
+        self._manifest = None
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.directory, 'partitions.json')
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            self._manifest = {'max_id': 0}
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                    self._manifest = json.load(f)
+        return self._manifest
+
+    def max_id(self):
+        return self.manifest['max_id']
+
+    def guilds(self):
+        """ID серверов, у которых есть свой файл"""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted({
+            int(name.split('.', 1)[0]) for name in os.listdir(self.directory)
+            if name.split('.', 1)[0].isdigit()
+        })
+
+    def backend(self, guild_id):
+        """Хранилище сервера; None — общее"""
+        if guild_id is None:
+            return self.legacy
+        backend = self._backends.get(guild_id)
+        if backend is None:
+            os.makedirs(self.directory, exist_ok=True)
+            backend = self._backends[guild_id] = self.factory(os.path.join(self.directory, str(guild_id)))
+        return backend
+
+    def load(self):
+        return self.legacy.load()
+
+    @staticmethod
+    def _load(backend):
+        # У сервера без заявок файла нет, и пустой файл при чтении не создается
+        paths = (backend.path, getattr(backend, 'journal_path', None))
+        if not any(path and os.path.exists(path) for path in paths):
+            return []
+        return backend.load()
+
+    def load_partition(self, guild_id):
+        """Заявки одного сервера; дальше его изменения пишутся через это же хранилище"""
+        return self._load(self.backend(guild_id))
+
+    def read_partition(self, guild_id):
+        """Заявки сервера для разового прохода, без открытия его хранилища для записи"""
+        backend = self.factory(os.path.join(self.directory, str(guild_id)))
+        try:
+            return self._load(backend)
+        finally:
+            backend.close()
+
+    @staticmethod
+    def _group(requests):
+        groups = {}
+        for request in requests:
+            groups.setdefault(request.guild_id, []).append(request)
+        return groups
+
+    def save_all(self, requests):
+        groups = self._group(requests)
+        for guild_id in set(groups) | set(self.guilds()) | {None}:
+            self.backend(guild_id).save_all(groups.get(guild_id, []))
+        self._save_max_id(requests)
+
+    def write(self, entries, snapshot=None):
+        """Раскладывает пачку изменений по серверам и пишет только затронутые файлы"""
+        groups = {}
+        for entry in entries:
+            guild_id = entry['request'].guild_id if entry['op'] == 'put' else entry.get('guild_id')
+            groups.setdefault(guild_id, []).append(entry)
+        snapshots = self._group(snapshot) if snapshot is not None else {}
+        for guild_id, guild_entries in groups.items():
+            self.backend(guild_id).write(guild_entries, snapshots.get(guild_id, []) if snapshot is not None else None)
+        self._save_max_id(entry['request'] for entry in entries if entry['op'] == 'put')
+
+    def _save_max_id(self, requests):
+        max_id = max((r.id for r in requests), default=0)
+        if max_id > self.manifest['max_id']:
+            self.manifest['max_id'] = max_id
+            os.makedirs(self.directory, exist_ok=True)
+            write_json_atomic(self.manifest_path, self.manifest)
+
+    async def compact(self, requests):
+        """Сворачивает журналы загруженных серверов, каждый своим снимком"""
+        groups = self._group(requests)
+        compacted = False
+        for guild_id in {None} | set(self._backends):
+            compacted = await self.backend(guild_id).compact(groups.get(guild_id, [])) or compacted
+        return compacted
+
+    def close(self):
+        self.legacy.close()
+        for backend in self._backends.values():
+            backend.close()
+
+
+def migrate_json_to_sqlite(json_path=OTGUL_FILE, db_path=OTGUL_DB_FILE, journal_path=None):
+    """Однократно переносит заявки из JSON-файла (и журнала) в SQLite"""
+    requests = JsonBackend(json_path, journal_path).load()
+    backend = SqliteBackend(db_path)
+    backend.save_all(requests)
+    backend.close()
+    return len(requests)
+
+
+# Формат интервала отгула: ЧЧ:ММ - ЧЧ:ММ
+TIME_RANGE_RE = re.compile(r'(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})')
+
+# Минут в сутках: интервалы отгулов не переходят через полночь
+MINUTES_PER_DAY = 24 * 60
+
+
+class TimeWindow:
+    """Интервал отгула в минутах от начала суток [start, end)"""
+
+    __slots__ = ('start', 'end')
+
+    MAX_DURATION = 60
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+    @classmethod
+    def parse(cls, text):
+        """Разбирает 'ЧЧ:ММ - ЧЧ:ММ'; при ошибке бросает ValueError с текстом для пользователя"""
+        match = TIME_RANGE_RE.match(text or '')
+        if not match:
+            raise ValueError('Неверный формат времени. Используйте: ЧЧ:ММ - ЧЧ:ММ')
+        start_h, start_m, end_h, end_m = map(int, match.groups())
+        if start_h > 23 or end_h > 23 or start_m > 59 or end_m > 59:
+            raise ValueError('Неверный формат времени. Используйте: ЧЧ:ММ - ЧЧ:ММ')
+        window = cls(start_h * 60 + start_m, end_h * 60 + end_m)
+        if window.end <= window.start:
+            raise ValueError('Время окончания должно быть позже времени начала')
+        return window
+
+    def check_duration(self):
+        if self.duration > self.MAX_DURATION:
+            raise ValueError('Максимальная длительность отгула: 1 час')
+        return self
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def duration_text(self):
+        hours, minutes = divmod(self.duration, 60)
+        return f"{hours} ч" if hours > 0 else f"{minutes} мин"
+
+    def starts_after(self, moment):
+        """Начинается ли интервал позже moment (того же дня)"""
+        return self.start > moment.hour * 60 + moment.minute
+
+    def __str__(self):
+        return f'{self.start // 60:02d}:{self.start % 60:02d} - {self.end // 60:02d}:{self.end % 60:02d}'
+
+    def __repr__(self):
+        return f'TimeWindow({self})'
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_time_window(text):
+    """TimeWindow из поля time заявки или None; результаты разбора кэшируются"""
+    try:
+        return TimeWindow.parse(text)
+    except ValueError:
+        return None
+
+
+class _MinuteTree:
+    """Дерево отрезков по минутам суток: прибавление на отрезке и максимум на отрезке за O(log n)"""
+
+    __slots__ = ('size', '_max', '_add')
+
+    def __init__(self, size=MINUTES_PER_DAY):
+        self.size = size
+        self._max = [0] * (4 * size)
+        self._add = [0] * (4 * size)
+
+    def add(self, start, end, value, node=1, low=0, high=None):
+        if high is None:
+            high = self.size
+        if end <= low or high <= start:
+            return
+        if start <= low and high <= end:
+            self._max[node] += value
+            self._add[node] += value
+            return
+        middle = (low + high) // 2
+        self.add(start, end, value, node * 2, low, middle)
+        self.add(start, end, value, node * 2 + 1, middle, high)
+        self._max[node] = self._add[node] + max(self._max[node * 2], self._max[node * 2 + 1])
+
+    def max(self, start, end, node=1, low=0, high=None):
+        if high is None:
+            high = self.size
+        if end <= low or high <= start:
+            return 0
+        if start <= low and high <= end:
+            return self._max[node]
+        middle = (low + high) // 2
+        return self._add[node] + max(
+            self.max(start, end, node * 2, low, middle),
+            self.max(start, end, node * 2 + 1, middle, high)
+        )
+
+
+class AbsenceIndex:
+    """Интервалы отгулов по (дата, подразделение) для проверки пересечений
+
+    Учитываются ожидающие и одобренные заявки. Для каждого дня и подразделения
+    хранится список интервалов, отсортированный по началу (кто отсутствует в
+    заданное время). Дерево отрезков (максимум одновременных отгулов) строится
+    при первом запросе max_concurrent и только для текущих и будущих дней.
+    """
+
+    ACTIVE_STATUSES = (Status.PENDING, Status.APPROVED)
+
+    def __init__(self):
+        self._days = {}
+        self._trees = {}
+
+    @staticmethod
+    def _key(date, department):
+        return date_ordinal(date), _format_enum(department) or Department.GIBDD.value
+
+    def add(self, request):
+        window = parse_time_window(request.time)
+        if window is None or request.status not in self.ACTIVE_STATUSES:
+            return
+        key = self._key(request.date, request.department)
+        day = self._days.get(key)
+        if day is None:
+            day = self._days[key] = {'intervals': [], 'longest': 0}
+        tree = self._trees.get(key)
+        if tree is not None:
+            tree.add(window.start, window.end, 1)
+        bisect.insort(day['intervals'], (window.start, window.end, request.id))
+        day['longest'] = max(day['longest'], window.duration)
+
+    def remove(self, request):
+        window = parse_time_window(request.time)
+        if window is None or request.status not in self.ACTIVE_STATUSES:
+            return
+        key = self._key(request.date, request.department)
+        day = self._days.get(key)
+        if day is None:
+            return
+        item = (window.start, window.end, request.id)
+        position = bisect.bisect_left(day['intervals'], item)
+        if position < len(day['intervals']) and day['intervals'][position] == item:
+            del day['intervals'][position]
+            tree = self._trees.get(key)
+            if tree is not None:
+                tree.add(window.start, window.end, -1)
+        if not day['intervals']:
+            del self._days[key]
+            self._trees.pop(key, None)
+
+    def _tree(self, key):
+        """Дерево отрезков дня; при построении нового деревья прошедших дней удаляются"""
+        tree = self._trees.get(key)
+        if tree is None:
+            today = datetime.now().toordinal()
+            for old in [old for old in self._trees if isinstance(old[0], int) and old[0] < today]:
+                del self._trees[old]
+            tree = _MinuteTree()
+            for start, end, _ in self._days[key]['intervals']:
+                tree.add(start, end, 1)
+            self._trees[key] = tree
+        return tree
+
+    def max_concurrent(self, date, department, window):
+        """Наибольшее число одновременных отгулов внутри интервала"""
+        key = self._key(date, department)
+        if key not in self._days:
+            return 0
+        return self._tree(key).max(window.start, window.end)
+
+    def overlapping(self, date, department, window):
+        """ID заявок, интервалы которых пересекаются с window"""
+        day = self._days.get(self._key(date, department))
+        if day is None:
+            return []
+        intervals = day['intervals']
+        # Интервал не длиннее longest, поэтому раньше window.start - longest пересечений нет
+        position = bisect.bisect_left(intervals, (window.start - day['longest'],))
+        result = []
+        while position < len(intervals) and intervals[position][0] < window.end:
+            start, end, request_id = intervals[position]
+            if end > window.start:
+                result.append(request_id)
+            position += 1
+        return result
+
+
+class StatsCounters:
+    """Счетчики заявок по пользователям, модераторам и подразделениям, отдельно для каждого сервера
+
+    Обновляются при каждом добавлении, смене статуса и удалении заявки, поэтому
+    отчет не требует перечитывать историю. Пересчитать с нуля можно через rebuild().
+    Заявки без guild_id считаются в разделе '' и, как и в хранилище, видны на
+    всех серверах.
+    """
+
+    VERSION = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.dirty = False
+        self.data = self._empty()
+        # Изменения из цикла событий и сериализация в потоке записи не пересекаются
+        self._lock = threading.Lock()
+
+    @classmethod
+    def _empty(cls):
+        return {'version': cls.VERSION, 'guilds': {}}
+
+    @staticmethod
+    def _section_key(guild_id):
+        return '' if guild_id is None else str(guild_id)
+
+    def _section(self, guild_id):
+        section = self.data['guilds'].get(self._section_key(guild_id))
+        if section is None:
+            section = self.data['guilds'][self._section_key(guild_id)] = {'users': {}, 'moderators': {}, 'departments': {}}
+        return section
+
+    def _sections(self, guild_id):
+        """Разделы, видимые на сервере: его собственный и общий"""
+        keys = {'', self._section_key(guild_id)}
+        return [self.data['guilds'][key] for key in sorted(keys) if key in self.data['guilds']]
+
+    @staticmethod
+    def _bucket(group, key):
+        bucket = group.get(key)
+        if bucket is None:
+            bucket = group[key] = {'total': 0, 'approved': 0, 'rejected': 0, 'minutes': 0, 'months': {}}
+        return bucket
+
+    def load(self):
+        """Читает сохраненные счетчики; False, если их еще нет"""
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != self.VERSION:
+            # Счетчики без разбивки по серверам пересчитываются заново
+            return False
+        self.data = data
+        return True
+
+    async def flush(self):
+        """Сохраняет счетчики, если они изменились; сериализация и запись идут в фоновом потоке"""
+        if not self.dirty:
+            return
+        await asyncio.to_thread(self._save)
+
+    def _save(self):
+        with self._lock:
+            text = json.dumps(self.data, ensure_ascii=False)
+            self.dirty = False
+        try:
+            write_text_atomic(self.path, text)
+        except OSError:
+            self.dirty = True
+            raise
+
+    def replace(self, data):
+        """Подменяет счетчики пересчитанными"""
+        with self._lock:
+            self.data = data
+            self.dirty = True
+
+    def max_id(self):
+        """Наибольший ID заявки, учтенной в счетчиках"""
+        return self.data.get('max_id', 0)
+
+    def record(self, request, sign=1):
+        """Добавляет (sign=1) или вычитает (sign=-1) вклад заявки в счетчики"""
+        with self._lock:
+            self._record(request, sign)
+
+    def _record(self, request, sign):
+        if sign > 0 and request.id is not None and request.id > self.data.get('max_id', 0):
+            self.data['max_id'] = request.id
+        status = request['status']
+        month = RequestArchive.month_of(request)
+        window = parse_time_window(request.get('time'))
+        minutes = window.duration if window is not None and status == 'approved' else 0
+        section = self._section(request.guild_id)
+        for group, key in (('users', request['user_id']), ('departments', request.get('department') or 'ГИБДД')):
+            bucket = self._bucket(section[group], key)
+            bucket['total'] += sign
+            bucket['months'][month] = bucket['months'].get(month, 0) + sign
+            bucket['minutes'] += sign * minutes
+            if status in ('approved', 'rejected'):
+                bucket[status] += sign
+        if request.get('moderator_id') and status in ('approved', 'rejected'):
+            bucket = self._bucket(section['moderators'], request['moderator_id'])
+            bucket[status] += sign
+            bucket['total'] += sign
+            bucket['months'][month] = bucket['months'].get(month, 0) + sign
+            if request.get('moderator_name'):
+                bucket['name'] = request['moderator_name']
+        self.dirty = True
+
+    def rebuild(self, requests):
+        """Пересчитывает счетчики по полной истории заявок"""
+        self.data = self._empty()
+        for request in requests:
+            self.record(request)
+
+    @staticmethod
+    def _merge(buckets):
+        """Сумма счетчиков одного ключа из нескольких разделов"""
+        buckets = [bucket for bucket in buckets if bucket]
+        if len(buckets) < 2:
+            return buckets[0] if buckets else None
+        merged = {'total': 0, 'approved': 0, 'rejected': 0, 'minutes': 0, 'months': {}}
+        for bucket in buckets:
+            for name in ('total', 'approved', 'rejected', 'minutes'):
+                merged[name] += bucket.get(name, 0)
+            for month, count in bucket['months'].items():
+                merged['months'][month] = merged['months'].get(month, 0) + count
+            if 'name' in bucket:
+                merged['name'] = bucket['name']
+        return merged
+
+    def get(self, group, key, guild_id=None):
+        return self._merge([section[group].get(str(key)) for section in self._sections(guild_id)])
+
+    def moderators(self, guild_id=None):
+        sections = self._sections(guild_id)
+        keys = {key for section in sections for key in section['moderators']}
+        return {key: self._merge([section['moderators'].get(key) for section in sections]) for key in keys}
+
+
+def approval_rate(bucket):
+    """Доля одобренных среди рассмотренных заявок, в процентах"""
+    decided = bucket['approved'] + bucket['rejected']
+    return round(100 * bucket['approved'] / decided) if decided else 0
+
+
+class GuildPartition:
+    """Индексы заявок одного сервера: (пользователь, дата, статус), ожидающие и интервалы отгулов"""
+
+    __slots__ = ('by_key', 'pending', 'absences')
+
+    def __init__(self):
+        self.by_key = {}
+        self.pending = set()
+        self.absences = AbsenceIndex()
+
+
+class RequestStore:
+    """Хранилище заявок в памяти с индексами по id, пользователю и по серверам
+
+    Индексы (пользователь, дата, статус), ожидающих и интервалов ведутся
+    отдельно для каждого сервера. Заявки, поданные до появления guild_id,
+    лежат в разделе None и видны на всех серверах.
+    """
+
+    def __init__(self, backend, archive=None, stats=None):
+        self.backend = backend
+        self.archive = archive
+        self.stats = stats
+        self.writer = None
+        self._loaded = False
+        self._loading = None
+        self._requests = {}
+        self._by_user = {}
+        self._partitions = {}
+        self._loaded_guilds = set()
+        self._max_id = 0
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def _ensure_loaded(self, guild_id=None):
+        if not self._loaded:
+            if self._loading is not None and not self._loading.done():
+                # Вторая загрузка поверх фоновой потеряла бы изменения, сделанные между ними
+                raise RuntimeError('Хранилище заявок еще загружается')
+            self.load()
+        if guild_id is None:
+            return
+        guild_id = _parse_snowflake(str(guild_id))
+        if guild_id not in self._loaded_guilds:
+            # Сервер, для которого не пришло on_guild_available, читается при первом обращении
+            self._load_partition(guild_id, self.backend.load_partition(guild_id) if self.partitioned else ())
+
+    @property
+    def partitioned(self):
+        """Хранится ли каждый сервер в своем файле"""
+        return hasattr(self.backend, 'load_partition')
+
+    def load(self):
+        """Загружает заявки из хранилища и строит индексы
+
+        В раздельном хранилище читается только общий файл, файлы серверов
+        подгружаются по мере их появления (load_guild).
+        """
+        self._reset(self.backend.load())
+        if self.partitioned:
+            self._max_id = max(self._max_id, self.backend.max_id())
+        if self.archive is not None:
+            # ID заархивированных заявок не должны выдаваться повторно
+            self._max_id = max(self._max_id, self.archive.max_id())
+        self._loaded = True
+
+    def begin_load(self):
+        """Начинает загрузку заявок в фоновом потоке; до ее конца обработчики ждут в wait_loaded()"""
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(asyncio.to_thread(self.load))
+        return self._loading
+
+    async def wait_loaded(self):
+        if self._loading is not None and not self._loading.done():
+            await asyncio.shield(self._loading)
+
+    def _load_partition(self, guild_id, requests):
+        if guild_id in self._loaded_guilds:
+            return []
+        self._loaded_guilds.add(guild_id)
+        requests = [r for r in requests if r.id not in self._requests]
+        for request in requests:
+            self._index(request)
+        return requests
+
+    async def load_guild(self, guild_id):
+        """Подгружает заявки сервера вне цикла событий; возвращает добавленные заявки"""
+        self._ensure_loaded()
+        if guild_id is None:
+            return []
+        guild_id = _parse_snowflake(str(guild_id))
+        if guild_id in self._loaded_guilds:
+            return []
+        if not self.partitioned:
+            self._loaded_guilds.add(guild_id)
+            return []
+        with metrics.timer('otgul_storage_load_seconds'):
+            requests = await asyncio.to_thread(self.backend.load_partition, guild_id)
+        return self._load_partition(guild_id, requests)
+
+    def snapshot(self):
+        """Копия всех заявок для записи вне цикла событий"""
+        return [r.copy() for r in self._requests.values()]
+
+    def _submit(self, entry):
+        """Передает изменение фоновой задаче записи или, если она не запущена, пишет сразу"""
+        if self.writer is not None and self.writer.running:
+            self.writer.submit(entry)
+        else:
+            self.backend.write([entry], self.snapshot() if self.backend.needs_snapshot else None)
+
+    async def persist(self, durable=None):
+        """Дожидается записи изменений на диск, если включено подтверждение записи"""
+        if self.writer is None or not self.writer.running:
+            return
+        if durable is None:
+            durable = self.writer.durable
+        if durable:
+            await self.writer.wait_flushed()
+
+    async def compact(self):
+        """Сворачивает журнал хранилища в снимок, если он используется"""
+        self._ensure_loaded()
+        if self.writer is not None and self.writer.running:
+            return await self.writer.compact()
+        return await self.backend.compact(self._requests.values())
+
+    def _reset(self, requests):
+        self._requests = {}
+        self._by_user = {}
+        self._partitions = {}
+        self._loaded_guilds = set()
+        self._max_id = 0
+        for request in requests:
+            self._index(request)
+
+    def _partition(self, guild_id):
+        partition = self._partitions.get(guild_id)
+        if partition is None:
+            partition = self._partitions[guild_id] = GuildPartition()
+        return partition
+
+    def _scope(self, guild_id):
+        """Разделы, видимые на сервере: его собственный и общий; без сервера — все"""
+        if guild_id is None:
+            return list(self._partitions.values())
+        guild_id = _parse_snowflake(str(guild_id))
+        return [p for p in (self._partitions.get(guild_id), self._partitions.get(None)) if p is not None]
+
+    def _index(self, request):
+        request_id = request.id
+        self._requests[request_id] = request
+        self._by_user.setdefault(request.user_id, {})[request_id] = None
+        partition = self._partition(request.guild_id)
+        key = (request.user_id, request.date, request.status)
+        partition.by_key.setdefault(key, set()).add(request_id)
+        if request.status is Status.PENDING:
+            partition.pending.add(request_id)
+        partition.absences.add(request)
+        if request_id > self._max_id:
+            self._max_id = request_id
+
+    def _unindex(self, request):
+        request_id = request.id
+        self._requests.pop(request_id, None)
+        user_ids = self._by_user.get(request.user_id)
+        if user_ids is not None:
+            user_ids.pop(request_id, None)
+            if not user_ids:
+                del self._by_user[request.user_id]
+        partition = self._partitions.get(request.guild_id)
+        if partition is None:
+            return
+        key = (request.user_id, request.date, request.status)
+        ids = partition.by_key.get(key)
+        if ids is not None:
+            ids.discard(request_id)
+            if not ids:
+                del partition.by_key[key]
+        partition.pending.discard(request_id)
+        partition.absences.remove(request)
+
+    def all(self):
+        """Возвращает список всех заявок"""
+        self._ensure_loaded()
+        return list(self._requests.values())
+
+    def all_guilds(self):
+        """Все заявки горячего хранилища, включая серверы, еще не загруженные в память (для разовых проходов)"""
+        requests = self.all()
+        if self.partitioned:
+            for guild_id in self.backend.guilds():
+                if guild_id not in self._loaded_guilds:
+                    requests.extend(self.backend.read_partition(guild_id))
+        return requests
+
+    def get(self, request_id):
+        """Получает заявку по ID"""
+        self._ensure_loaded()
+        return self._requests.get(request_id)
+
+    async def rebuild_stats(self):
+        """Пересчитывает счетчики статистики по горячему хранилищу и всему архиву
+
+        Архив и не загруженные в память серверы считаются в фоновом потоке, а
+        заявки из памяти добавляются после него без await до подмены счетчиков,
+        поэтому изменения, сделанные во время пересчета, не теряются.
+        """
+        self._ensure_loaded()
+        hot_ids = set(self._requests)
+        loaded_guilds = set(self._loaded_guilds)
+
+        def collect():
+            stats = StatsCounters(self.stats.path)
+            if self.partitioned:
+                # Серверы, еще не подгруженные в память, читаются прямо из их файлов
+                for guild_id in self.backend.guilds():
+                    if guild_id not in loaded_guilds:
+                        for request in self.backend.read_partition(guild_id):
+                            if request.id not in hot_ids:
+                                stats.record(request)
+            if self.archive is not None:
+                for month in self.archive.months():
+                    for request in self.archive.load_month(month).values():
+                        if request.id not in hot_ids:
+                            stats.record(request)
+            return stats
+
+        stats = await asyncio.to_thread(collect)
+        for request in self._requests.values():
+            if request.guild_id is None or request.guild_id in loaded_guilds:
+                stats.record(request)
+        self.stats.replace(stats.data)
+
+    async def history_index(self, user_id, status=None, date=None):
+        """Индекс истории пользователя [(id, месяц архива или None)] по возрастанию ID
+
+        Фильтр по статусу и дате (ДД.ММ.ГГГГ или ММ.ГГГГ) применяется к индексу,
+        сами заявки из архива при этом не читаются.
+        """
+        user_id = str(user_id)
+
+        def matches(request_status, request_date):
+            if status is not None and request_status != status:
+                return False
+            return date is None or request_date == date or request_date.endswith(f'.{date}')
+
+        entries = []
+        if self.archive is not None:
+            archived = await asyncio.to_thread(self.archive.user_index, user_id)
+            # Заявка, которая уже в архиве, но еще не убрана из горячего хранилища, берется из памяти
+            entries = [
+                (request_id, month) for request_id, month, request_status, request_date in archived
+                if request_id not in self._requests and matches(request_status, request_date)
+            ]
+        entries.extend((r['id'], None) for r in self.by_user(user_id) if matches(r['status'], r['date']))
+        entries.sort()
+        return entries
+
+    async def load_entries(self, entries):
+        """Читает заявки только для переданных элементов индекса истории"""
+        months = {month for _, month in entries if month is not None}
+        loaded = {}
+        if months:
+            loaded = await asyncio.to_thread(lambda: {month: self.archive.load_month(month) for month in months})
+        requests = []
+        for request_id, month in entries:
+            request = self._requests.get(request_id) if month is None else loaded[month].get(request_id)
+            if request is not None:
+                requests.append(request)
+        return requests
+
+    def by_user(self, user_id):
+        """Возвращает заявки пользователя в порядке подачи"""
+        self._ensure_loaded()
+        return [self._requests[i] for i in self._by_user.get(_parse_snowflake(str(user_id)), ())]
+
+    def find(self, user_id, date, status, guild_id=None):
+        """Возвращает заявки пользователя на дату с указанным статусом (на сервере guild_id или на всех)
+
+        Дату быстрее передавать порядковым номером дня: строка разбирается через strptime.
+        """
+        self._ensure_loaded(guild_id)
+        key = (_parse_snowflake(user_id), date_ordinal(date), Status(status))
+        ids = [i for partition in self._scope(guild_id) for i in partition.by_key.get(key, ())]
+        return [self._requests[i] for i in sorted(ids)]
+
+    def pending(self, guild_id=None):
+        """Возвращает заявки, ожидающие рассмотрения (на сервере guild_id или на всех)"""
+        self._ensure_loaded(guild_id)
+        ids = [i for partition in self._scope(guild_id) for i in partition.pending]
+        return [self._requests[i] for i in sorted(ids)]
+
+    def pending_count(self):
+        self._ensure_loaded()
+        return sum(len(partition.pending) for partition in self._partitions.values())
+
+    def max_concurrent(self, date, department, window, guild_id=None):
+        """Наибольшее число одновременных отгулов подразделения на сервере внутри интервала
+
+        Максимумы разделов складываются, поэтому для сервера с заявками в
+        общем разделе это оценка сверху.
+        """
+        self._ensure_loaded(guild_id)
+        return sum(p.absences.max_concurrent(date, department, window) for p in self._scope(guild_id))
+
+    def overlapping(self, date, department, window, guild_id=None):
+        """Заявки сервера, интервалы которых пересекаются с window, по возрастанию ID"""
+        self._ensure_loaded(guild_id)
+        ids = [i for p in self._scope(guild_id) for i in p.absences.overlapping(date, department, window)]
+        return [self._requests[i] for i in sorted(ids)]
+
+    def last_id(self):
+        """Наибольший выданный ID заявки, включая архив и файлы серверов"""
+        self._ensure_loaded()
+        return self._max_id
+
+    def next_id(self):
+        """Выдает следующий ID заявки; последовательность только растет, в том числе после удалений"""
+        self._ensure_loaded()
+        self._max_id += 1
+        return self._max_id
+
+    def add(self, request):
+        """Добавляет заявку, назначая ей следующий ID"""
+        self._ensure_loaded(request.guild_id)
+        request.id = self.next_id()
+        self._index(request)
+        if self.stats is not None:
+            self.stats.record(request)
+        self._submit({'op': 'put', 'request': request.copy()})
+        return request
+
+    def update(self, request_id, **changes):
+        """Изменяет поля заявки с переиндексацией"""
+        self._ensure_loaded()
+        request = self._requests.get(request_id)
+        if request:
+            counted = self.stats is not None and 'status' in changes
+            if counted:
+                self.stats.record(request, -1)
+            self._unindex(request)
+            request.update(changes)
+            self._index(request)
+            if counted:
+                self.stats.record(request)
+            self._submit({'op': 'put', 'request': request.copy()})
+        return request
+
+    def transition(self, request_id, expected, **changes):
+        """Меняет заявку, только если ее статус равен expected (compare-and-set)
+
+        Все изменения состояния выполняются синхронно в потоке цикла событий,
+        поэтому проверка и запись не разделены await и не пересекаются с другими
+        обработчиками; заявки с разными ID друг друга не блокируют.
+        """
+        self._ensure_loaded()
+        request = self._requests.get(request_id)
+        if request is None or request['status'] != expected:
+            return None
+        return self.update(request_id, **changes)
+
+    def evict(self, request_ids):
+        """Убирает заявки, перенесенные в архив, из горячего хранилища"""
+        self._ensure_loaded()
+        for request_id in request_ids:
+            request = self._requests.get(request_id)
+            if request:
+                self._unindex(request)
+                self._submit({'op': 'delete', 'id': request_id, 'guild_id': request.guild_id})
+
+    def delete(self, request_id):
+        """Удаляет заявку"""
+        self._ensure_loaded()
+        request = self._requests.get(request_id)
+        if request:
+            if self.stats is not None:
+                self.stats.record(request, -1)
+            self._unindex(request)
+            self._submit({'op': 'delete', 'id': request_id, 'guild_id': request.guild_id})
+        return request
+
+
+class StoreWriter:
+    """Фоновая задача записи: копит изменения и сбрасывает их в хранилище одной пачкой"""
+
+    def __init__(self, store, max_delay=OTGUL_FLUSH_DELAY, durable=OTGUL_DURABLE_ACK):
+        self.store = store
+        self.max_delay = max_delay
+        self.durable = durable
+        self._entries = []
+        self._waiters = []
+        self._wakeup = None
+        self._lock = None
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self.running:
+            return
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+        self.store.writer = self
+
+    async def stop(self):
+        """Останавливает задачу, сбросив накопленные изменения"""
+        if not self.running:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        await self.flush()
+        self.store.writer = None
+
+    def submit(self, entry):
+        self._entries.append(entry)
+        self._wakeup.set()
+
+    def queue_size(self):
+        return len(self._entries)
+
+    async def wait_flushed(self):
+        """Ждет, пока все переданные ранее изменения окажутся на диске"""
+        if not self._entries and not self._lock.locked():
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._wakeup.set()
+        await waiter
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            # Даем накопиться пачке изменений, но не дольше max_delay
+            await asyncio.sleep(self.max_delay)
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            await self._flush_locked()
+
+    async def _flush_locked(self):
+        entries, self._entries = self._entries, []
+        waiters, self._waiters = self._waiters, []
+        try:
+            if entries:
+                backend = self.store.backend
+                snapshot = self.store.snapshot() if backend.needs_snapshot else None
+                with metrics.timer('otgul_storage_write_seconds', backend=type(backend).__name__):
+                    await asyncio.to_thread(backend.write, entries, snapshot)
+                metrics.inc('otgul_storage_write_entries_total', len(entries))
+        except Exception as e:
+            log_error('storage_write', f'❌ Ошибка записи заявок: {e}', e, entries=len(entries))
+            # Повторим запись этих изменений при следующем сбросе
+            self._entries[:0] = entries
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+        else:
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    async def compact(self):
+        """Сворачивает журнал, не пересекаясь с записью новых изменений"""
+        async with self._lock:
+            await self._flush_locked()
+            return await self.store.backend.compact(self.store._requests.values())
+
+
+class RequestArchive:
+    """Архив рассмотренных заявок: по файлу на месяц, файлы только дописываются архиватором
+
+    Манифест хранит только наибольший выданный ID и читается при запуске.
+    Индекс истории пользователей ([id, месяц, статус, дата] по возрастанию ID)
+    разложен по USER_BUCKETS файлам users/<xx>.json по хешу ID пользователя:
+    запрос истории читает один такой файл и только месяцы с нужными заявками.
+    """
+
+    USER_BUCKETS = 256
+
+    def __init__(self, directory, cache_size=4):
+        self.directory = directory
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._manifest = None
+
+    @staticmethod
+    def month_of(request):
+        """Месяц заявки в виде 'ГГГГ-ММ' по полю date ('ДД.ММ.ГГГГ')"""
+        try:
+            day, month, year = request['date'].split('.')
+            return f'{int(year):04d}-{int(month):02d}'
+        except (AttributeError, ValueError):
+            return 'unknown'
+
+    def _path(self, name):
+        return os.path.join(self.directory, f'{name}.json')
+
+    def _read(self, name, default):
+        path = self._path(name)
+        if not os.path.exists(path):
+            return default
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _read_requests(self, month):
+        with metrics.timer('otgul_archive_read_seconds'):
+            return RequestSerializer.read(self._path(month))
+
+    @property
+    def manifest(self):
+        with self._lock:
+            if self._manifest is None:
+                self._manifest = self._read('manifest', {'max_id': 0})
+            return self._manifest
+
+    def max_id(self):
+        return self.manifest['max_id']
+
+    def months(self):
+        """Все месяцы архива, от старых к новым"""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name[:-5] for name in os.listdir(self.directory) if name.endswith('.json') and name != 'manifest.json')
+
+    @classmethod
+    def _user_bucket(cls, user_id):
+        digest = hashlib.blake2b(str(user_id).encode(), digest_size=2).digest()
+        return f'users/{int.from_bytes(digest, "big") % cls.USER_BUCKETS:02x}'
+
+    def user_index(self, user_id):
+        """Индекс истории пользователя: [id, месяц, статус, дата] по возрастанию ID"""
+        return self._read(self._user_bucket(user_id), {}).get(str(user_id), [])
+
+    def user_months(self, user_id):
+        return sorted({month for _, month, _, _ in self.user_index(user_id)})
+
+    def load_month(self, month):
+        """Заявки одного месяца по ID; последние прочитанные месяцы держатся в памяти"""
+        with self._lock:
+            if month in self._cache:
+                self._cache.move_to_end(month)
+                return self._cache[month]
+        requests = {r.id: r for r in self._read_requests(month)}
+        with self._lock:
+            self._cache[month] = requests
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return requests
+
+    def read_month(self, month):
+        """Заявки одного месяца списком, без кэширования (для разовых проходов по архиву)"""
+        return self._read_requests(month)
+
+    def archive(self, requests):
+        """Дописывает заявки в файлы их месяцев и обновляет манифест"""
+        os.makedirs(self.directory, exist_ok=True)
+        by_month = {}
+        for request in requests:
+            by_month.setdefault(self.month_of(request), []).append(request)
+        by_bucket = {}
+        for month, month_requests in by_month.items():
+            # Повторная архивация той же заявки (после сбоя) заменяет старую запись
+            merged = {r.id: r for r in self._read_requests(month)}
+            merged.update((r.id, r) for r in month_requests)
+            RequestSerializer.save(self._path(month), sorted(merged.values(), key=lambda r: r.id))
+            with self._lock:
+                self._cache.pop(month, None)
+            for request in month_requests:
+                entry = [request['id'], month, request['status'], request['date']]
+                by_bucket.setdefault(self._user_bucket(request['user_id']), []).append((request['user_id'], entry))
+        os.makedirs(os.path.join(self.directory, 'users'), exist_ok=True)
+        for bucket, bucket_entries in by_bucket.items():
+            users = self._read(bucket, {})
+            for user_id, entry in bucket_entries:
+                entries = users.setdefault(user_id, [])
+                position = bisect.bisect_left(entries, [entry[0]])
+                if position < len(entries) and entries[position][0] == entry[0]:
+                    entries[position] = entry
+                else:
+                    entries.insert(position, entry)
+            write_json_atomic(self._path(bucket), users, None)
+        manifest = self.manifest
+        manifest['max_id'] = max([manifest['max_id']] + [request['id'] for request in requests])
+        write_json_atomic(self._path('manifest'), manifest, None)
+
+
+async def archive_processed_requests(today=None):
+    """Переносит рассмотренные заявки прошлых дней из горячего хранилища в архив"""
+    if store.archive is None:
+        return 0
+    today = today or datetime.now().strftime('%d.%m.%Y')
+    candidates = [r.copy() for r in store.all() if r['status'] != 'pending' and r['date'] != today]
+    if not candidates:
+        return 0
+    await asyncio.to_thread(store.archive.archive, candidates)
+    # Заявки, изменившиеся во время записи архива, уйдут в архив в следующий раз
+    archived = [r.id for r in candidates if store.get(r.id) == r]
+    store.evict(archived)
+    await store.persist()
+    return len(archived)
+
+
+# Поля выгрузки заявок, в этом порядке
+EXPORT_FIELDS = (
+    'id', 'user_id', 'username', 'date', 'time', 'duration', 'static', 'department', 'reason',
+    'status', 'created_at', 'moderator_id', 'moderator_name', 'rejection_reason', 'processed_at'
+)
+
+
+def parse_date(text):
+    """Дата из строки 'ДД.ММ.ГГГГ'"""
+    return datetime.strptime(text.strip(), '%d.%m.%Y').date()
+
+
+def iter_export_requests(hot, archive=None, date_from=None, date_to=None, user_id=None, status=None, moderator_id=None, guild_id=None):
+    """Заявки для выгрузки по одной; архив читается по одному месяцу и без кэша
+
+    С guild_id выгружаются заявки этого сервера и заявки без сервера.
+    """
+    user_id = str(user_id) if user_id is not None else None
+    moderator_id = str(moderator_id) if moderator_id is not None else None
+    guild_id = _parse_snowflake(str(guild_id)) if guild_id is not None else None
+
+    def matches(request):
+        if guild_id is not None and request.guild_id is not None and request.guild_id != guild_id:
+            return False
+        if user_id is not None and request['user_id'] != user_id:
+            return False
+        if status is not None and request['status'] != status:
+            return False
+        if moderator_id is not None and request.get('moderator_id') != moderator_id:
+            return False
+        if date_from is not None or date_to is not None:
+            try:
+                day = parse_date(request['date'])
+            except (AttributeError, ValueError):
+                return False
+            if (date_from is not None and day < date_from) or (date_to is not None and day > date_to):
+                return False
+        return True
+
+    hot_ids = {r['id'] for r in hot}
+    if archive is not None:
+        months = archive.user_months(user_id) if user_id is not None else archive.months()
+        first = f'{date_from.year:04d}-{date_from.month:02d}' if date_from else None
+        last = f'{date_to.year:04d}-{date_to.month:02d}' if date_to else None
+        for month in months:
+            if (first and month < first) or (last and month > last):
+                continue
+            for request in archive.read_month(month):
+                if request['id'] not in hot_ids and matches(request):
+                    yield request
+    for request in hot:
+        if matches(request):
+            yield request
+
+
+def write_export(requests, fmt, fp):
+    """Пишет заявки в двоичный файл построчно в формате csv или jsonl; возвращает их число"""
+    # BOM, чтобы Excel правильно открыл кириллицу в CSV
+    text = io.TextIOWrapper(fp, encoding='utf-8-sig' if fmt == 'csv' else 'utf-8', newline='')
+    count = 0
+    if fmt == 'csv':
+        writer = csv.DictWriter(text, fieldnames=EXPORT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for request in requests:
+            writer.writerow(request)
+            count += 1
+    else:
+        for request in requests:
+            text.write(json.dumps(request.to_dict(), ensure_ascii=False) + '\n')
+            count += 1
+    text.flush()
+    text.detach()
+    return count
+
+
+def create_backend():
+    """Создает хранилище заявок согласно настройкам OTGUL_STORAGE и OTGUL_PARTITIONED"""
+    if OTGUL_STORAGE == 'sqlite':
+        legacy = SqliteBackend(OTGUL_DB_FILE)
+        factory = lambda base: SqliteBackend(f'{base}.db')
+    else:
+        legacy = JsonBackend(OTGUL_FILE, OTGUL_JOURNAL_FILE if OTGUL_JOURNAL else None)
+        factory = lambda base: JsonBackend(f'{base}.json', f'{base}.journal' if OTGUL_JOURNAL else None)
+    if OTGUL_PARTITIONED:
+        return PartitionedBackend(OTGUL_PARTITION_DIR, legacy, factory)
+    return legacy
+
+
+store = RequestStore(create_backend(), RequestArchive(OTGUL_ARCHIVE_DIR), StatsCounters(OTGUL_STATS_FILE))
+store_writer = StoreWriter(store)
+
+
+def storage_file_sizes():
+    """Размеры файлов хранилища, журнала, каталога серверов, статистики и очереди уведомлений"""
+    paths = (OTGUL_FILE, OTGUL_JOURNAL_FILE, OTGUL_DB_FILE, f'{OTGUL_DB_FILE}-wal', OTGUL_STATS_FILE, OTGUL_NOTIFY_FILE)
+    sizes = {(('file', path),): os.path.getsize(path) for path in paths if os.path.exists(path)}
+    if os.path.isdir(OTGUL_PARTITION_DIR):
+        # Файлы серверов одной суммой, чтобы число серий не росло с числом серверов
+        with os.scandir(OTGUL_PARTITION_DIR) as entries:
+            sizes[(('file', OTGUL_PARTITION_DIR),)] = sum(e.stat().st_size for e in entries if e.is_file())
+    return sizes
+
+
+# Пока заявки загружаются, значений нет
+metrics.gauge('otgul_pending_requests', 'Заявки, ожидающие рассмотрения', lambda: store.pending_count() if store.loaded else {})
+metrics.gauge('otgul_hot_requests', 'Заявки в горячем хранилище', lambda: len(store.all()) if store.loaded else {})
+metrics.gauge('otgul_store_writer_queue', 'Изменения, ожидающие записи на диск', lambda: store_writer.queue_size())
+metrics.gauge('otgul_storage_bytes', 'Размер файлов хранилища', storage_file_sizes)
+
+def create_request(user_id, username, date, time=None, duration=None, static=None, department=None, reason=None, guild_id=None):
+    """Добавляет заявку в хранилище без ожидания записи на диск
+
+    Выполняется без await, поэтому между проверками обработчика и появлением
+    заявки в хранилище другие обработчики вклиниться не могут.
+    """
+    request = OtgulRequest(
+        user_id=user_id,
+        guild_id=guild_id,
+        username=username,
+        date=date,
+        time=time,
+        duration=duration,
+        static=static,
+        department=department or Department.GIBDD,
+        reason=reason,
+        status=Status.PENDING,
+        created_at=int(datetime.now().timestamp())
+    )
+    store.add(request)
+    return request
+
+async def add_request(user_id, username, date, time=None, duration=None, static=None, department=None, reason=None, guild_id=None):
+    """Добавляет новый запрос отгула"""
+    request = create_request(user_id, username, date, time, duration, static, department, reason, guild_id)
+    await store.persist()
+    return request
+
+def get_request_by_id(request_id):
+    """Получает запрос по ID"""
+    return store.get(request_id)
+
+def status_changes(status, moderator_id=None, moderator_name=None, rejection_reason=None):
+    """Поля заявки, которые меняются вместе со статусом"""
+    changes = {'status': status}
+    if moderator_id:
+        changes['moderator_id'] = moderator_id
+    if moderator_name:
+        changes['moderator_name'] = moderator_name
+    if rejection_reason:
+        changes['rejection_reason'] = rejection_reason
+    if status != 'pending':
+        changes['processed_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    return changes
+
+async def update_request_status(request_id, status, moderator_id=None, moderator_name=None, rejection_reason=None):
+    """Обновляет статус запроса"""
+    request = store.update(request_id, **status_changes(status, moderator_id, moderator_name, rejection_reason))
+    await store.persist()
+    return request
+
+async def transition_request(request_id, status, moderator_id=None, moderator_name=None, rejection_reason=None):
+    """Переводит ожидающую заявку в новый статус; None, если заявку уже обработали"""
+    request = store.transition(
+        request_id, 'pending', **status_changes(status, moderator_id, moderator_name, rejection_reason)
+    )
+    if request:
+        await store.persist()
+    return request
+
+def has_today_request(user_id, guild_id=None):
+    """Проверяет, есть ли у пользователя заявка на сегодня (на сервере guild_id или на любом)"""
+    return len(store.find(user_id, datetime.now().toordinal(), Status.PENDING, guild_id)) > 0
+
+# Неотправленные уведомления переживают перезапуск бота
+OTGUL_NOTIFY_FILE = os.getenv('OTGUL_NOTIFY_FILE', 'otgul_notifications.json')
+OTGUL_NOTIFY_MAX_ATTEMPTS = int(os.getenv('OTGUL_NOTIFY_MAX_ATTEMPTS', '6'))
+# Пауза между личными сообщениями, чтобы не упираться в лимиты Discord
+OTGUL_NOTIFY_INTERVAL = float(os.getenv('OTGUL_NOTIFY_INTERVAL', '0.5'))
+
+
+class NotificationDispatcher:
+    """Фоновая отправка личных сообщений о решениях по заявкам с повторами при ошибках"""
+
+    def __init__(self, client, path=OTGUL_NOTIFY_FILE, max_attempts=OTGUL_NOTIFY_MAX_ATTEMPTS, interval=OTGUL_NOTIFY_INTERVAL):
+        self.client = client
+        self.path = path
+        self.max_attempts = max_attempts
+        self.interval = interval
+        self._queue = []
+        self._wakeup = None
+        self._save_lock = None
+        self._task = None
+        self.sent = 0
+        self.failed = 0
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def queue_size(self):
+        return len(self._queue)
+
+    def load(self):
+        """Читает уведомления, не отправленные до прошлой остановки"""
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self._queue = json.load(f)
+
+    async def _save(self):
+        if self._save_lock is None:
+            self._save_lock = asyncio.Lock()
+        async with self._save_lock:
+            try:
+                await asyncio.to_thread(write_json_atomic, self.path, [dict(n) for n in self._queue])
+            except OSError as e:
+                log_error('notify_save', f'❌ Ошибка сохранения очереди уведомлений: {e}', e)
+
+    def start(self):
+        if self.running:
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if not self.running:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        await self._save()
+
+    async def enqueue(self, user_id, text, request_id=None):
+        """Ставит сообщение в очередь; обработчик взаимодействия не ждет отправки"""
+        await self.enqueue_many([(user_id, text, request_id)])
+
+    async def enqueue_many(self, messages):
+        """Ставит в очередь несколько сообщений (user_id, text, request_id) с одной записью на диск"""
+        for user_id, text, request_id in messages:
+            self._queue.append({
+                'user_id': str(user_id),
+                'request_id': request_id,
+                'text': text,
+                'attempts': 0,
+                'next_at': 0,
+            })
+        await self._save()
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _resolve_user(self, user_id):
+        # Сначала кэш пользователей и участников серверов, REST-запрос — только если там нет
+        user = self.client.get_user(user_id)
+        if user is None:
+            user = await self.client.fetch_user(user_id)
+        return user
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            ready = [n for n in self._queue if n.get('next_at', 0) <= now]
+            if not ready:
+                timeout = min((n.get('next_at', 0) for n in self._queue), default=now + 3600) - now
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            for notification in ready:
+                try:
+                    await self._deliver(notification)
+                except Exception as e:
+                    # Любая другая ошибка (разрыв соединения aiohttp, испорченная запись очереди)
+                    # не должна останавливать отправку: уведомление уходит на повтор
+                    self._retry(notification, e)
+                await asyncio.sleep(self.interval)
+            await self._save()
+
+    async def _deliver(self, notification):
+        try:
+            user = await self._resolve_user(int(notification['user_id']))
+            await user.send(notification['text'])
+        except (discord.Forbidden, discord.NotFound) as e:
+            # Личные сообщения закрыты или пользователя нет — повтор не поможет
+            self._finish(notification, 'failed', e)
+        except (discord.HTTPException, OSError, asyncio.TimeoutError) as e:
+            self._retry(notification, e)
+        else:
+            self._finish(notification, 'sent')
+
+    def _retry(self, notification, error):
+        """Откладывает повтор с растущей паузой; после max_attempts попыток уведомление считается недоставленным"""
+        notification['attempts'] = notification.get('attempts', 0) + 1
+        if notification['attempts'] >= self.max_attempts:
+            self._finish(notification, 'failed', error)
+            return
+        retry_after = getattr(error, 'retry_after', None) or min(2 ** notification['attempts'], 300)
+        notification['next_at'] = time.time() + retry_after
+        log_error(
+            'notify_retry',
+            f'⚠️ Уведомление по заявке #{notification.get("request_id")} не отправлено ({error}), повтор через {retry_after:.0f} с',
+            error, request_id=notification.get('request_id'), attempts=notification['attempts']
+        )
+
+    def _finish(self, notification, status, error=None):
+        """Убирает уведомление из очереди и записывает результат доставки в заявку"""
+        if notification in self._queue:
+            self._queue.remove(notification)
+        if status == 'sent':
+            self.sent += 1
+        else:
+            self.failed += 1
+            log_error(
+                'notify_failed',
+                f'❌ Не удалось уведомить пользователя {notification.get("user_id")} по заявке #{notification.get("request_id")}: {error}',
+                error, request_id=notification.get('request_id'), user_id=notification.get('user_id')
+            )
+        if notification.get('request_id') is not None:
+            store.update(notification['request_id'], notification_status=status)
+
+
+notifier = NotificationDispatcher(bot)
+metrics.gauge('otgul_notifications_queued', 'Неотправленные личные сообщения', lambda: notifier.queue_size())
+metrics.gauge('otgul_notifications_sent_total', 'Доставленные личные сообщения', lambda: notifier.sent, 'counter')
+metrics.gauge('otgul_notifications_failed_total', 'Личные сообщения, которые не удалось доставить', lambda: notifier.failed, 'counter')
+
+def request_deadline(request):
+    """Момент (timestamp), после которого ожидающая заявка считается просроченной"""
+    if not isinstance(request.date, int):
+        return None
+    day = datetime.fromordinal(request.date)
+    window = parse_time_window(request.get('time'))
+    if window is not None:
+        return (day + timedelta(minutes=window.end)).timestamp()
+    return (day + timedelta(days=1)).timestamp()
+
+
+class ExpiryScheduler:
+    """Переводит ожидающие заявки в статус expired, когда их время прошло
+
+    Сроки лежат в куче: задача спит до ближайшего срока, без периодического
+    перебора всех заявок. Записи о заявках, рассмотренных раньше срока, просто
+    пропускаются при извлечении из кучи.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._heap = []
+        self._wakeup = None
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def schedule(self, request):
+        deadline = request_deadline(request)
+        if deadline is None:
+            return
+        heapq.heappush(self._heap, (deadline, request['id']))
+        # Новый срок раньше текущего — задача должна проснуться раньше
+        if self._wakeup is not None and self._heap[0][1] == request['id']:
+            self._wakeup.set()
+
+    def start(self):
+        if self.running:
+            return
+        self._heap = [
+            (deadline, request['id'])
+            for request in store.pending()
+            if (deadline := request_deadline(request)) is not None
+        ]
+        heapq.heapify(self._heap)
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self.running:
+            self._task.cancel()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self.expire_due()
+            except Exception as e:
+                log_error('expiry', f'❌ Ошибка завершения просроченных заявок: {e}', e)
+
+    async def expire_due(self):
+        """Переводит все наступившие сроки в expired одной записью в хранилище"""
+        now = time.time()
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            _, request_id = heapq.heappop(self._heap)
+            request = store.transition(request_id, 'pending', **status_changes('expired'))
+            if request:
+                expired.append(request)
+        if not expired:
+            return []
+        await store.persist()
+        log(f'⌛ Просрочено заявок: {len(expired)}', 'requests_expired', count=len(expired))
+        results = await asyncio.gather(
+            *(update_request_card(self.client, request) for request in expired),
+            return_exceptions=True
+        )
+        for request, result in zip(expired, results):
+            if isinstance(result, Exception):
+                log_error('card_update', f'⚠️ Не удалось обновить карточку заявки #{request["id"]}: {result}', result, request_id=request['id'])
+        return expired
+
+
+async def update_request_card(client, request):
+    """Перерисовывает карточку заявки в канале по ее текущему статусу и отключает кнопки"""
+    if not request.get('channel_id') or not request.get('message_id'):
+        return
+    # Карточка строится из заявки, поэтому канал и сообщение не запрашиваются у Discord
+    channel = client.get_partial_messageable(int(request['channel_id']))
+    message = channel.get_partial_message(int(request['message_id']))
+    await message.edit(embed=render_request_card(request), view=OtgulButtonsView(request['id'], disabled=True))
+
+
+expiry_scheduler = ExpiryScheduler(bot)
+
+# Роли, которые упоминаются в новой заявке
+MENTION_ROLE_NAMES = (
+    "Начальник УГИБДД",
+    "Зам. Нач. УГИБДД",
+    "Начальник ЦППС",
+    "Зам. Начальника ЦППС"
+)
+
+# Роли, которым разрешено рассматривать заявки (можно настроить список ролей)
+MODERATOR_ROLE_NAMES = MENTION_ROLE_NAMES + (
+    "Модератор",
+    "Администратор"
+)
+
+
+class GuildPolicy:
+    """Роли модераторов сервера, посчитанные заранее"""
+
+    __slots__ = ('moderator_role_ids', 'mentions')
+
+    def __init__(self, guild):
+        roles_by_name = {}
+        for role in guild.roles:
+            roles_by_name.setdefault(role.name, role)
+        self.moderator_role_ids = frozenset(
+            roles_by_name[name].id for name in MODERATOR_ROLE_NAMES if name in roles_by_name
+        )
+        self.mentions = ' '.join(
+            roles_by_name[name].mention for name in MENTION_ROLE_NAMES if name in roles_by_name
+        )
+
+
+_guild_policies = {}
+
+def get_guild_policy(guild):
+    """Возвращает закэшированные роли модераторов сервера"""
+    policy = _guild_policies.get(guild.id)
+    if policy is None:
+        policy = _guild_policies[guild.id] = GuildPolicy(guild)
+    return policy
+
+def invalidate_guild_policy(guild):
+    """Сбрасывает кэш ролей сервера после изменения ролей"""
+    _guild_policies.pop(guild.id, None)
+
+def can_moderate(user):
+    """Проверяет, может ли пользователь одобрять/отклонять заявки"""
+    # Проверка по правам (управление сообщениями)
+    if user.guild_permissions.manage_messages:
+        return True
+    
+    # Проверка по ролям
+    if user.guild:
+        policy = get_guild_policy(user.guild)
+        return not policy.moderator_role_ids.isdisjoint(role.id for role in user.roles)
+    
+    return False
+
+@bot.event
+async def on_guild_role_create(role):
+    invalidate_guild_policy(role.guild)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    invalidate_guild_policy(after.guild)
+
+@bot.event
+async def on_guild_role_delete(role):
+    invalidate_guild_policy(role.guild)
+
+@bot.event
+async def on_guild_remove(guild):
+    invalidate_guild_policy(guild)
+
+@bot.event
+async def on_guild_available(guild):
+    # Заявки сервера читаются, когда его шард получил сервер, а не все сразу при запуске
+    await store.wait_loaded()
+    with startup_profile.phase('guild_load'):
+        requests = await store.load_guild(guild.id)
+    pending = [r for r in requests if r.status is Status.PENDING]
+    if pending:
+        log(f'⏳ {guild.name}: активных заявок {len(pending)}', 'guild_pending_restored', guild=guild.id, count=len(pending))
+    # До on_ready планировщик еще не запущен и сам возьмет все ожидающие заявки
+    if expiry_scheduler.running:
+        for request in pending:
+            expiry_scheduler.schedule(request)
+
+# Файл с хэшем последнего синхронизированного набора команд
+COMMANDS_HASH_FILE = os.getenv('COMMANDS_HASH_FILE', 'commands_hash.txt')
+
+def command_tree_hash(tree):
+    """Хэш описания всех команд бота; меняется только вместе с самими командами"""
+    commands_data = sorted(
+        (cmd.to_dict(tree) for cmd in tree.get_commands()),
+        key=lambda data: (data.get('type', 1), data['name'])
+    )
+    payload = json.dumps([tree.client.application_id, commands_data], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+async def sync_commands(force=False):
+    """Синхронизирует команды с Discord, если их описание изменилось с прошлой синхронизации"""
+    current_hash = command_tree_hash(bot.tree)
+    saved_hash = None
+    if os.path.exists(COMMANDS_HASH_FILE):
+        with open(COMMANDS_HASH_FILE, 'r', encoding='utf-8') as f:
+            saved_hash = f.read().strip()
+    
+    if not force and saved_hash == current_hash:
+        log('✅ Команды не изменились, синхронизация пропущена', 'commands_sync_skipped')
+        return None
+    
+    log('Синхронизация команд с Discord...', 'commands_sync')
+    synced = await bot.tree.sync()
+    with open(COMMANDS_HASH_FILE, 'w', encoding='utf-8') as f:
+        f.write(current_hash)
+    log(
+        f'✅ Синхронизировано {len(synced)} команд:' + ''.join(f'\n   - /{cmd.name}' for cmd in synced),
+        'commands_synced', commands=[cmd.name for cmd in synced]
+    )
+    return synced
+
+@bot.event
+async def on_ready():
+    log(f'{bot.user} подключен к Discord!', 'connected', user=str(bot.user))
+    if bot.startup_done:
+        return
+    bot.startup_done = True
+    if bot.connect_started is not None:
+        startup_profile.add('gateway', time.perf_counter() - bot.connect_started)
+    
+    # До готовности нужны только заявки и сроки ожидающих; остальное делается в фоне
+    with startup_profile.phase('store_wait'):
+        await store.wait_loaded()
+    with startup_profile.phase('view_restore'):
+        expiry_scheduler.start()
+    
+    pending_count = store.pending_count()
+    if pending_count > 0:
+        log(f'⏳ Активных заявок: {pending_count}', 'pending_restored', count=pending_count)
+    if notifier.queue_size():
+        log(f'📨 Неотправленных уведомлений: {notifier.queue_size()}', 'notifications_restored', count=notifier.queue_size())
+    
+    startup_profile.mark('ready')
+    log(f'🚀 Бот готов к работе! ({EVENT_LOOP})', 'ready', loop=EVENT_LOOP)
+    bot.spawn(deferred_startup())
+
+async def deferred_startup():
+    """Запуск того, без чего бот уже отвечает: синхронизация команд, пересчет статистики, фоновые задачи"""
+    try:
+        with startup_profile.phase('sync'):
+            await sync_commands(force=bot.force_sync)
+    except Exception as e:
+        log_error('commands_sync', f'❌ Ошибка синхронизации команд: {e}', e)
+    
+    # Счетчики, отставшие от заявок (сбой между сохранениями), пересчитываются по истории
+    if bot.stats_missing or store.stats.max_id() < store.last_id():
+        # Пересчет до запуска архивации: архиватор переносит заявки, которые пересчет читает
+        with startup_profile.phase('stats_rebuild'):
+            await store.rebuild_stats()
+        bot.stats_missing = False
+    
+    if not archive_requests.is_running():
+        archive_requests.start()
+    
+    if not save_stats.is_running():
+        save_stats.start()
+    
+    if store.backend.compactable and not compact_journal.is_running():
+        compact_journal.start()
+    
+    startup_profile.mark('total')
+    log(f'⏱️ Этапы запуска:\n{startup_profile.report()}', 'startup_profile', phases=startup_profile.phases)
+    if bot.profile_startup:
+        await bot.close()
+
+@tasks.loop(seconds=OTGUL_ARCHIVE_INTERVAL)
+async def archive_requests():
+    """Периодически переносит рассмотренные заявки прошлых дней в архив"""
+    try:
+        count = await archive_processed_requests()
+        if count:
+            log(f'🗄️ В архив перенесено заявок: {count}', 'archived', count=count)
+    except OSError as e:
+        log_error('archive', f'❌ Ошибка архивации заявок: {e}', e)
+
+@tasks.loop(seconds=60)
+async def save_stats():
+    """Сохраняет изменившиеся счетчики статистики"""
+    try:
+        await store.stats.flush()
+    except OSError as e:
+        log_error('stats_save', f'❌ Ошибка сохранения статистики: {e}', e)
+
+@tasks.loop(seconds=OTGUL_COMPACT_INTERVAL)
+async def compact_journal():
+    """Периодически сворачивает журнал заявок в снимок"""
+    try:
+        await store.compact()
+    except OSError as e:
+        log_error('compact', f'❌ Ошибка сжатия журнала заявок: {e}', e)
+
+def parse_rate(text):
+    """Лимит вида 'N/секунды' -> (N, секунды); '0' или пустая строка — без ограничения"""
+    text = (text or '').strip()
+    if not text or text == '0':
+        return None
+    capacity, _, period = text.partition('/')
+    return int(capacity), float(period or 60)
+
+
+# Лимиты частоты взаимодействий по типу: (на пользователя, на сервер), формат 'N/секунды'
+OTGUL_RATE_LIMITS = {
+    'command': (
+        parse_rate(os.getenv('OTGUL_RATE_COMMAND', '5/10')),
+        parse_rate(os.getenv('OTGUL_RATE_COMMAND_GUILD', '100/10')),
+    ),
+    'button': (
+        parse_rate(os.getenv('OTGUL_RATE_BUTTON', '10/10')),
+        parse_rate(os.getenv('OTGUL_RATE_BUTTON_GUILD', '200/10')),
+    ),
+    'submit': (
+        parse_rate(os.getenv('OTGUL_RATE_SUBMIT', '3/60')),
+        parse_rate(os.getenv('OTGUL_RATE_SUBMIT_GUILD', '60/60')),
+    ),
+}
+
+
+class RateLimiter:
+    """Token bucket в памяти: до capacity запросов подряд, пополнение capacity за period секунд
+
+    Корзина, простоявшая period секунд, снова полна и ничем не отличается от новой,
+    поэтому такие корзины удаляются при периодическом проходе.
+    """
+
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.period = period
+        self.rate = capacity / period
+        self._buckets = {}
+        self._swept_at = time.monotonic()
+
+    def retry_after(self, key, now=None):
+        """Через сколько секунд для key появится токен (0 — уже есть)"""
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return 0.0
+        tokens = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def take(self, key, now=None):
+        """Забирает токен (вызывается после retry_after() == 0)"""
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(key)
+        tokens = self.capacity if bucket is None else min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+        self._buckets[key] = [tokens - 1, now]
+        if now - self._swept_at >= self.period:
+            self.evict_idle(now)
+
+    def evict_idle(self, now=None):
+        now = time.monotonic() if now is None else now
+        self._swept_at = now
+        idle = [key for key, (_, updated) in self._buckets.items() if now - updated >= self.period]
+        for key in idle:
+            del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class InteractionThrottle:
+    """Ограничение частоты взаимодействий по пользователю и серверу для каждого типа взаимодействия"""
+
+    KINDS = {
+        discord.InteractionType.application_command: 'command',
+        discord.InteractionType.component: 'button',
+        discord.InteractionType.modal_submit: 'submit',
+    }
+
+    def __init__(self, limits=OTGUL_RATE_LIMITS):
+        self._limiters = {
+            kind: (RateLimiter(*user) if user else None, RateLimiter(*guild) if guild else None)
+            for kind, (user, guild) in limits.items()
+        }
+
+    def check(self, interaction):
+        """0, если взаимодействие можно обработать (токены списаны), иначе через сколько секунд повторить"""
+        kind = self.KINDS.get(interaction.type)
+        user_limiter, guild_limiter = self._limiters.get(kind, (None, None))
+        checks = []
+        if user_limiter is not None:
+            checks.append((user_limiter, interaction.user.id))
+        if guild_limiter is not None and interaction.guild_id is not None:
+            checks.append((guild_limiter, interaction.guild_id))
+        now = time.monotonic()
+        # Токены списываются, только если разрешают все лимиты
+        wait = max((limiter.retry_after(key, now) for limiter, key in checks), default=0.0)
+        if wait:
+            metrics.inc('otgul_throttled_total', kind=kind)
+            return wait
+        for limiter, key in checks:
+            limiter.take(key, now)
+        return 0.0
+
+    def buckets(self):
+        return {
+            (('kind', kind), ('scope', scope)): len(limiter)
+            for kind, limiters in self._limiters.items()
+            for scope, limiter in zip(('user', 'guild'), limiters) if limiter is not None
+        }
+
+
+throttle = InteractionThrottle()
+metrics.describe('otgul_throttled_total', 'counter', 'Взаимодействия, отклоненные ограничением частоты')
+metrics.gauge('otgul_rate_limit_buckets', 'Активные корзины ограничения частоты', throttle.buckets)
+
 
-# Настройка для Windows
-if sys.platform == 'win32':
-    try:
-        import winloop
-        winloop.install()
-    except ImportError:
-        import asyncio
-        if sys.version_info >= (3, 8):
-            asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+# Discord ждет первого ответа на взаимодействие 3 секунды; после OTGUL_DEFER_AFTER секунд
+# работы обработчика ответ откладывается (defer), а итог отправляется через followup
+OTGUL_DEFER_AFTER = float(os.getenv('OTGUL_DEFER_AFTER', '2.0'))
 
-# Настройка intents
-intents = discord.Intents.default()
-try:
-    intents.message_content = True
-except AttributeError:
-    pass
-try:
-    intents.members = True
-except AttributeError:
-    pass
 
-# Создание бота
-bot = commands.Bot(command_prefix='!', intents=intents)
+class InteractionDeadline:
+    """Откладывает ответ на взаимодействие, если обработчик не успевает ответить за budget секунд
 
-# Файл для хранения запросов отгула
-OTGUL_FILE = 'otgul_requests.json'
+    Проверка «ответ уже отправлен» и сама отправка выполняются под одной блокировкой,
+    поэтому автоматический defer не пересекается с ответом обработчика.
+    """
 
-def load_requests():
-    """Загружает запросы отгула из файла"""
-    if os.path.exists(OTGUL_FILE):
-        with open(OTGUL_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return []
+    def __init__(self, interaction, budget, ephemeral=False, update=False):
+        self.interaction = interaction
+        self.budget = budget
+        self.ephemeral = ephemeral
+        self.update = update
+        self.deferred = False
+        self.lock = asyncio.Lock()
+        self._task = None
 
-def save_requests(requests):
-    """Сохраняет запросы отгула в файл"""
-    with open(OTGUL_FILE, 'w', encoding='utf-8') as f:
-        json.dump(requests, f, ensure_ascii=False, indent=2)
+    def start(self):
+        self._task = asyncio.create_task(self._defer_later())
 
-def add_request(user_id, username, date, time=None, duration=None, static=None, department=None, reason=None):
-    """Добавляет новый запрос отгула"""
-    requests = load_requests()
-    max_id = max([r['id'] for r in requests], default=0)
-    request = {
-        'id': max_id + 1,
-        'user_id': user_id,
-        'username': username,
-        'date': date,
-        'time': time,
-        'duration': duration,
-        'static': static,
-        'department': department or 'ГИБДД',
-        'reason': reason,
-        'status': 'pending',
-        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    }
-    requests.append(request)
-    save_requests(requests)
-    return request
+    def publish(self):
+        """Дальнейший автоматический defer будет публичным; True, если ответ уже отложен скрыто"""
+        hidden = self.deferred or self.lock.locked()
+        self.ephemeral = False
+        return hidden
 
-def get_request_by_id(request_id):
-    """Получает запрос по ID"""
-    requests = load_requests()
-    return next((r for r in requests if r['id'] == request_id), None)
+    def stop(self):
+        # Уже начатый defer доводится до конца, иначе ответ останется в неизвестном состоянии
+        if self._task is not None and not self.lock.locked():
+            self._task.cancel()
 
-def update_request_status(request_id, status, moderator_id=None, moderator_name=None, rejection_reason=None):
-    """Обновляет статус запроса"""
-    requests = load_requests()
-    request = next((r for r in requests if r['id'] == request_id), None)
-    if request:
-        request['status'] = status
-        if moderator_id:
-            request['moderator_id'] = moderator_id
-        if moderator_name:
-            request['moderator_name'] = moderator_name
-        if rejection_reason:
-            request['rejection_reason'] = rejection_reason
-        if status != 'pending':
-            request['processed_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        save_requests(requests)
-    return request
+    async def _defer_later(self):
+        await asyncio.sleep(self.budget)
+        async with self.lock:
+            if self.interaction.response.is_done():
+                return
+            try:
+                if self.update:
+                    await self.interaction.response.defer()
+                else:
+                    await self.interaction.response.defer(ephemeral=self.ephemeral, thinking=True)
+                self.deferred = True
+            except discord.HTTPException as e:
+                log_error('interaction_defer', f'⚠️ Не удалось отложить ответ на взаимодействие: {e}', e)
 
-def has_today_request(user_id):
-    """Проверяет, есть ли у пользователя заявка на сегодня"""
-    requests = load_requests()
-    today = datetime.now().strftime('%d.%m.%Y')
-    user_requests = [r for r in requests if r['user_id'] == str(user_id) and r['date'] == today and r['status'] == 'pending']
-    return len(user_requests) > 0
 
-def parse_time_duration(time_str):
-    """Парсит время и вычисляет продолжительность"""
-    match = re.match(r'(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})', time_str)
-    if match:
-        start_h, start_m = int(match.group(1)), int(match.group(2))
-        end_h, end_m = int(match.group(3)), int(match.group(4))
-        
-        start = timedelta(hours=start_h, minutes=start_m)
-        end = timedelta(hours=end_h, minutes=end_m)
-        duration = end - start
-        
-        if duration.total_seconds() <= 0:
-            return None, None, "Время окончания должно быть позже времени начала"
-        
-        hours = int(duration.total_seconds() // 3600)
-        minutes = int((duration.total_seconds() % 3600) // 60)
-        
-        if hours > 1 or (hours == 1 and minutes > 0):
-            return None, None, "Максимальная длительность отгула: 1 час"
-        
-        duration_str = f"{hours} ч" if hours > 0 else f"{minutes} мин"
-        return time_str, duration_str, None
-    
-    return None, None, "Неверный формат времени. Используйте: ЧЧ:ММ - ЧЧ:ММ"
+def deadline_aware(ephemeral=False, update=False, defer=True, budget=None):
+    """Декоратор обработчика взаимодействия: ограничивает частоту, следит за сроком ответа и замеряет время работы
 
-def is_future_time(time_str):
-    """Проверяет, что время в будущем"""
-    match = re.match(r'(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})', time_str)
-    if match:
-        now = datetime.now()
-        start_h, start_m = int(match.group(1)), int(match.group(2))
-        request_time = now.replace(hour=start_h, minute=start_m, second=0, microsecond=0)
-        
-        if request_time < now:
-            request_time += timedelta(days=1)
-        
-        return request_time > now
-    return False
+    ephemeral — видимость отложенного ответа команды или модального окна, update —
+    обработчик кнопки правит свое сообщение, defer=False — обработчик открывает
+    модальное окно (его нельзя отправить после defer), время только замеряется.
+    Ответы в обработчике отправляются через respond() и respond_edit().
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            interaction = next(arg for arg in args if isinstance(arg, discord.Interaction))
+            # Слишком частые взаимодействия отклоняются до любой работы с хранилищем
+            retry_after = throttle.check(interaction)
+            if retry_after:
+                await interaction.response.send_message(
+                    f'🐢 Слишком много запросов, попробуйте через {math.ceil(retry_after)} с',
+                    ephemeral=True
+                )
+                return None
+            guard = None
+            if defer:
+                guard = InteractionDeadline(interaction, OTGUL_DEFER_AFTER if budget is None else budget, ephemeral, update)
+                interaction.extras['deadline'] = guard
+                guard.start()
+            name = func.__qualname__
+            started = time.perf_counter()
+            try:
+                # Сразу после запуска заявки могут еще читаться с диска; срок ответа при этом уже идет
+                await store.wait_loaded()
+                return await func(*args, **kwargs)
+            except Exception:
+                metrics.inc('otgul_handler_errors_total', handler=name)
+                raise
+            finally:
+                if guard is not None:
+                    guard.stop()
+                elapsed = time.perf_counter() - started
+                metrics.observe('otgul_handler_duration_seconds', elapsed, handler=name)
+                if guard is not None and guard.deferred:
+                    metrics.inc('otgul_handler_deferred_total', handler=name)
+                    log(f'⏱️ {name}: ответ отложен, обработка заняла {elapsed:.2f} с', 'handler_deferred', handler=name, elapsed=elapsed)
+        return wrapper
+    return decorator
 
-def can_moderate(user):
-    """Проверяет, может ли пользователь одобрять/отклонять заявки"""
-    # Проверка по правам (управление сообщениями)
-    if user.guild_permissions.manage_messages:
-        return True
-    
-    # Проверка по ролям (можно настроить список ролей)
-    if user.guild:
-        moderator_roles = [
-            "Начальник УГИБДД",
-            "Зам. Нач. УГИБДД",
-            "Начальник ЦППС",
-            "Зам. Начальника ЦППС",
-            "Модератор",
-            "Администратор"
-        ]
-        user_roles = [role.name for role in user.roles]
-        for mod_role in moderator_roles:
-            if mod_role in user_roles:
-                return True
-    
-    return False
 
-@bot.event
-async def on_ready():
-    print(f'{bot.user} подключен к Discord!')
-    print('Синхронизация команд с Discord...')
-    try:
-        synced = await bot.tree.sync()
-        print(f'✅ Синхронизировано {len(synced)} команд:')
-        for cmd in synced:
-            print(f'   - /{cmd.name}')
-    except Exception as e:
-        print(f'❌ Ошибка синхронизации команд: {e}')
-    
-    requests = load_requests()
-    pending_count = len([r for r in requests if r['status'] == 'pending'])
-    if pending_count > 0:
-        print(f'Восстановление {pending_count} активных заявок...')
-        for req in requests:
-            if req['status'] == 'pending':
-                view = OtgulButtonsView(req['id'])
-                bot.add_view(view)
-        print('✅ Активные заявки восстановлены')
-    
-    print('🚀 Бот готов к работе!')
+def _response_lock(interaction):
+    guard = interaction.extras.get('deadline')
+    return guard.lock if guard is not None else contextlib.nullcontext()
 
-@bot.tree.command(name='инфо_отгулы', description='Показать информацию о системе отгулов (для модераторов)')
-async def info_otguls(interaction: discord.Interaction):
-    """Показать информационное сообщение о системе отгулов"""
-    if not can_moderate(interaction.user):
-        await interaction.response.send_message('❌ У вас нет прав для использования этой команды', ephemeral=True)
-        return
-    
-    embed = discord.Embed(
-        title='🧳 Система подачи заявок на отгулы',
-        description='Здесь вы можете подать заявку на отгул в рабочее время.',
-        color=discord.Color.blue(),
-        timestamp=datetime.now()
-    )
-    
-    embed.add_field(
-        name='⚠️ Важные ограничения:',
-        value=(
+
+async def respond(interaction, *args, **kwargs):
+    """Отвечает на взаимодействие новым сообщением; после defer — через followup"""
+    async with _response_lock(interaction):
+        if not interaction.response.is_done():
+            await interaction.response.send_message(*args, **kwargs)
+            return
+    await interaction.followup.send(*args, **kwargs)
+
+
+async def respond_edit(interaction, **kwargs):
+    """Правит сообщение, к которому относится взаимодействие; после defer — edit_original_response"""
+    async with _response_lock(interaction):
+        if not interaction.response.is_done():
+            await interaction.response.edit_message(**kwargs)
+            return
+    await interaction.edit_original_response(**kwargs)
+
+
+async def defer_response(interaction, ephemeral=False):
+    """Откладывает ответ перед долгой операцией, если он еще не отложен"""
+    async with _response_lock(interaction):
+        if not interaction.response.is_done():
+            await interaction.response.defer(ephemeral=ephemeral, thinking=True)
+
+
+class EmbedTemplate:
+    """Заготовка embed, собранная один раз при запуске
+
+    render() подставляет значения (str.format) только в поля с {шаблонами},
+    словари статичных полей общие для всех сообщений. Поэтому полученный
+    embed не правят через set_field_at, а рендерят заново.
+    """
+
+    def __init__(self, title, color, description=None, fields=(), footer=None):
+        self.title = title
+        self.color = color.value
+        self.description = description
+        self.footer = footer
+        self.fields = [{'name': name, 'value': value, 'inline': inline} for name, value, inline in fields]
+        self.dynamic = [i for i, (name, value, _) in enumerate(fields) if '{' in name or '{' in value]
+
+    def render(self, color=None, timestamp=None, extra_fields=(), **values):
+        fields = list(self.fields)
+        for i in self.dynamic:
+            field = fields[i]
+            fields[i] = {'name': field['name'].format(**values), 'value': field['value'].format(**values), 'inline': field['inline']}
+        fields.extend({'name': name, 'value': value, 'inline': inline} for name, value, inline in extra_fields)
+        data = {'type': 'rich', 'title': self.title, 'color': color.value if color is not None else self.color, 'fields': fields}
+        if self.description:
+            data['description'] = self.description
+        if self.footer:
+            data['footer'] = {'text': self.footer.format(**values)}
+        embed = discord.Embed.from_dict(data)
+        if timestamp is not None:
+            embed.timestamp = timestamp
+        return embed
+
+
+# Панель /инфо_отгулы: меняются только время в подписи и отметка времени
+INFO_PANEL = EmbedTemplate(
+    '🧳 Система подачи заявок на отгулы',
+    discord.Color.blue(),
+    description='Здесь вы можете подать заявку на отгул в рабочее время.',
+    fields=(
+        (
+            '⚠️ Важные ограничения:',
             '• Максимальная длительность отгула: **1 час**\n'
             '• Можно подать только на **сегодняшний день**\n'
             '• Отгул разрешен только в **рабочее время**\n'
             '• Можно подать только **одну заявку в день**\n'
-            '• Время должно быть в **будущем** относительно текущего момента'
+            '• Время должно быть в **будущем** относительно текущего момента',
+            False,
         ),
-        inline=False
-    )
-    
-    embed.add_field(
-        name='📝 Что нужно указать:',
-        value=(
+        (
+            '📝 Что нужно указать:',
             '• Имя и фамилия\n'
             '• Статик (123-456)\n'
             '• Время начала и конца отгула (формат НН:ММ)\n'
-            '• Причина взятия отгула'
+            '• Причина взятия отгула',
+            False,
         ),
-        inline=False
-    )
-    
-    embed.add_field(
-        name='🔍 Рассмотрение заявок:',
-        value=(
+        (
+            '🔍 Рассмотрение заявок:',
             '• Заявки рассматривают командиры вашего подразделения\n'
             '• Уведомление о результате придет в **личные сообщения**\n'
             '• Вы можете **удалить** свою заявку до рассмотрения\n'
-            '• При отклонении можно подать новую заявку в тот же день'
+            '• При отклонении можно подать новую заявку в тот же день',
+            False,
         ),
-        inline=False
+    ),
+    footer='Нажмите кнопку ниже, чтобы подать заявку • {time}',
+)
+
+# Карточка заявки в канале; статус — последнее поле
+REQUEST_CARD = EmbedTemplate(
+    '🧳 Заявка на отгул',
+    discord.Color.blue(),
+    fields=(
+        ('👤 Заявитель', '<@{user_id}> ({username})', False),
+        ('🏷️ Статик', '{static}', True),
+        ('📅 Дата', '{date}', True),
+        ('⏰ Время', '{time} ({duration})', True),
+        ('✏️ Причина', '{reason}', False),
+        ('🏛️ Подразделение', '{department}', False),
+        ('📢 Статус:', '{status}', False),
+    ),
+    footer='ID запроса: #{id}',
+)
+
+
+def card_status(request):
+    """Значение поля статуса и цвет карточки заявки"""
+    status = request['status']
+    moderator_name = request.get('moderator_name')
+    if status == 'approved':
+        return f'✅ Одобрено\n👤 Одобрил: {moderator_name}', discord.Color.green()
+    if status == 'rejected':
+        return f'❌ Отклонено\n👤 Отклонил: {moderator_name}', discord.Color.red()
+    if status == 'expired':
+        return '⌛ Время заявки истекло', discord.Color.light_grey()
+    return '⏳ Ожидает рассмотрения', discord.Color.blue()
+
+
+def render_request_card(request):
+    """Карточка заявки по ее текущему состоянию; сообщение с прошлой версией карточки не нужно"""
+    status_value, color = card_status(request)
+    extra_fields = ()
+    if request['status'] == 'rejected' and request.get('rejection_reason'):
+        extra_fields = (('Причина отклонения', request['rejection_reason'], False),)
+    return REQUEST_CARD.render(
+        color=color,
+        timestamp=datetime.fromtimestamp(request.created_at) if request.created_at else None,
+        extra_fields=extra_fields,
+        id=request['id'],
+        user_id=request['user_id'],
+        username=request['username'],
+        static=request.get('static'),
+        date=request['date'],
+        time=request.get('time'),
+        duration=request.get('duration'),
+        reason=request.get('reason'),
+        department=request.get('department') or Department.GIBDD.value,
+        status=status_value,
     )
+
+
+class SubmitView(discord.ui.View):
+    """Кнопка подачи заявки под панелью /инфо_отгулы
+
+    Один экземпляр регистрируется в setup_hook; custom_id постоянный, поэтому
+    кнопка на уже опубликованной панели работает и после перезапуска бота.
+    """
+
+    def __init__(self):
+        super().__init__(timeout=None)
+
+    @discord.ui.button(label='Подать заявку на отгул', style=discord.ButtonStyle.success, emoji='✈️', custom_id='otgul_submit')
+    @deadline_aware(defer=False)
+    async def submit_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.send_modal(OtgulModal())
+
+
+@bot.tree.command(name='инфо_отгулы', description='Показать информацию о системе отгулов (для модераторов)')
+@deadline_aware()
+async def info_otguls(interaction: discord.Interaction):
+    """Показать информационное сообщение о системе отгулов"""
+    if not can_moderate(interaction.user):
+        await respond(interaction, '❌ У вас нет прав для использования этой команды', ephemeral=True)
+        return
     
-    current_time = datetime.now().strftime('%d.%m.%Y %H:%M')
-    embed.set_footer(text=f'Нажмите кнопку ниже, чтобы подать заявку • {current_time}')
-    
-    class SubmitButton(discord.ui.Button):
-        def __init__(self):
-            super().__init__(label='Подать заявку на отгул', style=discord.ButtonStyle.success, emoji='✈️')
-        
-        async def callback(self, interaction: discord.Interaction):
-            modal = OtgulModal()
-            await interaction.response.send_modal(modal)
-    
-    submit_button = SubmitButton()
-    
-    view = discord.ui.View()
-    view.add_item(submit_button)
-    
-    await interaction.response.send_message(embed=embed, view=view)
+    now = datetime.now()
+    embed = INFO_PANEL.render(timestamp=now, time=now.strftime('%d.%m.%Y %H:%M'))
+    await respond(interaction, embed=embed, view=bot.submit_view)
 
 @bot.tree.command(name='отгул', description='Запросить отгул (через модальное окно)')
+@deadline_aware(defer=False)
 async def otgul_modal_command(interaction: discord.Interaction):
     """Команда для открытия модального окна заявки на отгул"""
     modal = OtgulModal()
@@ -290,135 +3000,172 @@ class OtgulModal(discord.ui.Modal, title='🧳 Заявка на отгул'):
         max_length=200
     )
     
+    # Автоматический defer скрытый: до конца проверок ответом может оказаться сообщение об ошибке
+    @deadline_aware(ephemeral=True)
     async def on_submit(self, interaction: discord.Interaction):
         user = interaction.user
         username = user.display_name or user.name
         
         today = datetime.now().strftime('%d.%m.%Y')
         
-        if has_today_request(user.id):
-            await interaction.response.send_message(
+        if has_today_request(user.id, interaction.guild_id):
+            await respond(
+                interaction,
                 '❌ У вас уже есть активная заявка на сегодня! Можно подать только одну заявку в день.',
                 ephemeral=True
             )
             return
         
-        time_str, duration_str, error = parse_time_duration(self.время.value)
-        if error:
-            await interaction.response.send_message(f'❌ {error}', ephemeral=True)
+        try:
+            window = TimeWindow.parse(self.время.value).check_duration()
+        except ValueError as e:
+            await respond(interaction, f'❌ {e}', ephemeral=True)
             return
         
-        if not is_future_time(self.время.value):
-            await interaction.response.send_message(
+        if not window.starts_after(datetime.now()):
+            await respond(
+                interaction,
                 '❌ Время должно быть в будущем относительно текущего момента!',
                 ephemeral=True
             )
             return
         
-        request = add_request(
+        if OTGUL_MAX_CONCURRENT and store.max_concurrent(today, 'ГИБДД', window, interaction.guild_id) >= OTGUL_MAX_CONCURRENT:
+            await respond(
+                interaction,
+                f'❌ На это время уже оформлено максимальное число отгулов ({OTGUL_MAX_CONCURRENT}). '
+                'Выберите другое время.',
+                ephemeral=True
+            )
+            return
+        
+        time_str, duration_str = str(window), window.duration_text()
+        
+        # Заявка попадает в хранилище сразу после проверок, без await между ними: иначе
+        # параллельная отправка формы обошла бы правило одной заявки в день и лимит отгулов
+        request = create_request(
             str(user.id),
             self.имя_фамилия.value,
             today,
             time=time_str,
             duration=duration_str,
             static=self.статик.value,
-            reason=self.причина.value
-        )
-        
-        embed = discord.Embed(
-            title='🧳 Заявка на отгул',
-            color=discord.Color.blue(),
-            timestamp=datetime.now()
-        )
-        
-        embed.add_field(
-            name='👤 Заявитель',
-            value=f"{user.mention} ({self.имя_фамилия.value})",
-            inline=False
+            reason=self.причина.value,
+            guild_id=interaction.guild_id
         )
+        # Проверки пройдены: если запись на диск затянется, ответ откладывается уже публично
+        guard = interaction.extras.get('deadline')
+        hidden = guard.publish() if guard is not None else False
+        await store.persist()
         
-        embed.add_field(name='🏷️ Статик', value=self.статик.value, inline=True)
-        embed.add_field(name='📅 Дата', value=today, inline=True)
-        embed.add_field(name='⏰ Время', value=f"{time_str} ({duration_str})", inline=True)
-        embed.add_field(name='✏️ Причина', value=self.причина.value, inline=False)
-        embed.add_field(name='🏛️ Подразделение', value='ГИБДД', inline=False)
-        embed.add_field(name='📢 Статус:', value='⏳ Ожидает рассмотрения', inline=False)
-        
-        embed.set_footer(text=f'ID запроса: #{request["id"]}')
+        embed = render_request_card(request)
         
         view = OtgulButtonsView(request["id"])
         
         mentions = ""
         if interaction.guild:
-            role_names = [
-                "Начальник УГИБДД",
-                "Зам. Нач. УГИБДД",
-                "Начальник ЦППС",
-                "Зам. Начальника ЦППС"
-            ]
-            for role_name in role_names:
-                role = discord.utils.get(interaction.guild.roles, name=role_name)
-                if role:
-                    mentions += f"{role.mention} "
-        
-        await interaction.response.send_message(
-            content=mentions if mentions else None,
-            embed=embed,
-            view=view
+            mentions = get_guild_policy(interaction.guild).mentions
+        
+        if hidden:
+            # Ответ был скрыто отложен еще до проверок (например, пока заявки читались с диска),
+            # поэтому карточка публикуется в канал отдельным сообщением
+            message = await interaction.channel.send(content=mentions if mentions else None, embed=embed, view=view)
+            await respond(interaction, f'✅ Заявка #{request["id"]} отправлена', ephemeral=True)
+        else:
+            await respond(
+                interaction,
+                content=mentions if mentions else None,
+                embed=embed,
+                view=view
+            )
+            message = await interaction.original_response()
+        
+        # Запоминаем карточку, чтобы отключить ее кнопки, когда время заявки истечет
+        store.update(request['id'], channel_id=str(message.channel.id), message_id=str(message.id))
+        expiry_scheduler.schedule(request)
+
+def decision_message(request, moderator_name):
+    """Текст личного сообщения пользователю о решении по заявке"""
+    if request['status'] == 'approved':
+        return f'✅ Ваш запрос на отгул #{request["id"]} был одобрен модератором {moderator_name}!'
+    message = f'❌ Ваш запрос на отгул #{request["id"]} был отклонен модератором {moderator_name}.'
+    if request.get('rejection_reason'):
+        message += f'\nПричина: {request["rejection_reason"]}'
+    return message
+
+async def decide_requests(request_ids, status, moderator, reason=None):
+    """Рассматривает несколько заявок сразу: одна запись в хранилище и одна пачка уведомлений
+
+    Возвращает заявки, которые удалось перевести из pending; остальные уже
+    рассмотрел кто-то другой.
+    """
+    moderator_name = moderator.display_name or moderator.name
+    changes = status_changes(status, str(moderator.id), moderator_name, reason)
+    decided = [
+        request for request in (store.transition(request_id, 'pending', **changes) for request_id in request_ids)
+        if request
+    ]
+    if not decided:
+        return decided
+    await store.persist()
+    await notifier.enqueue_many(
+        [(request['user_id'], decision_message(request, moderator_name), request['id']) for request in decided]
+    )
+    return decided
+
+async def refresh_request_cards(requests):
+    """Обновляет карточки рассмотренных заявок одной пачкой запросов"""
+    results = await asyncio.gather(*(update_request_card(bot, request) for request in requests), return_exceptions=True)
+    for request, result in zip(requests, results):
+        if isinstance(result, Exception):
+            log_error('card_update', f'⚠️ Не удалось обновить карточку заявки #{request["id"]}: {result}', result, request_id=request['id'])
+
+# Кнопки заявки
+class OtgulActionButton(discord.ui.DynamicItem[discord.ui.Button], template=r'(?P<action>approve|reject|delete)_(?P<id>[0-9]+)'):
+    """Кнопка заявки; один обработчик на все заявки, ID берется из custom_id"""
+
+    STYLES = {
+        'approve': ('Одобрить', discord.ButtonStyle.success, '✅'),
+        'reject': ('Отклонить', discord.ButtonStyle.danger, '❌'),
+        'delete': ('Удалить', discord.ButtonStyle.secondary, '🗑️'),
+    }
+
+    def __init__(self, action, request_id, disabled=False):
+        label, style, emoji = self.STYLES[action]
+        super().__init__(
+            discord.ui.Button(
+                label=label,
+                style=style,
+                emoji=emoji,
+                custom_id=f'{action}_{request_id}',
+                disabled=disabled
+            )
         )
+        self.action = action
+        self.request_id = request_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match: re.Match[str]):
+        return cls(match['action'], int(match['id']))
+
+    async def callback(self, interaction: discord.Interaction):
+        view = OtgulButtonsView(self.request_id)
+        await getattr(view, f'handle_{self.action}')(interaction)
 
 # View с кнопками для заявки
 class OtgulButtonsView(discord.ui.View):
-    def __init__(self, request_id):
+    def __init__(self, request_id, disabled=False):
         super().__init__(timeout=None)
         self.request_id = request_id
         
-        class ApproveButton(discord.ui.Button):
-            def __init__(self, view_instance, request_id):
-                super().__init__(
-                    label='Одобрить', 
-                    style=discord.ButtonStyle.success, 
-                    emoji='✅',
-                    custom_id=f'approve_{request_id}'
-                )
-                self.view_instance = view_instance
-            
-            async def callback(self, interaction: discord.Interaction):
-                await self.view_instance.handle_approve(interaction)
-        
-        class RejectButton(discord.ui.Button):
-            def __init__(self, view_instance, request_id):
-                super().__init__(
-                    label='Отклонить', 
-                    style=discord.ButtonStyle.danger, 
-                    emoji='❌',
-                    custom_id=f'reject_{request_id}'
-                )
-                self.view_instance = view_instance
-            
-            async def callback(self, interaction: discord.Interaction):
-                await self.view_instance.handle_reject(interaction)
-        
-        class DeleteButton(discord.ui.Button):
-            def __init__(self, view_instance, request_id):
-                super().__init__(
-                    label='Удалить', 
-                    style=discord.ButtonStyle.secondary, 
-                    emoji='🗑️',
-                    custom_id=f'delete_{request_id}'
-                )
-                self.view_instance = view_instance
-            
-            async def callback(self, interaction: discord.Interaction):
-                await self.view_instance.handle_delete(interaction)
-        
-        self.add_item(ApproveButton(self, request_id))
-        self.add_item(RejectButton(self, request_id))
-        self.add_item(DeleteButton(self, request_id))
+        for action in ('approve', 'reject', 'delete'):
+            self.add_item(OtgulActionButton(action, request_id, disabled))
     
+    @deadline_aware(update=True)
     async def handle_approve(self, interaction: discord.Interaction):
         if not can_moderate(interaction.user):
-            await interaction.response.send_message(
+            await respond(
+                interaction,
                 '❌ У вас нет прав для одобрения заявок.\n'
                 'Требуется право "Управление сообщениями" или одна из ролей модератора.',
                 ephemeral=True
@@ -427,46 +3174,44 @@ class OtgulButtonsView(discord.ui.View):
         
         request = get_request_by_id(self.request_id)
         if not request:
-            await interaction.response.send_message('❌ Заявка не найдена', ephemeral=True)
+            await respond(interaction, '❌ Заявка не найдена', ephemeral=True)
             return
         
         if request['status'] != 'pending':
-            await interaction.response.send_message('❌ Эта заявка уже обработана', ephemeral=True)
+            await respond(interaction, '❌ Эта заявка уже обработана', ephemeral=True)
             return
         
         # Получаем имя модератора
         moderator = interaction.user
         moderator_name = moderator.display_name or moderator.name
         
-        # Обновляем статус с информацией о модераторе
-        update_request_status(
+        # Обновляем статус с информацией о модераторе, если заявку еще никто не обработал
+        request = await transition_request(
             self.request_id, 
             'approved', 
             str(moderator.id),
             moderator_name
         )
+        if not request:
+            await respond(interaction, '❌ Эта заявка уже обработана', ephemeral=True)
+            return
         
-        # Обновляем embed
-        embed = interaction.message.embeds[0]
-        embed.set_field_at(-1, name='📢 Статус:', value=f'✅ Одобрено\n👤 Одобрил: {moderator_name}', inline=False)
-        embed.color = discord.Color.green()
+        # Карточка перерисовывается по заявке, уже с новым статусом
+        embed = render_request_card(request)
         
         # Отключаем кнопки
-        for item in self.children:
-            item.disabled = True
+        view = OtgulButtonsView(self.request_id, disabled=True)
         
-        await interaction.response.edit_message(embed=embed, view=self)
+        await respond_edit(interaction, embed=embed, view=view)
         
-        # Уведомляем пользователя
-        try:
-            user = await bot.fetch_user(int(request['user_id']))
-            await user.send(f'✅ Ваш запрос на отгул #{self.request_id} был одобрен модератором {moderator_name}!')
-        except:
-            pass
+        # Уведомляем пользователя в фоне
+        await notifier.enqueue(request['user_id'], decision_message(request, moderator_name), self.request_id)
     
+    @deadline_aware(defer=False)
     async def handle_reject(self, interaction: discord.Interaction):
         if not can_moderate(interaction.user):
-            await interaction.response.send_message(
+            await respond(
+                interaction,
                 '❌ У вас нет прав для отклонения заявок.\n'
                 'Требуется право "Управление сообщениями" или одна из ролей модератора.',
                 ephemeral=True
@@ -475,35 +3220,37 @@ class OtgulButtonsView(discord.ui.View):
         
         request = get_request_by_id(self.request_id)
         if not request:
-            await interaction.response.send_message('❌ Заявка не найдена', ephemeral=True)
+            await respond(interaction, '❌ Заявка не найдена', ephemeral=True)
             return
         
         if request['status'] != 'pending':
-            await interaction.response.send_message('❌ Эта заявка уже обработана', ephemeral=True)
+            await respond(interaction, '❌ Эта заявка уже обработана', ephemeral=True)
             return
         
         modal = RejectModal(self.request_id)
         await interaction.response.send_modal(modal)
     
+    @deadline_aware(ephemeral=True)
     async def handle_delete(self, interaction: discord.Interaction):
         request = get_request_by_id(self.request_id)
         if not request:
-            await interaction.response.send_message('❌ Заявка не найдена', ephemeral=True)
+            await respond(interaction, '❌ Заявка не найдена', ephemeral=True)
             return
         
         if str(interaction.user.id) != request['user_id'] and not interaction.user.guild_permissions.manage_messages:
-            await interaction.response.send_message('❌ Вы можете удалить только свою заявку', ephemeral=True)
+            await respond(interaction, '❌ Вы можете удалить только свою заявку', ephemeral=True)
             return
         
         if request['status'] != 'pending':
-            await interaction.response.send_message('❌ Можно удалить только заявки, ожидающие рассмотрения', ephemeral=True)
+            await respond(interaction, '❌ Можно удалить только заявки, ожидающие рассмотрения', ephemeral=True)
             return
         
-        requests = load_requests()
-        requests = [r for r in requests if r['id'] != self.request_id]
-        save_requests(requests)
+        # Заявка остается в истории со статусом deleted, чтобы ее ID не был выдан повторно
+        if not await transition_request(self.request_id, 'deleted'):
+            await respond(interaction, '❌ Эта заявка уже обработана', ephemeral=True)
+            return
         
-        await interaction.response.send_message('✅ Заявка удалена', ephemeral=True)
+        await respond(interaction, '✅ Заявка удалена', ephemeral=True)
         await interaction.message.delete()
 
 # Модальное окно для причины отклонения
@@ -520,88 +3267,509 @@ class RejectModal(discord.ui.Modal, title='❌ Отклонение заявки
         max_length=200
     )
     
+    @deadline_aware(update=True)
     async def on_submit(self, interaction: discord.Interaction):
         request = get_request_by_id(self.request_id)
         if not request:
-            await interaction.response.send_message('❌ Заявка не найдена', ephemeral=True)
+            await respond(interaction, '❌ Заявка не найдена', ephemeral=True)
             return
         
         # Получаем имя модератора
         moderator = interaction.user
         moderator_name = moderator.display_name or moderator.name
         
-        update_request_status(
+        request = await transition_request(
             self.request_id, 
             'rejected', 
             str(moderator.id),
             moderator_name,
             self.причина.value or None
         )
+        if not request:
+            await respond(interaction, '❌ Эта заявка уже обработана', ephemeral=True)
+            return
         
-        # Обновляем embed
-        embed = interaction.message.embeds[0]
-        embed.set_field_at(-1, name='📢 Статус:', value=f'❌ Отклонено\n👤 Отклонил: {moderator_name}', inline=False)
-        embed.color = discord.Color.red()
-        if self.причина.value:
-            embed.add_field(name='Причина отклонения', value=self.причина.value, inline=False)
+        # Карточка перерисовывается по заявке, уже с новым статусом и причиной
+        embed = render_request_card(request)
         
         # Отключаем кнопки
-        view = OtgulButtonsView(self.request_id)
-        for item in view.children:
-            item.disabled = True
+        view = OtgulButtonsView(self.request_id, disabled=True)
         
-        await interaction.response.edit_message(embed=embed, view=view)
+        await respond_edit(interaction, embed=embed, view=view)
         
-        # Уведомляем пользователя
-        try:
-            user = await bot.fetch_user(int(request['user_id']))
-            message = f'❌ Ваш запрос на отгул #{self.request_id} был отклонен модератором {moderator_name}.'
-            if self.причина.value:
-                message += f'\nПричина: {self.причина.value}'
-            await user.send(message)
-        except:
-            pass
+        # Уведомляем пользователя в фоне
+        await notifier.enqueue(request['user_id'], decision_message(request, moderator_name), self.request_id)
+
+# Заявок на одной странице /мои_отгулы
+HISTORY_PAGE_SIZE = 10
+
+def format_history_field(req):
+    """Строка истории заявок: заголовок и описание поля embed"""
+    status_emoji = {
+        'approved': '✅',
+        'rejected': '❌',
+        'deleted': '🗑️',
+        'expired': '⌛'
+    }.get(req['status'], '⏳')
+    status_text = {
+        'pending': 'Ожидает',
+        'approved': 'Одобрен',
+        'rejected': 'Отклонен',
+        'deleted': 'Удален',
+        'expired': 'Истек'
+    }.get(req['status'], req['status'])
+    
+    info = f'Статус: {status_text}'
+    if req['status'] == 'approved' and req.get('moderator_name'):
+        info += f'\nОдобрил: {req["moderator_name"]}'
+    elif req['status'] == 'rejected' and req.get('moderator_name'):
+        info += f'\nОтклонил: {req["moderator_name"]}'
+    if req.get('notification_status') == 'failed':
+        info += '\nУведомление в личные сообщения не доставлено'
+    
+    return f'{status_emoji} Запрос #{req["id"]} - {req["date"]}', info
+
+# Постраничный просмотр истории заявок
+class HistoryView(discord.ui.View):
+    """Страницы истории от новых заявок к старым; курсор — граничный ID страницы"""
+
+    def __init__(self, owner_id, index, page_size=HISTORY_PAGE_SIZE):
+        super().__init__(timeout=300)
+        self.owner_id = owner_id
+        self.index = index
+        self.ids = [request_id for request_id, _ in index]
+        self.page_size = page_size
+        # Страница — срез index[start:end], показывается в обратном порядке
+        self.end = len(index)
+        self.start = max(0, self.end - page_size)
+    
+    def older(self, before_id):
+        self.end = bisect.bisect_left(self.ids, before_id)
+        self.start = max(0, self.end - self.page_size)
+    
+    def newer(self, after_id):
+        self.start = bisect.bisect_right(self.ids, after_id)
+        self.end = min(len(self.ids), self.start + self.page_size)
+    
+    async def render(self):
+        page = await store.load_entries(self.index[self.start:self.end])
+        total = len(self.index)
+        pages = max(1, -(-total // self.page_size))
+        current = -(-(total - self.end) // self.page_size) + 1
+        
+        embed = discord.Embed(
+            title=f'📋 Ваши запросы на отгул ({total})',
+            color=discord.Color.green()
+        )
+        for req in reversed(page):
+            name, value = format_history_field(req)
+            embed.add_field(name=name, value=value, inline=False)
+        embed.set_footer(text=f'Страница {current} из {pages}')
+        
+        self.newer_button.disabled = self.end >= total
+        self.older_button.disabled = self.start <= 0
+        return embed
+    
+    async def interaction_check(self, interaction: discord.Interaction):
+        return interaction.user.id == self.owner_id
+    
+    @discord.ui.button(label='Новее', style=discord.ButtonStyle.secondary, emoji='◀️')
+    @deadline_aware(update=True)
+    async def newer_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.newer(self.ids[self.end - 1])
+        await respond_edit(interaction, embed=await self.render(), view=self)
+    
+    @discord.ui.button(label='Старее', style=discord.ButtonStyle.secondary, emoji='▶️')
+    @deadline_aware(update=True)
+    async def older_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.older(self.ids[self.start])
+        await respond_edit(interaction, embed=await self.render(), view=self)
 
 @bot.tree.command(name='мои_отгулы', description='Показать мои запросы на отгул')
-async def my_otguls(interaction: discord.Interaction):
-    """Показать все запросы отгула пользователя"""
-    user_id = str(interaction.user.id)
-    requests = load_requests()
-    user_requests = [r for r in requests if r['user_id'] == user_id]
-    
-    if not user_requests:
-        await interaction.response.send_message('❌ У вас нет запросов на отгул', ephemeral=True)
+@app_commands.describe(статус='Показать только заявки с этим статусом', дата='Дата (ДД.ММ.ГГГГ) или месяц (ММ.ГГГГ)')
+@app_commands.choices(статус=[
+    app_commands.Choice(name='Ожидает', value='pending'),
+    app_commands.Choice(name='Одобрен', value='approved'),
+    app_commands.Choice(name='Отклонен', value='rejected'),
+    app_commands.Choice(name='Удален', value='deleted'),
+    app_commands.Choice(name='Истек', value='expired'),
+])
+@deadline_aware(ephemeral=True)
+async def my_otguls(interaction: discord.Interaction, статус: Optional[str] = None, дата: Optional[str] = None):
+    """Показать запросы отгула пользователя постранично"""
+    index = await store.history_index(interaction.user.id, статус, дата)
+    
+    if not index:
+        await respond(interaction, '❌ У вас нет запросов на отгул', ephemeral=True)
+        return
+    
+    view = HistoryView(interaction.user.id, index)
+    await respond(interaction, embed=await view.render(), view=view, ephemeral=True)
+
+@bot.tree.command(name='кто_в_отгуле', description='Кто отсутствует в указанное время (для модераторов)')
+@app_commands.describe(
+    время='Интервал ЧЧ:ММ - ЧЧ:ММ',
+    дата='Дата ДД.ММ.ГГГГ (по умолчанию сегодня)',
+    подразделение='Подразделение (по умолчанию ГИБДД)'
+)
+@deadline_aware(ephemeral=True)
+async def who_is_off(interaction: discord.Interaction, время: str, дата: Optional[str] = None, подразделение: Optional[str] = None):
+    """Показать ожидающие и одобренные отгулы, пересекающиеся с интервалом"""
+    if not can_moderate(interaction.user):
+        await respond(interaction, '❌ У вас нет прав для использования этой команды', ephemeral=True)
+        return
+    
+    try:
+        window = TimeWindow.parse(время)
+    except ValueError as e:
+        await respond(interaction, f'❌ {e}', ephemeral=True)
         return
     
+    date = дата or datetime.now().strftime('%d.%m.%Y')
+    department = подразделение or 'ГИБДД'
+    requests = store.overlapping(date, department, window, interaction.guild_id)
+    
     embed = discord.Embed(
-        title=f'📋 Ваши запросы на отгул ({len(user_requests)})',
-        color=discord.Color.green()
+        title=f'🕒 В отгуле {date} {window} ({department}): {len(requests)}',
+        color=discord.Color.blue()
     )
+    for req in requests[:25]:
+        status = '✅ Одобрен' if req['status'] == 'approved' else '⏳ Ожидает'
+        embed.add_field(
+            name=f'#{req["id"]} {req["username"]} — {req["time"]}',
+            value=f'<@{req["user_id"]}> • {status}',
+            inline=False
+        )
+    if not requests:
+        embed.description = 'Никто не отсутствует в это время'
     
-    for req in user_requests[-10:]:
-        status_emoji = '✅' if req['status'] == 'approved' else '❌' if req['status'] == 'rejected' else '⏳'
-        status_text = {
-            'pending': 'Ожидает',
-            'approved': 'Одобрен',
-            'rejected': 'Отклонен'
-        }.get(req['status'], req['status'])
-        
-        info = f'Статус: {status_text}'
-        if req['status'] == 'approved' and req.get('moderator_name'):
-            info += f'\nОдобрил: {req["moderator_name"]}'
-        elif req['status'] == 'rejected' and req.get('moderator_name'):
-            info += f'\nОтклонил: {req["moderator_name"]}'
-        
+    await respond(interaction, embed=embed, ephemeral=True)
+
+def format_stats(bucket, month):
+    """Краткая сводка по счетчикам пользователя или подразделения"""
+    return (
+        f'Всего заявок: **{bucket["total"]}** (за {month}: {bucket["months"].get(month, 0)})\n'
+        f'Одобрено: {bucket["approved"]} • Отклонено: {bucket["rejected"]} • '
+        f'Процент одобрения: {approval_rate(bucket)}%\n'
+        f'Всего в отгуле: {bucket["minutes"] // 60} ч {bucket["minutes"] % 60} мин'
+    )
+
+@bot.tree.command(name='статистика_отгулов', description='Статистика заявок на отгул (для модераторов)')
+@app_commands.describe(
+    пользователь='Показать статистику сотрудника',
+    подразделение='Подразделение (по умолчанию ГИБДД)',
+    пересчитать='Пересчитать счетчики по всей истории'
+)
+@deadline_aware(ephemeral=True)
+async def otgul_stats(
+    interaction: discord.Interaction,
+    пользователь: Optional[discord.Member] = None,
+    подразделение: Optional[str] = None,
+    пересчитать: bool = False
+):
+    """Показать статистику по сотруднику, подразделению и модераторам"""
+    if not can_moderate(interaction.user):
+        await respond(interaction, '❌ У вас нет прав для использования этой команды', ephemeral=True)
+        return
+    
+    if пересчитать:
+        await defer_response(interaction, ephemeral=True)
+        await store.rebuild_stats()
+    
+    month = datetime.now().strftime('%Y-%m')
+    department = подразделение or 'ГИБДД'
+    embed = discord.Embed(title='📊 Статистика отгулов', color=discord.Color.blue())
+    
+    if пользователь:
+        bucket = store.stats.get('users', пользователь.id, interaction.guild_id)
+        embed.add_field(
+            name=f'👤 {пользователь.display_name}',
+            value=format_stats(bucket, month) if bucket else 'Заявок нет',
+            inline=False
+        )
+    
+    bucket = store.stats.get('departments', department, interaction.guild_id)
+    embed.add_field(
+        name=f'🏛️ {department}',
+        value=format_stats(bucket, month) if bucket else 'Заявок нет',
+        inline=False
+    )
+    
+    moderators = sorted(
+        store.stats.moderators(interaction.guild_id).items(),
+        key=lambda item: item[1]['approved'] + item[1]['rejected'],
+        reverse=True
+    )[:10]
+    if moderators:
         embed.add_field(
-            name=f'{status_emoji} Запрос #{req["id"]} - {req["date"]}',
-            value=info,
+            name='🛡️ Модераторы',
+            value='\n'.join(
+                f'{bucket.get("name", moderator_id)}: ✅ {bucket["approved"]} • ❌ {bucket["rejected"]}'
+                for moderator_id, bucket in moderators
+            ),
             inline=False
         )
     
-    await interaction.response.send_message(embed=embed, ephemeral=True)
+    await respond(interaction, embed=embed, ephemeral=True)
+
+@bot.tree.command(name='экспорт_отгулов', description='Выгрузить историю заявок в файл (для модераторов)')
+@app_commands.describe(
+    с='Начальная дата ДД.ММ.ГГГГ',
+    по='Конечная дата ДД.ММ.ГГГГ',
+    формат='Формат файла',
+    пользователь='Только заявки этого сотрудника',
+    статус='Только заявки с этим статусом',
+    модератор='Только заявки, рассмотренные этим модератором'
+)
+@app_commands.choices(
+    формат=[
+        app_commands.Choice(name='CSV', value='csv'),
+        app_commands.Choice(name='JSONL', value='jsonl'),
+    ],
+    статус=[
+        app_commands.Choice(name='Ожидает', value='pending'),
+        app_commands.Choice(name='Одобрен', value='approved'),
+        app_commands.Choice(name='Отклонен', value='rejected'),
+        app_commands.Choice(name='Удален', value='deleted'),
+        app_commands.Choice(name='Истек', value='expired'),
+    ]
+)
+@deadline_aware(ephemeral=True)
+async def export_otguls(
+    interaction: discord.Interaction,
+    с: str,
+    по: str,
+    формат: str = 'csv',
+    пользователь: Optional[discord.Member] = None,
+    статус: Optional[str] = None,
+    модератор: Optional[discord.Member] = None
+):
+    """Выгрузить заявки за период в CSV или JSONL"""
+    if not can_moderate(interaction.user):
+        await respond(interaction, '❌ У вас нет прав для использования этой команды', ephemeral=True)
+        return
+    
+    try:
+        date_from, date_to = parse_date(с), parse_date(по)
+    except ValueError:
+        await respond(interaction, '❌ Неверный формат даты. Используйте: ДД.ММ.ГГГГ', ephemeral=True)
+        return
+    
+    await defer_response(interaction, ephemeral=True)
+    
+    requests = iter_export_requests(
+        store.snapshot(),
+        store.archive,
+        date_from,
+        date_to,
+        user_id=пользователь.id if пользователь else None,
+        status=статус,
+        moderator_id=модератор.id if модератор else None,
+        guild_id=interaction.guild_id
+    )
+    # Файл собирается построчно: в памяти до 1 МБ, дальше на диске
+    fp = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    count = await asyncio.to_thread(write_export, requests, формат, fp)
+    
+    limit = interaction.guild.filesize_limit if interaction.guild else 10 * 1024 * 1024
+    if fp.tell() > limit:
+        fp.close()
+        await interaction.followup.send('❌ Файл выгрузки слишком большой, уменьшите период', ephemeral=True)
+        return
+    
+    fp.seek(0)
+    filename = f'otgul_{date_from:%Y%m%d}_{date_to:%Y%m%d}.{формат}'
+    await interaction.followup.send(
+        f'📤 Выгружено заявок: {count}',
+        file=discord.File(fp, filename=filename),
+        ephemeral=True
+    )
+
+# Заявок на одной странице /очередь_отгулов (не больше 25 — ограничение списка выбора)
+QUEUE_PAGE_SIZE = 10
+
+# Очередь ожидающих заявок для модераторов
+class ReviewQueueView(discord.ui.View):
+    """Постраничный список ожидающих заявок с массовым одобрением и отклонением"""
+
+    def __init__(self, moderator_id, guild_id=None, page_size=QUEUE_PAGE_SIZE):
+        super().__init__(timeout=600)
+        self.moderator_id = moderator_id
+        self.page_size = page_size
+        self.ids = [r['id'] for r in store.pending(guild_id)]
+        self.offset = 0
+        self.selected = set()
+        self.summary = None
+        
+        self.select = discord.ui.Select(placeholder='Выберите заявки', min_values=0, row=0)
+        self.select.callback = self.on_select
+        self.add_item(self.select)
+    
+    def page_requests(self):
+        page = []
+        for request_id in self.ids[self.offset:self.offset + self.page_size]:
+            request = store.get(request_id)
+            if request and request['status'] == 'pending':
+                page.append(request)
+        return page
+    
+    def render(self):
+        # Заявки, рассмотренные другими модераторами, пропадают из очереди
+        self.ids = [i for i in self.ids if (r := store.get(i)) and r['status'] == 'pending']
+        self.selected &= set(self.ids)
+        if self.offset >= len(self.ids):
+            self.offset = max(0, (len(self.ids) - 1) // self.page_size * self.page_size)
+        page = self.page_requests()
+        
+        embed = discord.Embed(
+            title=f'🗂️ Очередь заявок на отгул ({len(self.ids)})',
+            description=self.summary,
+            color=discord.Color.blue()
+        )
+        for req in page:
+            mark = '☑️' if req['id'] in self.selected else '▫️'
+            embed.add_field(
+                name=f'{mark} Запрос #{req["id"]} - {req["date"]} {req.get("time") or ""}',
+                value=f'👤 {req["username"]} (<@{req["user_id"]}>)\n✏️ {req.get("reason") or "—"}',
+                inline=False
+            )
+        if not page:
+            embed.description = (self.summary + '\n' if self.summary else '') + '✅ Ожидающих заявок нет'
+        pages = max(1, -(-len(self.ids) // self.page_size))
+        embed.set_footer(text=f'Страница {self.offset // self.page_size + 1} из {pages} • Выбрано: {len(self.selected)}')
+        
+        self.select.options = [
+            discord.SelectOption(
+                label=f'#{req["id"]} {req["username"]}'[:100],
+                description=f'{req["date"]} {req.get("time") or ""}'[:100],
+                value=str(req['id']),
+                default=req['id'] in self.selected
+            )
+            for req in page
+        ] or [discord.SelectOption(label='Нет заявок', value='0')]
+        self.select.max_values = max(1, len(page))
+        self.select.disabled = not page
+        self.prev_button.disabled = self.offset == 0
+        self.next_button.disabled = self.offset + self.page_size >= len(self.ids)
+        self.approve_button.disabled = self.reject_button.disabled = not self.selected
+        return embed
+    
+    async def interaction_check(self, interaction: discord.Interaction):
+        return interaction.user.id == self.moderator_id and can_moderate(interaction.user)
+    
+    @deadline_aware(update=True)
+    async def on_select(self, interaction: discord.Interaction):
+        page_ids = {r['id'] for r in self.page_requests()}
+        self.selected = (self.selected - page_ids) | {int(v) for v in self.select.values if v != '0'}
+        await respond_edit(interaction, embed=self.render(), view=self)
+    
+    async def apply(self, interaction: discord.Interaction, status, reason=None):
+        """Рассматривает выбранные заявки и обновляет очередь"""
+        decided = await decide_requests(sorted(self.selected), status, interaction.user, reason)
+        skipped = len(self.selected) - len(decided)
+        self.selected.clear()
+        self.summary = f'{"✅ Одобрено" if status == "approved" else "❌ Отклонено"}: {len(decided)}'
+        if skipped:
+            self.summary += f' • уже рассмотрены другими: {skipped}'
+        await respond_edit(interaction, embed=self.render(), view=self)
+        await refresh_request_cards(decided)
+    
+    @discord.ui.button(label='Назад', style=discord.ButtonStyle.secondary, emoji='◀️', row=1)
+    @deadline_aware(update=True)
+    async def prev_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.offset = max(0, self.offset - self.page_size)
+        await respond_edit(interaction, embed=self.render(), view=self)
+    
+    @discord.ui.button(label='Вперед', style=discord.ButtonStyle.secondary, emoji='▶️', row=1)
+    @deadline_aware(update=True)
+    async def next_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.offset += self.page_size
+        await respond_edit(interaction, embed=self.render(), view=self)
+    
+    @discord.ui.button(label='Одобрить выбранные', style=discord.ButtonStyle.success, emoji='✅', row=2)
+    @deadline_aware(update=True)
+    async def approve_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.apply(interaction, 'approved')
+    
+    @discord.ui.button(label='Отклонить выбранные', style=discord.ButtonStyle.danger, emoji='❌', row=2)
+    @deadline_aware(defer=False)
+    async def reject_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.send_modal(BulkRejectModal(self))
+
+# Модальное окно для причины массового отклонения
+class BulkRejectModal(discord.ui.Modal, title='❌ Отклонение выбранных заявок'):
+    def __init__(self, queue_view):
+        super().__init__()
+        self.queue_view = queue_view
+    
+    причина = discord.ui.TextInput(
+        label='Причина отклонения',
+        placeholder='Укажите причину отклонения',
+        required=False,
+        style=discord.TextStyle.paragraph,
+        max_length=200
+    )
+    
+    @deadline_aware(update=True)
+    async def on_submit(self, interaction: discord.Interaction):
+        await self.queue_view.apply(interaction, 'rejected', self.причина.value or None)
+
+@bot.tree.command(name='очередь_отгулов', description='Очередь ожидающих заявок на отгул (для модераторов)')
+@deadline_aware(ephemeral=True)
+async def review_queue(interaction: discord.Interaction):
+    """Показать ожидающие заявки с возможностью рассмотреть несколько сразу"""
+    if not can_moderate(interaction.user):
+        await respond(interaction, '❌ У вас нет прав для использования этой команды', ephemeral=True)
+        return
+    
+    view = ReviewQueueView(interaction.user.id, interaction.guild_id)
+    await respond(interaction, embed=view.render(), view=view, ephemeral=True)
+
+startup_profile.add('module', time.perf_counter() - IMPORTS_DONE)
 
 # Запуск бота
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Discord-бот для заявок на отгул')
+    parser.add_argument('--migrate-sqlite', action='store_true',
+                        help=f'перенести заявки из {OTGUL_FILE} в {OTGUL_DB_FILE} и выйти')
+    parser.add_argument('--force-sync', action='store_true',
+                        help='синхронизировать команды с Discord, даже если они не менялись')
+    parser.add_argument('--export', choices=('csv', 'jsonl'),
+                        help='выгрузить заявки в stdout (или в --output) и выйти')
+    parser.add_argument('--date-from', type=parse_date, help='выгрузка: начальная дата ДД.ММ.ГГГГ')
+    parser.add_argument('--date-to', type=parse_date, help='выгрузка: конечная дата ДД.ММ.ГГГГ')
+    parser.add_argument('--user', help='выгрузка: ID пользователя')
+    parser.add_argument('--status', help='выгрузка: статус заявки')
+    parser.add_argument('--moderator', help='выгрузка: ID модератора')
+    parser.add_argument('--guild', help='выгрузка: ID сервера (и заявки без сервера)')
+    parser.add_argument('--output', help='выгрузка: файл вместо stdout')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='запуститься, вывести время этапов запуска и выйти')
+    args = parser.parse_args()
+    bot.force_sync = args.force_sync
+    bot.profile_startup = args.profile_startup
+    
+    if args.export:
+        store.load()
+        requests = iter_export_requests(
+            store.all_guilds(), store.archive, args.date_from, args.date_to, args.user, args.status, args.moderator,
+            args.guild
+        )
+        if args.output:
+            with open(args.output, 'wb') as f:
+                count = write_export(requests, args.export, f)
+        else:
+            count = write_export(requests, args.export, sys.stdout.buffer)
+            sys.stdout.flush()
+        print(f'✅ Выгружено заявок: {count}', file=sys.stderr)
+        sys.exit(0)
+    
+    if args.migrate_sqlite:
+        count = migrate_json_to_sqlite(journal_path=OTGUL_JOURNAL_FILE)
+        print(f'✅ Перенесено {count} заявок в {OTGUL_DB_FILE}')
+        print('📝 Добавьте OTGUL_STORAGE=sqlite в файл .env')
+        sys.exit(0)
+    
     token = os.getenv('DISCORD_TOKEN')
     
     if not token:
@@ -0,0 +1,571 @@
+"""Нагрузочный прогон обработчиков заявок без Discord и без сети
+
+Настоящие обработчики (OtgulModal.on_submit, OtgulButtonsView.handle_approve /
+handle_reject / handle_delete, RejectModal.on_submit, /мои_отгулы) вызываются с
+поддельными Interaction, сервером, ролями и участниками. Ответы Discord
+заменены локальной заглушкой HTTP с настраиваемой задержкой. Трафик
+генерируется (одновременные заявки, повторные заявки одного сотрудника, гонки
+кликов модераторов и удалений) или
+воспроизводится из файла. В отчете: p50/p99 времени обработчиков и первого
+ответа, задержка цикла событий и нарушения согласованности (двойные решения,
+повторные ID, больше одной ожидающей заявки сотрудника на день, расхождение
+памяти, диска и статистики).
+
+    python loadtest.py --users 300 --rate 100 --moderators 5 --clicks 3
+    python loadtest.py --record traffic.jsonl
+    python loadtest.py --replay traffic.jsonl --storage sqlite
+    python loadtest.py --storage journal --partitioned
+"""
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import discord
+
+bot = None
+_snowflakes = itertools.count(900000000000000000)
+
+
+class FakeRole:
+    def __init__(self, name):
+        self.id = next(_snowflakes)
+        self.name = name
+        self.mention = f'<@&{self.id}>'
+
+
+class FakeGuild:
+    def __init__(self, role_names):
+        self.id = next(_snowflakes)
+        self.name = 'Тестовый сервер'
+        self.roles = [FakeRole(name) for name in role_names]
+
+
+class FakeMember:
+    def __init__(self, guild, name, roles=(), manage_messages=False):
+        self.id = next(_snowflakes)
+        self.name = name
+        self.display_name = name
+        self.mention = f'<@{self.id}>'
+        self.guild = guild
+        self.roles = list(roles)
+        self.guild_permissions = discord.Permissions(manage_messages=manage_messages)
+        self.bot = False
+
+
+class FakeChannel:
+    def __init__(self, http=None):
+        self.id = next(_snowflakes)
+        self.http = http
+        self.sent = []
+
+    async def send(self, content=None, *, embed=None, view=None, **kwargs):
+        await self.http.call('channel.send')
+        message = FakeMessage(self.http, self, content, embed, view)
+        self.sent.append(message)
+        return message
+
+
+class FakeMessage:
+    def __init__(self, http, channel, content=None, embed=None, view=None):
+        self.id = next(_snowflakes)
+        self.http = http
+        self.channel = channel
+        self.content = content
+        self.embeds = [embed] if embed is not None else []
+        self.view = view
+        self.deleted = False
+
+    def apply(self, content=None, embed=None, view=None, **kwargs):
+        if content is not None:
+            self.content = content
+        if embed is not None:
+            self.embeds = [embed]
+        if view is not None:
+            self.view = view
+
+    async def edit(self, **kwargs):
+        await self.http.call('message.edit')
+        self.apply(**kwargs)
+        self.http.card_edited(self)
+        return self
+
+    async def delete(self):
+        await self.http.call('message.delete')
+        self.deleted = True
+        self.http.card_deleted(self)
+
+
+class FakeHTTP:
+    """Заглушка REST API Discord: задержка ответа и учет карточек заявок"""
+
+    def __init__(self, latency, jitter, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.calls = {}
+        self.channel = FakeChannel(self)
+        # Карточка заявки -> ID заявки и число решений, показанных на ней
+        self.cards = {}
+        self.decisions = {}
+        self.deletions = {}
+
+    async def call(self, route):
+        self.calls[route] = self.calls.get(route, 0) + 1
+        await asyncio.sleep(max(0.0, self.rng.gauss(self.latency, self.jitter)))
+
+    def request_of(self, message):
+        return self.cards.get(message.id) if message is not None else None
+
+    def card_edited(self, message):
+        request_id = self.request_of(message)
+        if request_id is not None and message.view is not None and all(getattr(item, 'item', item).disabled for item in message.view.children):
+            self.decisions[request_id] = self.decisions.get(request_id, 0) + 1
+
+    def card_deleted(self, message):
+        request_id = self.request_of(message)
+        if request_id is not None:
+            self.deletions[request_id] = self.deletions.get(request_id, 0) + 1
+
+
+class FakeResponse:
+    """interaction.response поверх FakeHTTP"""
+
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self._type = None
+
+    def is_done(self):
+        return self._type is not None
+
+    def _check(self):
+        if self._type is not None:
+            raise discord.InteractionResponded(self.interaction)
+
+    async def _respond(self, kind, route):
+        self._check()
+        await self.interaction.http.call(route)
+        self._check()
+        self._type = kind
+        self.interaction.acked_at = time.perf_counter()
+
+    async def send_message(self, content=None, *, embed=None, view=None, ephemeral=False, **kwargs):
+        await self._respond('message', 'interaction.send_message')
+        self.interaction.original = FakeMessage(self.interaction.http, self.interaction.http.channel, content, embed, view)
+
+    async def edit_message(self, **kwargs):
+        await self._respond('update', 'interaction.edit_message')
+        self.interaction.message.apply(**kwargs)
+        self.interaction.http.card_edited(self.interaction.message)
+
+    async def defer(self, *, ephemeral=False, thinking=False):
+        await self._respond('thinking' if thinking else 'deferred_update', 'interaction.defer')
+
+    async def send_modal(self, modal):
+        await self._respond('modal', 'interaction.send_modal')
+        self.interaction.modal = modal
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, *, embed=None, view=None, ephemeral=False, **kwargs):
+        interaction = self.interaction
+        await interaction.http.call('followup.send')
+        message = FakeMessage(interaction.http, interaction.http.channel, content, embed, view)
+        # Первый followup после defer с thinking заменяет сообщение «думает...»
+        if interaction.response._type == 'thinking' and interaction.original is None:
+            interaction.original = message
+        return message
+
+
+class FakeInteraction(discord.Interaction):
+    """Interaction без состояния клиента: ответы идут в FakeHTTP"""
+
+    def __init__(self, http, kind, user, guild, message=None):
+        self.http = http
+        self.id = next(_snowflakes)
+        self.type = kind
+        self.user = user
+        self.guild_id = guild.id if guild else None
+        self.message = message
+        self.extras = {}
+        self._fake_guild = guild
+        self._cs_response = FakeResponse(self)
+        self._cs_followup = FakeFollowup(self)
+        self.original = None
+        self.modal = None
+        self.acked_at = None
+        self._fake_channel = None
+
+    @property
+    def guild(self):
+        return self._fake_guild
+
+    @property
+    def channel(self):
+        # Сообщения, отправленные в канал из обработчика, запоминаются для поиска карточки
+        if self._fake_channel is None:
+            self._fake_channel = FakeChannel(self.http)
+            self._fake_channel.id = self.http.channel.id
+        return self._fake_channel
+
+    async def original_response(self):
+        await self.http.call('interaction.original_response')
+        return self.original
+
+    async def edit_original_response(self, **kwargs):
+        await self.http.call('interaction.edit_original_response')
+        target = self.message if self.response._type == 'deferred_update' else self.original
+        target.apply(**kwargs)
+        self.http.card_edited(target)
+        return target
+
+
+class FrozenClock(datetime):
+    """datetime.now() бота, зафиксированный на заданном времени сегодняшнего дня"""
+
+    offset = 0.0
+
+    @classmethod
+    def now(cls, tz=None):
+        return datetime.fromtimestamp(time.time() + cls.offset, tz)
+
+
+def generate_traffic(users, rate, moderators, clicks, delete_share, history_share, invalid_share, repeat_share=0.0, seed=0):
+    """События нагрузки: {"at", "op", "key"/"user"/"moderator", ...}, отсортированные по времени
+
+    Доля repeat_share сотрудников отправляет форму повторно: почти одновременно
+    с первой заявкой (двойное нажатие) и еще раз позже. Их заявки не
+    рассматриваются и не удаляются, поэтому лишняя ожидающая заявка доживает
+    до проверки согласованности.
+    """
+    rng = random.Random(seed)
+    events = []
+    at = 0.0
+    for key in range(users):
+        at += rng.expovariate(rate)
+        start = rng.randrange(10 * 60, 17 * 60)
+        end = start + rng.choice((15, 30, 45, 60))
+        time_text = f'{start // 60:02d}:{start % 60:02d} - {end // 60:02d}:{end % 60:02d}'
+        if rng.random() < invalid_share:
+            time_text = rng.choice(('25:00 - 26:00', '10:00 - 13:00', 'завтра'))
+        events.append({'at': at, 'op': 'submit', 'key': key, 'user': key, 'time': time_text})
+        if rng.random() < repeat_share:
+            for n, repeat_at in enumerate((at + rng.uniform(0, 0.005), at + rng.uniform(0.1, 1.0))):
+                events.append({'at': repeat_at, 'op': 'submit', 'key': f'{key}-{n}', 'user': key, 'time': time_text})
+            continue
+        # Несколько модераторов нажимают на одну карточку почти одновременно
+        decided_at = at + rng.uniform(0.05, 0.5)
+        for _ in range(clicks):
+            events.append({
+                'at': decided_at + rng.uniform(0, 0.02),
+                'op': rng.choice(('approve', 'approve', 'reject')),
+                'key': key,
+                'moderator': rng.randrange(moderators),
+            })
+        if rng.random() < delete_share:
+            events.append({'at': decided_at + rng.uniform(0, 0.02), 'op': 'delete', 'key': key, 'user': key})
+        if rng.random() < history_share:
+            events.append({'at': decided_at + rng.uniform(0.1, 1.0), 'op': 'history', 'user': key})
+    events.sort(key=lambda event: event['at'])
+    return events
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] if values else 0.0
+
+
+class LoadHarness:
+    def __init__(self, http, moderators):
+        self.http = http
+        self.guild = FakeGuild(bot.MODERATOR_ROLE_NAMES + ('Сотрудник',))
+        moderator_role = next(role for role in self.guild.roles if role.name == 'Модератор')
+        self.moderators = [FakeMember(self.guild, f'Модератор {i}', [moderator_role]) for i in range(moderators)]
+        self.users = {}
+        self.submits = {}
+        self.latencies = {}
+        self.acks = {}
+        self.errors = []
+        self.outcomes = {}
+
+    def user(self, index):
+        member = self.users.get(index)
+        if member is None:
+            member = self.users[index] = FakeMember(self.guild, f'Сотрудник {index}')
+        return member
+
+    def interaction(self, kind, user, message=None):
+        return FakeInteraction(self.http, kind, user, self.guild, message)
+
+    async def run_event(self, event):
+        op = event['op']
+        if op != 'submit' and 'key' in event:
+            # Действие с карточкой возможно только после того, как заявка подана
+            submitted = await self.submits[event['key']]
+            if submitted is None:
+                return
+            request_id, card = submitted
+        started = time.perf_counter()
+        interaction = None
+        try:
+            if op == 'submit':
+                interaction = self.interaction(discord.InteractionType.modal_submit, self.user(event['user']))
+                modal = bot.OtgulModal()
+                modal.имя_фамилия._value = f'Сотрудник {event["user"]}'
+                modal.статик._value = '123-456'
+                modal.время._value = event['time']
+                modal.причина._value = 'Гражданские дела'
+                await modal.on_submit(interaction)
+            elif op == 'approve':
+                interaction = self.interaction(discord.InteractionType.component, self.moderators[event['moderator']], card)
+                await bot.OtgulButtonsView(request_id).handle_approve(interaction)
+            elif op == 'reject':
+                interaction = self.interaction(discord.InteractionType.component, self.moderators[event['moderator']], card)
+                await bot.OtgulButtonsView(request_id).handle_reject(interaction)
+                if interaction.modal is not None:
+                    interaction = self.interaction(discord.InteractionType.modal_submit, interaction.user, card)
+                    interaction.modal = None
+                    modal = bot.RejectModal(request_id)
+                    modal.причина._value = 'Нагрузочный прогон'
+                    await modal.on_submit(interaction)
+            elif op == 'delete':
+                interaction = self.interaction(discord.InteractionType.component, self.user(event['user']), card)
+                await bot.OtgulButtonsView(request_id).handle_delete(interaction)
+            elif op == 'history':
+                interaction = self.interaction(discord.InteractionType.application_command, self.user(event['user']))
+                await bot.my_otguls.callback(interaction)
+        except Exception as e:
+            self.errors.append(f'{op}: {type(e).__name__}: {e}')
+        finally:
+            elapsed = time.perf_counter() - started
+            self.latencies.setdefault(op, []).append(elapsed)
+            if interaction is not None and interaction.acked_at is not None:
+                self.acks.setdefault(op, []).append(interaction.acked_at - started)
+        if op == 'submit':
+            card = interaction.original if interaction is not None else None
+            if interaction is not None and interaction._fake_channel is not None and interaction._fake_channel.sent:
+                # Ответ был отложен скрыто, карточка опубликована в канал отдельным сообщением
+                card = interaction._fake_channel.sent[-1]
+            request_id = None
+            if card is not None and card.view is not None:
+                request_id = card.view.request_id
+                self.http.cards[card.id] = request_id
+            self.submits[event['key']].set_result((request_id, card) if request_id is not None else None)
+
+    async def replay(self, events, speed):
+        loop = asyncio.get_running_loop()
+        self.submits = {event['key']: loop.create_future() for event in events if event['op'] == 'submit'}
+        started = loop.time()
+        tasks = []
+        for event in events:
+            delay = started + event['at'] / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(self.run_event(event)))
+        await asyncio.gather(*tasks)
+
+
+async def measure_lag(samples, interval=0.01):
+    """Задержка цикла событий: насколько позже срока просыпается sleep(interval)"""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - expected))
+
+
+def check_consistency(harness):
+    """Нарушения согласованности после прогона"""
+    violations = []
+    requests = bot.store.all()
+    ids = [request.id for request in requests]
+    if len(ids) != len(set(ids)):
+        violations.append('повторяющиеся ID заявок в хранилище')
+    submitted = [value[0] for value in (f.result() for f in harness.submits.values()) if value is not None]
+    if len(submitted) != len(set(submitted)):
+        violations.append('одинаковый ID выдан разным заявкам')
+    for request_id, count in harness.http.decisions.items():
+        request = bot.store.get(request_id)
+        if count > 1:
+            violations.append(f'заявка #{request_id}: решение показано {count} раз')
+        if request is None or request['status'] not in ('approved', 'rejected'):
+            violations.append(f'заявка #{request_id}: карточка закрыта, статус {request and request["status"]}')
+    for request_id in harness.http.deletions:
+        if request_id in harness.http.decisions:
+            violations.append(f'заявка #{request_id}: одновременно рассмотрена и удалена')
+        request = bot.store.get(request_id)
+        if request is None or request['status'] != 'deleted':
+            violations.append(f'заявка #{request_id}: карточка удалена, статус {request and request["status"]}')
+    notified = {}
+    for notification in bot.notifier._queue:
+        notified[notification['request_id']] = notified.get(notification['request_id'], 0) + 1
+    for request_id, count in notified.items():
+        if count > 1:
+            violations.append(f'заявка #{request_id}: {count} уведомления о решении')
+    pending = {}
+    for request in bot.store.pending():
+        key = (request['user_id'], request['date'])
+        pending[key] = pending.get(key, 0) + 1
+    violations.extend(f'пользователь {user_id}: {count} ожидающих заявок на {day}' for (user_id, day), count in pending.items() if count > 1)
+    return violations
+
+
+async def check_persisted():
+    """Расхождения между памятью, диском и счетчиками статистики"""
+    violations = []
+    await bot.store_writer.stop()
+    reloaded = bot.RequestStore(bot.create_backend())
+    reloaded.load()
+    if reloaded.partitioned:
+        for guild_id in reloaded.backend.guilds():
+            await reloaded.load_guild(guild_id)
+    on_disk = {r.id: r.to_dict() for r in reloaded.all()}
+    for request in bot.store.all():
+        if on_disk.pop(request.id, None) != request.to_dict():
+            violations.append(f'заявка #{request.id}: на диске отличается от памяти')
+    violations.extend(f'заявка #{request_id}: есть на диске, но не в памяти' for request_id in on_disk)
+    incremental = json.loads(json.dumps(bot.store.stats.data))
+    rebuilt = bot.StatsCounters(bot.store.stats.path)
+    rebuilt.rebuild(bot.store.all())
+    if json.loads(json.dumps(rebuilt.data)) != incremental:
+        violations.append('счетчики статистики отличаются от пересчета по истории')
+    return violations
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50_ms': percentile(values, 0.5) * 1000,
+        'p99_ms': percentile(values, 0.99) * 1000,
+        'max_ms': max(values, default=0.0) * 1000,
+    }
+
+
+async def run(args, events):
+    http = FakeHTTP(args.latency / 1000, args.jitter / 1000, args.seed)
+    # Бот не подключается к Discord: только хранилище и фоновая запись
+    await asyncio.to_thread(bot.store.load)
+    bot.store_writer.start()
+    harness = LoadHarness(http, args.moderators)
+    lag = []
+    monitor = asyncio.create_task(measure_lag(lag))
+    started = time.perf_counter()
+    await harness.replay(events, args.speed)
+    wall = time.perf_counter() - started
+    monitor.cancel()
+    violations = check_consistency(harness) + await check_persisted()
+    return {
+        'events': len(events),
+        'wall_s': wall,
+        'handlers': {op: summarize(values) for op, values in sorted(harness.latencies.items())},
+        'first_response': {op: summarize(values) for op, values in sorted(harness.acks.items())},
+        'loop_lag': summarize(lag),
+        'http_calls': http.calls,
+        'requests': {status: sum(1 for r in bot.store.all() if r['status'] == status)
+                     for status in ('pending', 'approved', 'rejected', 'deleted', 'expired')},
+        'errors': harness.errors,
+        'violations': violations,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон обработчиков заявок без Discord')
+    parser.add_argument('--users', type=int, default=200, help='Число заявок (по одной на сотрудника)')
+    parser.add_argument('--rate', type=float, default=50.0, help='Заявок в секунду')
+    parser.add_argument('--moderators', type=int, default=5, help='Число модераторов')
+    parser.add_argument('--clicks', type=int, default=3, help='Одновременных решений по одной карточке')
+    parser.add_argument('--delete-share', type=float, default=0.1, help='Доля заявок, которые владелец удаляет во время рассмотрения')
+    parser.add_argument('--history-share', type=float, default=0.3, help='Доля сотрудников, открывающих /мои_отгулы')
+    parser.add_argument('--invalid-share', type=float, default=0.05, help='Доля заявок с неверным временем')
+    parser.add_argument('--repeat-share', type=float, default=0.2, help='Доля сотрудников, повторно отправляющих форму')
+    parser.add_argument('--latency', type=float, default=40.0, help='Задержка ответа заглушки Discord, мс')
+    parser.add_argument('--jitter', type=float, default=15.0, help='Разброс задержки, мс')
+    parser.add_argument('--speed', type=float, default=1.0, help='Ускорение воспроизведения')
+    parser.add_argument('--now', default='09:00', help='Текущее время бота (ЧЧ:ММ), чтобы заявки были в будущем')
+    parser.add_argument('--storage', choices=('json', 'journal', 'sqlite'), default='journal', help='Хранилище')
+    parser.add_argument('--partitioned', action='store_true', help='Хранить заявки каждого сервера в своем файле')
+    parser.add_argument('--throttle', action='store_true', help='Оставить ограничение частоты взаимодействий')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--record', metavar='FILE', help='Сохранить сгенерированный трафик в JSONL')
+    parser.add_argument('--replay', metavar='FILE', help='Воспроизвести трафик из JSONL')
+    parser.add_argument('--output', help='Файл отчета (по умолчанию stdout)')
+    parser.add_argument('--keep', action='store_true', help='Не удалять временный каталог с файлами бота')
+    args = parser.parse_args()
+    if args.output:
+        # Путь отчета считается от каталога запуска, а не от временного
+        args.output = os.path.abspath(args.output)
+
+    if args.replay:
+        with open(args.replay, 'r', encoding='utf-8') as f:
+            events = [json.loads(line) for line in f if line.strip()]
+    else:
+        events = generate_traffic(
+            args.users, args.rate, args.moderators, args.clicks,
+            args.delete_share, args.history_share, args.invalid_share, args.repeat_share, args.seed
+        )
+    if args.record:
+        with open(args.record, 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(event, ensure_ascii=False) + '\n' for event in events)
+
+    # Все файлы бота создаются во временном каталоге; он удаляется после прогона, если не указан --keep
+    if args.keep:
+        workdir = tempfile.mkdtemp(prefix='otgul-load-')
+        cleanup = contextlib.nullcontext(workdir)
+    else:
+        cleanup = tempfile.TemporaryDirectory(prefix='otgul-load-', ignore_cleanup_errors=True)
+        workdir = cleanup.name
+    cwd = os.getcwd()
+    with cleanup:
+        os.chdir(workdir)
+        try:
+            report = run_in(args, events)
+        finally:
+            os.chdir(cwd)
+    if args.keep:
+        report['workdir'] = workdir
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    for violation in report['violations']:
+        print(f'❌ {violation}', file=sys.stderr)
+    if report['violations'] or report['errors']:
+        sys.exit(1)
+    print('✅ Нарушений согласованности нет', file=sys.stderr)
+
+
+def run_in(args, events):
+    """Импортирует бота в текущем (временном) каталоге и проводит прогон"""
+    os.environ['OTGUL_STORAGE'] = 'sqlite' if args.storage == 'sqlite' else 'json'
+    os.environ['OTGUL_JOURNAL'] = '1' if args.storage == 'journal' else '0'
+    os.environ['OTGUL_PARTITIONED'] = '1' if args.partitioned else '0'
+    os.environ['OTGUL_METRICS_PORT'] = '0'
+    global bot
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot as bot_module
+    bot = bot_module
+
+    hour, minute = map(int, args.now.split(':'))
+    target = datetime.now().replace(hour=hour, minute=minute, second=0, microsecond=0)
+    FrozenClock.offset = target.timestamp() - time.time()
+    bot.datetime = FrozenClock
+    if not args.throttle:
+        bot.throttle = bot.InteractionThrottle({})
+
+    return asyncio.run(run(args, events))
+
+
+if __name__ == '__main__':
+    main()
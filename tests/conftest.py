@@ -0,0 +1,57 @@
+import os
+import sys
+
+import pytest
+
+# bot.py лежит в корне репозитория и импортируется как модуль
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('OTGUL_METRICS_PORT', '0')
+
+import bot  # noqa: E402
+
+LEGACY = {
+    'id': 7,
+    'user_id': '123456789012345678',
+    'username': 'Иван Иванов',
+    'date': '15.03.2027',
+    'time': '10:00 - 10:30',
+    'duration': '30 мин',
+    'static': '123-456',
+    'department': 'ГИБДД',
+    'reason': 'Гражданские дела',
+    'status': 'approved',
+    'created_at': '2027-03-15 09:12:00',
+    'moderator_id': '876543210987654321',
+    'moderator_name': 'Модератор',
+    'processed_at': '2027-03-15 09:20:00',
+    'guild_id': '555',
+    'custom_note': 'сохраняется как есть',
+}
+
+
+@pytest.fixture
+def legacy():
+    """Заявка в прежнем (строковом) формате otgul_requests.json"""
+    return dict(LEGACY)
+
+
+@pytest.fixture
+def make_request():
+    """Заявка на основе LEGACY с заменой отдельных полей"""
+    def make(request_id, **changes):
+        return bot.OtgulRequest(**dict(LEGACY, id=request_id, **changes))
+    return make
+
+
+@pytest.fixture
+def new_store(tmp_path):
+    """Хранилище в tmp_path, собранное как в боте: JSON с журналом, архив и счетчики"""
+    def make(backend=None, archive=True, stats=True):
+        if backend is None:
+            backend = bot.JsonBackend(str(tmp_path / 'otgul_requests.json'), str(tmp_path / 'otgul_requests.journal'))
+        return bot.RequestStore(
+            backend,
+            bot.RequestArchive(str(tmp_path / 'archive')) if archive else None,
+            bot.StatsCounters(str(tmp_path / 'otgul_stats.json')) if stats else None
+        )
+    return make
@@ -0,0 +1,105 @@
+import random
+from datetime import datetime
+
+import pytest
+
+from bot import AbsenceIndex, OtgulRequest, TimeWindow, _MinuteTree
+
+
+@pytest.mark.parametrize('text, start, end', [
+    ('10:00 - 10:30', 600, 630),
+    ('9:05-9:45', 545, 585),
+    ('23:00 - 23:59', 1380, 1439),
+])
+def test_time_window_parse(text, start, end):
+    window = TimeWindow.parse(text)
+    assert (window.start, window.end) == (start, end)
+    assert window.duration == end - start
+
+
+@pytest.mark.parametrize('text, message', [
+    ('', 'Неверный формат'),
+    ('10:00', 'Неверный формат'),
+    ('24:00 - 24:30', 'Неверный формат'),
+    ('10:60 - 11:00', 'Неверный формат'),
+    ('11:00 - 10:00', 'окончания'),
+    ('10:00 - 10:00', 'окончания'),
+])
+def test_time_window_parse_rejects(text, message):
+    with pytest.raises(ValueError, match=message):
+        TimeWindow.parse(text)
+
+
+def test_time_window_duration_limit_and_text():
+    assert TimeWindow.parse('10:00 - 11:00').check_duration().duration_text() == '1 ч'
+    assert TimeWindow.parse('10:00 - 10:45').duration_text() == '45 мин'
+    with pytest.raises(ValueError):
+        TimeWindow.parse('10:00 - 11:01').check_duration()
+    assert str(TimeWindow.parse('9:05 - 9:45')) == '09:05 - 09:45'
+
+
+def test_minute_tree_matches_naive_counts():
+    rng = random.Random(1)
+    tree = _MinuteTree(size=120)
+    counts = [0] * 120
+    added = []
+    for _ in range(200):
+        # Как в AbsenceIndex: вычитается только ранее добавленный интервал
+        if added and rng.random() < 0.3:
+            start, end = added.pop(rng.randrange(len(added)))
+            value = -1
+        else:
+            start = rng.randrange(120)
+            end = rng.randrange(start + 1, 121)
+            added.append((start, end))
+            value = 1
+        tree.add(start, end, value)
+        for minute in range(start, end):
+            counts[minute] += value
+        low = rng.randrange(120)
+        high = rng.randrange(low + 1, 121)
+        assert tree.max(low, high) == max(counts[low:high])
+
+
+def absence(request_id, time, date=None, status='pending', department='ГИБДД'):
+    date = date or datetime.now().strftime('%d.%m.%Y')
+    return OtgulRequest(id=request_id, date=date, time=time, status=status, department=department)
+
+
+def test_absence_index_concurrency_and_overlaps():
+    index = AbsenceIndex()
+    today = datetime.now().strftime('%d.%m.%Y')
+    requests = [
+        absence(1, '10:00 - 11:00'),
+        absence(2, '10:30 - 11:00'),
+        absence(3, '11:00 - 11:30'),
+        absence(4, '10:00 - 11:00', status='rejected'),
+        absence(5, '10:00 - 11:00', department='ППС'),
+    ]
+    for request in requests:
+        index.add(request)
+    assert index.max_concurrent(today, 'ГИБДД', TimeWindow.parse('10:00 - 12:00')) == 2
+    assert index.max_concurrent(today, 'ГИБДД', TimeWindow.parse('11:00 - 12:00')) == 1
+    assert sorted(index.overlapping(today, 'ГИБДД', TimeWindow.parse('10:45 - 11:15'))) == [1, 2, 3]
+    assert index.overlapping(today, 'ППС', TimeWindow.parse('10:00 - 10:15')) == [5]
+
+    # Дерево уже построено и должно обновляться вместе со списком интервалов
+    index.remove(requests[1])
+    index.add(absence(6, '11:15 - 11:45'))
+    assert index.max_concurrent(today, 'ГИБДД', TimeWindow.parse('10:00 - 12:00')) == 2
+    assert sorted(index.overlapping(today, 'ГИБДД', TimeWindow.parse('10:45 - 11:15'))) == [1, 3]
+
+
+def test_absence_index_keeps_past_days_without_trees():
+    index = AbsenceIndex()
+    index.add(absence(1, '10:00 - 11:00', date='01.01.2020'))
+    today = datetime.now().strftime('%d.%m.%Y')
+    index.add(absence(2, '10:00 - 11:00'))
+    window = TimeWindow.parse('10:00 - 11:00')
+    assert index.overlapping('01.01.2020', 'ГИБДД', window) == [1]
+    assert index.max_concurrent('01.01.2020', 'ГИБДД', window) == 1
+    # Построение дерева текущего дня удаляет деревья прошедших
+    index.remove(absence(2, '10:00 - 11:00'))
+    index.add(absence(3, '10:00 - 11:00'))
+    assert index.max_concurrent(today, 'ГИБДД', window) == 1
+    assert len(index._trees) == 1
@@ -0,0 +1,52 @@
+import asyncio
+from datetime import datetime
+
+import bot
+from bot import JsonBackend, RequestArchive
+
+
+def test_processed_past_requests_move_to_archive(tmp_path, new_store, make_request, monkeypatch):
+    store = new_store()
+    monkeypatch.setattr(bot, 'store', store)
+    today = datetime.now().strftime('%d.%m.%Y')
+    old = store.add(make_request(None, date='15.03.2026', status='approved'))
+    pending = store.add(make_request(None, date='15.03.2026', status='pending'))
+    fresh = store.add(make_request(None, date=today, status='rejected'))
+
+    assert asyncio.run(bot.archive_processed_requests()) == 1
+    assert store.get(old.id) is None
+    assert sorted(r.id for r in store.all()) == [pending.id, fresh.id]
+
+    archive = RequestArchive(str(tmp_path / 'archive'))
+    assert archive.months() == ['2026-03']
+    assert archive.load_month('2026-03')[old.id]['status'] == 'approved'
+    assert archive.user_index(old['user_id']) == [[old.id, '2026-03', 'approved', '15.03.2026']]
+    assert archive.max_id() == old.id
+
+    # Из горячего хранилища на диске заявка тоже удалена
+    hot = JsonBackend(str(tmp_path / 'otgul_requests.json'), str(tmp_path / 'otgul_requests.journal')).load()
+    assert sorted(r.id for r in hot) == [pending.id, fresh.id]
+
+
+def test_archived_ids_are_not_reissued(tmp_path, new_store, make_request, monkeypatch):
+    store = new_store()
+    monkeypatch.setattr(bot, 'store', store)
+    for _ in range(3):
+        store.add(make_request(None, date='15.03.2026', status='approved'))
+    asyncio.run(bot.archive_processed_requests())
+    assert store.all() == []
+
+    reloaded = new_store()
+    assert reloaded.add(make_request(None, status='pending')).id == 4
+
+
+def test_rearchiving_replaces_entries(tmp_path, make_request):
+    archive = RequestArchive(str(tmp_path / 'archive'))
+    archive.archive([make_request(1, date='15.03.2026', status='approved')])
+    # Повтор после сбоя между записью архива и удалением из горячего хранилища
+    archive.archive([make_request(1, date='15.03.2026', status='rejected'), make_request(2, date='01.04.2026')])
+    assert list(archive.load_month('2026-03')) == [1]
+    assert archive.load_month('2026-03')[1]['status'] == 'rejected'
+    assert [entry[:3] for entry in archive.user_index(make_request(1)['user_id'])] == [
+        [1, '2026-03', 'rejected'], [2, '2026-04', 'approved']
+    ]
@@ -0,0 +1,62 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import bot
+from bot import ExpiryScheduler, Status, request_deadline, status_changes
+
+YESTERDAY = (datetime.now() - timedelta(days=1)).strftime('%d.%m.%Y')
+TOMORROW = (datetime.now() + timedelta(days=1)).strftime('%d.%m.%Y')
+
+
+@pytest.fixture
+def store(new_store, monkeypatch):
+    store = new_store()
+    monkeypatch.setattr(bot, 'store', store)
+    return store
+
+
+def test_deadline_is_end_of_interval():
+    request = bot.OtgulRequest(date='15.03.2027', time='10:00 - 10:30')
+    assert request_deadline(request) == datetime(2027, 3, 15, 10, 30).timestamp()
+    assert request_deadline(bot.OtgulRequest(date='15.03.2027', time='когда-нибудь')) == datetime(2027, 3, 16).timestamp()
+
+
+def test_expire_due_pops_only_past_deadlines(store, make_request):
+    past = store.add(make_request(None, status='pending', date=YESTERDAY))
+    decided = store.add(make_request(None, status='pending', date=YESTERDAY))
+    future = store.add(make_request(None, status='pending', date=TOMORROW))
+    scheduler = ExpiryScheduler(None)
+
+    async def scenario():
+        scheduler.start()
+        scheduler.stop()
+        # Заявка, рассмотренная раньше срока, пропускается при извлечении из кучи
+        store.transition(decided.id, 'pending', **status_changes('approved', '1', 'Модератор'))
+        return await scheduler.expire_due()
+
+    assert asyncio.run(scenario()) == [past]
+    assert past.status is Status.EXPIRED
+    assert decided.status is Status.APPROVED
+    assert future.status is Status.PENDING
+    assert [request_id for _, request_id in scheduler._heap] == [future.id]
+
+
+def test_scheduled_request_wakes_the_task(store, make_request):
+    scheduler = ExpiryScheduler(None)
+
+    async def scenario():
+        scheduler.start()
+        await asyncio.sleep(0)
+        # Пустая куча: задача спит без срока, пока не появится новая заявка
+        request = store.add(make_request(None, status='pending', date=YESTERDAY))
+        scheduler.schedule(request)
+        for _ in range(100):
+            if request.status is Status.EXPIRED:
+                break
+            await asyncio.sleep(0.01)
+        scheduler.stop()
+        return request
+
+    assert asyncio.run(scenario()).status is Status.EXPIRED
@@ -0,0 +1,74 @@
+import csv
+import io
+import json
+
+import pytest
+
+from bot import RequestArchive, iter_export_requests, parse_date, write_export
+
+
+@pytest.fixture
+def sources(tmp_path, make_request):
+    """Архив за март и апрель и горячие заявки мая; заявка 4 есть и в архиве, и в памяти"""
+    archive = RequestArchive(str(tmp_path / 'archive'))
+    archive.archive([
+        make_request(1, date='10.03.2026', status='approved'),
+        make_request(2, date='20.03.2026', status='rejected', user_id='42'),
+        make_request(3, date='05.04.2026', status='approved', moderator_id='9'),
+        make_request(4, date='06.04.2026', status='approved'),
+    ])
+    hot = [
+        make_request(4, date='06.04.2026', status='expired'),
+        make_request(5, date='01.05.2026', status='pending', moderator_id=None),
+        make_request(6, date='02.05.2026', status='approved', user_id='42'),
+    ]
+    return hot, archive
+
+
+def ids(requests):
+    return [r['id'] for r in requests]
+
+
+def test_without_filters_hot_copy_wins(sources):
+    hot, archive = sources
+    exported = list(iter_export_requests(hot, archive))
+    assert ids(exported) == [1, 2, 3, 4, 5, 6]
+    assert exported[3]['status'] == 'expired'
+
+
+@pytest.mark.parametrize('filters, expected', [
+    ({'date_from': parse_date('15.03.2026'), 'date_to': parse_date('05.04.2026')}, [2, 3]),
+    ({'date_from': parse_date('01.05.2026')}, [5, 6]),
+    ({'date_to': parse_date('31.03.2026')}, [1, 2]),
+    ({'user_id': 42}, [2, 6]),
+    ({'status': 'approved'}, [1, 3, 6]),
+    ({'moderator_id': 9}, [3]),
+    ({'user_id': '42', 'status': 'rejected'}, [2]),
+])
+def test_filters(sources, filters, expected):
+    hot, archive = sources
+    assert ids(iter_export_requests(hot, archive, **filters)) == expected
+
+
+def test_date_filter_skips_months_outside_range(sources, monkeypatch):
+    hot, archive = sources
+    read = []
+    original = archive.read_month
+    monkeypatch.setattr(archive, 'read_month', lambda month: read.append(month) or original(month))
+    list(iter_export_requests(hot, archive, date_from=parse_date('01.04.2026')))
+    assert read == ['2026-04']
+
+
+def test_write_export_formats(sources):
+    hot, archive = sources
+    buffer = io.BytesIO()
+    assert write_export(iter_export_requests(hot, archive, status='approved'), 'csv', buffer) == 3
+    rows = list(csv.DictReader(io.StringIO(buffer.getvalue().decode('utf-8-sig'))))
+    assert [row['id'] for row in rows] == ['1', '3', '6']
+    assert rows[0]['date'] == '10.03.2026'
+
+    buffer = io.BytesIO()
+    assert write_export(iter_export_requests(hot, archive, user_id='42'), 'jsonl', buffer) == 2
+    lines = [json.loads(line) for line in buffer.getvalue().decode('utf-8').splitlines()]
+    assert [line['id'] for line in lines] == [2, 6]
+    assert lines[0]['user_id'] == '42'
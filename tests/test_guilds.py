@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+from bot import JsonBackend, PartitionedBackend, TimeWindow, date_ordinal, iter_export_requests
+
+DATE = '16.10.2026'
+WINDOW = TimeWindow.parse('10:00 - 11:00')
+
+
+@pytest.fixture
+def store(new_store, make_request):
+    """Две заявки одного пользователя на разных серверах и одна без сервера"""
+    store = new_store()
+    for guild_id in ('111', '222', None):
+        store.add(make_request(None, status='pending', date=DATE, time='10:00 - 10:30', guild_id=guild_id))
+    return store
+
+
+def ids(requests):
+    return [r['id'] for r in requests]
+
+
+def test_find_and_pending_scoped_by_guild(store, legacy):
+    user_id = legacy['user_id']
+    assert ids(store.find(user_id, DATE, 'pending', 111)) == [1, 3]
+    assert ids(store.find(user_id, date_ordinal(DATE), 'pending', '222')) == [2, 3]
+    # Заявки без сервера видны везде, а без guild_id поиск идет по всем серверам
+    assert ids(store.find(user_id, DATE, 'pending', 333)) == [3]
+    assert ids(store.find(user_id, DATE, 'pending')) == [1, 2, 3]
+    assert ids(store.pending(111)) == [1, 3]
+    assert ids(store.pending()) == [1, 2, 3]
+
+
+def test_absences_scoped_by_guild(store, legacy):
+    department = legacy['department']
+    assert store.max_concurrent(DATE, department, WINDOW, 111) == 2
+    assert store.max_concurrent(DATE, department, WINDOW, 333) == 1
+    assert ids(store.overlapping(DATE, department, WINDOW, 222)) == [2, 3]
+    assert ids(store.overlapping(DATE, department, TimeWindow.parse('10:30 - 11:00'), 222)) == []
+
+
+def test_stats_and_export_scoped_by_guild(store, legacy):
+    for request_id in (1, 2, 3):
+        store.transition(request_id, 'pending', status='approved')
+    assert store.stats.get('users', legacy['user_id'], 111)['approved'] == 2
+    assert store.stats.get('users', legacy['user_id'], 333)['approved'] == 1
+    assert ids(iter_export_requests(store.all(), guild_id=222)) == [2, 3]
+
+
+def test_partitioned_backend_keeps_guilds_apart(tmp_path, new_store, make_request):
+    def backend():
+        factory = lambda base: JsonBackend(f'{base}.json', f'{base}.journal')
+        legacy_backend = JsonBackend(str(tmp_path / 'otgul_requests.json'), str(tmp_path / 'otgul_requests.journal'))
+        return PartitionedBackend(str(tmp_path / 'guilds'), legacy_backend, factory)
+
+    store = new_store(backend())
+    for guild_id in ('111', '222', None):
+        store.add(make_request(None, status='pending', date=DATE, guild_id=guild_id))
+    asyncio.run(store.persist())
+    store.backend.close()
+
+    reloaded = new_store(backend())
+    reloaded.load()
+    assert reloaded.backend.guilds() == [111, 222]
+    # Файлы серверов читаются только по требованию, но разовые проходы видят все заявки
+    assert ids(reloaded.all()) == [3]
+    assert sorted(ids(reloaded.all_guilds())) == [1, 2, 3]
+    assert ids(reloaded.pending(222)) == [2, 3]
+    assert reloaded.add(make_request(None, status='pending', guild_id='111')).id == 4
+    reloaded.backend.close()
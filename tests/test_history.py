@@ -0,0 +1,64 @@
+import asyncio
+
+import bot
+from bot import HistoryView
+
+
+def fill(store, make_request, monkeypatch):
+    """7 заявок пользователя: 1–4 в архиве, 5–7 в горячем хранилище, и одна чужая"""
+    monkeypatch.setattr(bot, 'store', store)
+    for day in range(1, 5):
+        store.add(make_request(None, date=f'{day:02d}.03.2026', status='approved' if day % 2 else 'rejected'))
+    asyncio.run(bot.archive_processed_requests())
+    for day in range(5, 8):
+        store.add(make_request(None, date=f'{day:02d}.04.2026', status='pending'))
+    store.add(make_request(None, user_id='1', date='01.04.2026', status='pending'))
+    return make_request(0)['user_id']
+
+
+def test_history_index_merges_archive_and_hot(new_store, make_request, monkeypatch):
+    store = new_store()
+    user_id = fill(store, make_request, monkeypatch)
+
+    async def scenario():
+        return (
+            await store.history_index(user_id),
+            await store.history_index(user_id, status='rejected'),
+            await store.history_index(user_id, date='04.2026'),
+        )
+
+    full, rejected, april = asyncio.run(scenario())
+    assert full == [(1, '2026-03'), (2, '2026-03'), (3, '2026-03'), (4, '2026-03'), (5, None), (6, None), (7, None)]
+    assert rejected == [(2, '2026-03'), (4, '2026-03')]
+    assert april == [(5, None), (6, None), (7, None)]
+
+
+def test_history_view_pages_by_cursor(new_store, make_request, monkeypatch):
+    store = new_store()
+    user_id = fill(store, make_request, monkeypatch)
+
+    async def scenario():
+        view = HistoryView(int(user_id), await store.history_index(user_id), page_size=3)
+        pages = []
+
+        async def page():
+            embed = await view.render()
+            pages.append(([int(field.name.split('#')[1].split()[0]) for field in embed.fields], embed.footer.text,
+                          view.newer_button.disabled, view.older_button.disabled))
+
+        await page()
+        view.older(view.ids[view.start])
+        await page()
+        view.older(view.ids[view.start])
+        await page()
+        view.newer(view.ids[view.end - 1])
+        await page()
+        return pages
+
+    pages = asyncio.run(scenario())
+    assert pages == [
+        ([7, 6, 5], 'Страница 1 из 3', True, False),
+        ([4, 3, 2], 'Страница 2 из 3', False, False),
+        ([1], 'Страница 3 из 3', False, True),
+        ([4, 3, 2], 'Страница 2 из 3', False, False),
+    ]
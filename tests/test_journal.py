@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+from bot import JsonBackend, RequestSerializer, Status
+
+
+@pytest.fixture
+def journal_backend(tmp_path):
+    backend = JsonBackend(str(tmp_path / 'otgul_requests.json'), str(tmp_path / 'otgul_requests.journal'))
+    yield backend
+    backend.close()
+
+
+def test_journal_replay_applies_puts_and_deletes(journal_backend, make_request):
+    journal_backend.save_all([make_request(1), make_request(2)])
+    journal_backend.write([
+        {'op': 'put', 'request': make_request(3)},
+        {'op': 'put', 'request': make_request(1, status='rejected')},
+        {'op': 'delete', 'id': 2},
+    ])
+    journal_backend.close()
+    loaded = {request.id: request for request in journal_backend.load()}
+    assert sorted(loaded) == [1, 3]
+    assert loaded[1].status is Status.REJECTED
+
+
+def test_journal_replay_stops_at_torn_last_line(journal_backend, make_request):
+    journal_backend.save_all([make_request(1)])
+    journal_backend.write([{'op': 'put', 'request': make_request(2)}])
+    journal_backend.close()
+    # Сбой посреди записи оставляет недописанную последнюю строку
+    line = json.dumps(RequestSerializer.entry({'op': 'put', 'request': make_request(3)}), ensure_ascii=False)
+    with open(journal_backend.journal_path, 'a', encoding='utf-8') as f:
+        f.write(line[:len(line) // 2])
+    assert sorted(request.id for request in journal_backend.load()) == [1, 2]
+
+
+def test_journal_reads_v1_entries(journal_backend, legacy):
+    journal_backend.save_all([])
+    with open(journal_backend.journal_path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'op': 'put', 'request': legacy}, ensure_ascii=False) + '\n')
+    (request,) = journal_backend.load()
+    assert request['date'] == legacy['date']
+    assert RequestSerializer.request_of({'op': 'put', 'request': legacy}).id == legacy['id']
@@ -0,0 +1,24 @@
+import pytest
+
+from bot import RateLimiter
+
+
+def test_rate_limiter_bucket():
+    limiter = RateLimiter(capacity=3, period=6)
+    for _ in range(3):
+        assert limiter.retry_after('user', now=100.0) == 0
+        limiter.take('user', now=100.0)
+    assert limiter.retry_after('user', now=100.0) == pytest.approx(2.0)
+    assert limiter.retry_after('user', now=101.0) == pytest.approx(1.0)
+    assert limiter.retry_after('user', now=102.0) == 0
+    assert limiter.retry_after('other', now=100.0) == 0
+
+
+def test_rate_limiter_evicts_idle_buckets():
+    limiter = RateLimiter(capacity=2, period=10)
+    limiter.take('idle', now=0.0)
+    limiter.take('busy', now=5.0)
+    assert len(limiter) == 2
+    limiter.evict_idle(now=10.0)
+    assert len(limiter) == 1
+    assert limiter.retry_after('idle', now=10.0) == 0
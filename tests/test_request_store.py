@@ -0,0 +1,37 @@
+from bot import JsonBackend, Status, status_changes
+
+
+def test_transition_is_compare_and_set(new_store, make_request):
+    store = new_store()
+    request = store.add(make_request(None, status='pending'))
+    approved = store.transition(request.id, 'pending', **status_changes('approved', '1', 'Модератор'))
+    assert approved is request
+    assert request.status is Status.APPROVED
+    # Второе решение по той же заявке уже не проходит и ничего не меняет
+    assert store.transition(request.id, 'pending', **status_changes('rejected', '2', 'Другой')) is None
+    assert request.status is Status.APPROVED
+    assert request['moderator_id'] == '1'
+    assert store.transition(12345, 'pending', status='approved') is None
+
+
+def test_transition_moves_request_between_indexes(new_store, make_request):
+    store = new_store()
+    request = store.add(make_request(None, status='pending', date='16.10.2026'))
+    assert store.pending() == [request]
+    store.transition(request.id, 'pending', **status_changes('rejected', '1', 'Модератор', 'Нет замены'))
+    assert store.pending() == []
+    assert store.find(request.user_id, '16.10.2026', 'pending') == []
+    assert store.find(request.user_id, '16.10.2026', 'rejected') == [request]
+
+
+def test_ids_grow_and_are_not_reused(tmp_path, new_store, make_request):
+    store = new_store()
+    ids = [store.add(make_request(None, status='pending')).id for _ in range(3)]
+    assert ids == [1, 2, 3]
+    store.delete(3)
+    assert store.add(make_request(None, status='pending')).id == 4
+    assert store.last_id() == 4
+
+    # После перезапуска последовательность продолжается с наибольшего ID на диске
+    reloaded = new_store(JsonBackend(str(tmp_path / 'otgul_requests.json'), str(tmp_path / 'otgul_requests.journal')))
+    assert reloaded.add(make_request(None, status='pending')).id == 5
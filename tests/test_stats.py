@@ -0,0 +1,51 @@
+import asyncio
+import json
+import random
+
+import bot
+from bot import StatsCounters, status_changes
+
+
+def test_incremental_counters_match_rebuild(tmp_path, new_store, make_request, monkeypatch):
+    store = new_store()
+    monkeypatch.setattr(bot, 'store', store)
+    rng = random.Random(3)
+    for _ in range(200):
+        request = store.add(make_request(
+            None,
+            user_id=str(100 + rng.randrange(10)),
+            date=f'{rng.randrange(1, 28):02d}.{rng.randrange(1, 4):02d}.2026',
+            time=rng.choice(('10:00 - 10:30', '12:00 - 13:00', 'неверно')),
+            status='pending',
+            guild_id=rng.choice((None, '555', '777')),
+            moderator_id=None, moderator_name=None, processed_at=None,
+        ))
+        roll = rng.random()
+        if roll < 0.6:
+            status = rng.choice(('approved', 'rejected'))
+            store.transition(request.id, 'pending', **status_changes(status, str(rng.randrange(3)), 'Модератор'))
+        elif roll < 0.7:
+            store.delete(request.id)
+    asyncio.run(bot.archive_processed_requests(today='01.01.2000'))
+    incremental = json.loads(json.dumps(store.stats.data))
+
+    asyncio.run(store.rebuild_stats())
+    assert store.stats.data == incremental
+    assert store.stats.max_id() == store.last_id()
+
+
+def test_counters_survive_save_and_load(tmp_path, make_request):
+    stats = StatsCounters(str(tmp_path / 'otgul_stats.json'))
+    stats.record(make_request(1, status='approved', guild_id=None))
+    stats.record(make_request(2, status='rejected'))
+    asyncio.run(stats.flush())
+    assert not stats.dirty
+
+    loaded = StatsCounters(stats.path)
+    assert loaded.load()
+    assert loaded.data == stats.data
+    assert loaded.max_id() == 2
+    user = loaded.get('users', make_request(0)['user_id'], guild_id=555)
+    assert (user['total'], user['approved'], user['rejected']) == (2, 1, 1)
+    # Заявки без сервера видны везде, заявки сервера 555 — только на нем
+    assert loaded.get('users', make_request(0)['user_id'], guild_id=777)['total'] == 1
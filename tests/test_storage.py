@@ -0,0 +1,48 @@
+import json
+
+import pytest
+
+from bot import Department, OtgulRequest, RequestSerializer, Status
+
+
+def test_v1_dict_converted_to_internal_form(legacy):
+    request = OtgulRequest.from_dict(legacy)
+    assert request.user_id == 123456789012345678
+    assert request.status is Status.APPROVED
+    assert request.department is Department.GIBDD
+    assert isinstance(request.date, int)
+    assert request.extra == {'custom_note': 'сохраняется как есть'}
+
+
+def test_v1_to_v2_round_trip_keeps_legacy_view(legacy):
+    requests = RequestSerializer.load([legacy])
+    data = json.loads(json.dumps(RequestSerializer.dump(requests), ensure_ascii=False))
+    assert data['version'] == RequestSerializer.VERSION
+    (restored,) = RequestSerializer.load(data)
+    for key, value in legacy.items():
+        assert restored[key] == value
+    assert restored.status is Status.APPROVED
+    assert restored.department is Department.GIBDD
+
+
+def test_v2_row_from_older_field_list(legacy, make_request):
+    # Строки, записанные до появления guild_id, короче текущего списка полей
+    fields = [name for name in OtgulRequest.__slots__ if name != 'guild_id']
+    request = make_request(1)
+    row = [value for name, value in zip(OtgulRequest.__slots__, RequestSerializer.row(request)) if name != 'guild_id']
+    restored = RequestSerializer.from_row(row, fields)
+    assert restored.guild_id is None
+    assert restored['user_id'] == legacy['user_id']
+    assert RequestSerializer.from_row(row).guild_id is None
+
+
+def test_v2_unknown_field_goes_to_extra():
+    restored = RequestSerializer.from_row([3, 'pending', 'x'], ['id', 'status', 'removed_field'])
+    assert restored.id == 3
+    assert restored.status is Status.PENDING
+    assert restored.extra == {'removed_field': 'x'}
+
+
+def test_unknown_version_rejected():
+    with pytest.raises(ValueError):
+        RequestSerializer.load({'version': 99, 'fields': [], 'rows': []})
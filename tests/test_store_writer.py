@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from bot import JsonBackend, StoreWriter
+
+
+class RecordingBackend(JsonBackend):
+    """JSON с журналом, запоминающий пачки записи; первые fail_writes записей падают"""
+
+    def __init__(self, directory, fail_writes=0):
+        super().__init__(str(directory / 'otgul_requests.json'), str(directory / 'otgul_requests.journal'))
+        self.batches = []
+        self.fail_writes = fail_writes
+
+    def write(self, entries, snapshot=None):
+        if self.fail_writes:
+            self.fail_writes -= 1
+            raise OSError('диск недоступен')
+        self.batches.append([entry['request'].id if entry['op'] == 'put' else entry['id'] for entry in entries])
+        super().write(entries, snapshot)
+
+
+def test_changes_are_written_in_one_batch(tmp_path, new_store, make_request):
+    backend = RecordingBackend(tmp_path)
+    store = new_store(backend)
+    store.load()
+
+    async def scenario():
+        writer = StoreWriter(store, max_delay=0.01, durable=True)
+        writer.start()
+        requests = [store.add(make_request(None, status='pending')) for _ in range(5)]
+        store.update(requests[0].id, status='approved')
+        await asyncio.gather(*(store.persist() for _ in range(3)))
+        await writer.stop()
+
+    asyncio.run(scenario())
+    assert backend.batches == [[1, 2, 3, 4, 5, 1]]
+    reloaded = new_store(JsonBackend(backend.path, backend.journal_path))
+    assert reloaded.get(1)['status'] == 'approved'
+    assert len(reloaded.all()) == 5
+
+
+def test_failed_write_is_requeued(tmp_path, new_store, make_request):
+    backend = RecordingBackend(tmp_path, fail_writes=1)
+    store = new_store(backend)
+    store.load()
+
+    async def scenario():
+        writer = StoreWriter(store, max_delay=0.01, durable=True)
+        writer.start()
+        store.add(make_request(None, status='pending'))
+        with pytest.raises(OSError):
+            await store.persist()
+        # Неудачная пачка остается в очереди и уходит вместе со следующими изменениями
+        assert writer.queue_size() == 1
+        store.add(make_request(None, status='pending'))
+        await store.persist()
+        assert writer.queue_size() == 0
+        await writer.stop()
+
+    asyncio.run(scenario())
+    assert backend.batches == [[1, 2]]
+    assert sorted(r.id for r in JsonBackend(backend.path, backend.journal_path).load()) == [1, 2]